@@ -0,0 +1,44 @@
+"""
+Apply the order event outbox to the sales and product metrics
+"""
+from django.core.management.base import BaseCommand
+import time
+
+from analytics.services import apply_order_events
+
+
+class Command(BaseCommand):
+    help = (
+        "Drain the order event outbox in batches, applying each event to the daily sales "
+        "and product performance metrics as a delta. Safe to run from several processes at once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Events applied per transaction")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep running, draining every --interval seconds")
+        parser.add_argument('--interval', type=float, default=5,
+                            help="Seconds between drains with --loop")
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                self.drain(options['batch_size'])
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write("Drain stopped")
+
+    def drain(self, batch_size):
+        """Apply batches until the outbox is empty"""
+        total = 0
+        while True:
+            applied = apply_order_events(batch_size)
+            total += applied
+            if applied < batch_size:
+                break
+        if total:
+            self.stdout.write(f"Applied {total} order events")
+        return total
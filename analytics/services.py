@@ -5,14 +5,18 @@ from django.utils import timezone
 from django.db.models import Sum, Count, Avg, F, Q
 from django.db import transaction
 from datetime import datetime, timedelta
+from decimal import Decimal
 import logging
 
 from .models import SalesMetric, ProductPerformance, PageView, ProductView, SearchQuery
-from orders.models import Order, OrderItem
-from products.models import Product, Category
+from orders.models import Order, OrderEvent, OrderItem
 
 logger = logging.getLogger(__name__)
 
+def start_of_day(day):
+    """Start of a date in the current time zone, so date filters stay ranges on the indexed datetime"""
+    return timezone.make_aware(datetime.combine(day, datetime.min.time()))
+
 def record_page_view(request, page_url):
     """
     Record a page view event for analytics
@@ -103,46 +107,29 @@ def record_search_query(request, query, results_count):
         logger.error(f"Error recording search query: {str(e)}")
         return False
 
-@transaction.atomic
-def aggregate_daily_sales_metrics():
+def record_search_query_after_response(response, request, query, results_count):
     """
-    Aggregate sales metrics for the previous day
-    This should be run daily as a scheduled task
+    Record a search query once the response has been sent, so logging it
+    adds no latency to the search. WSGI servers call the response's close()
+    after writing it out; the wrapper records the query first, while the
+    request's database connection is still open, then closes as usual.
+    
+    Args:
+        response: The search results response
+        request: The HTTP request object
+        query: The search query string
+        results_count: Number of search results
     """
-    yesterday = timezone.now().date() - timedelta(days=1)
+    close = response.close
     
-    try:
-        # Check if we already have metrics for yesterday
-        if SalesMetric.objects.filter(period_type='daily', date=yesterday).exists():
-            logger.info(f"Daily metrics for {yesterday} already exist, skipping aggregation.")
-            return False
-            
-        # Get yesterday's orders
-        yesterday_orders = Order.objects.filter(
-            order_date__date=yesterday
-        )
-        
-        # Calculate metrics
-        total_sales = yesterday_orders.filter(status='Completed').aggregate(
-            total=Sum('total_price')
-        )['total'] or 0
-        
-        order_count = yesterday_orders.count()
-        
-        # Create metrics record
-        SalesMetric.objects.create(
-            period_type='daily',
-            date=yesterday,
-            total_sales=total_sales,
-            order_count=order_count,
-            # Add more metrics as needed
-        )
-        
-        logger.info(f"Daily sales metrics for {yesterday} successfully aggregated.")
-        return True
-    except Exception as e:
-        logger.error(f"Error aggregating daily sales metrics: {str(e)}")
-        return False
+    def record_and_close():
+        try:
+            record_search_query(request, query, results_count)
+        finally:
+            close()
+    
+    response.close = record_and_close
+    return response
 
 @transaction.atomic
 def aggregate_weekly_sales_metrics():
@@ -162,10 +149,10 @@ def aggregate_weekly_sales_metrics():
             logger.info(f"Weekly metrics for week ending {last_sunday} already exist, skipping.")
             return False
             
-        # Get last week's orders
-        weekly_orders = Order.objects.filter(
-            order_date__date__gte=last_monday,
-            order_date__date__lte=last_sunday
+        # Get last week's orders, archived ones included
+        weekly_orders = Order.objects.in_range(
+            start_of_day(last_monday),
+            start_of_day(last_sunday + timedelta(days=1))
         )
         
         # Calculate metrics
@@ -208,10 +195,10 @@ def aggregate_monthly_sales_metrics():
             logger.info(f"Monthly metrics for {last_month_end.strftime('%B %Y')} already exist, skipping.")
             return False
             
-        # Get last month's orders
-        monthly_orders = Order.objects.filter(
-            order_date__date__gte=last_month_start,
-            order_date__date__lte=last_month_end
+        # Get last month's orders, archived ones included
+        monthly_orders = Order.objects.in_range(
+            start_of_day(last_month_start),
+            start_of_day(first_of_month)
         )
         
         # Calculate metrics
@@ -239,52 +226,90 @@ def aggregate_monthly_sales_metrics():
 @transaction.atomic
 def aggregate_product_performance():
     """
-    Aggregate product performance metrics for the previous day
-    This should be run daily as a scheduled task
+    Record product view counts for the previous day
+    This should be run daily as a scheduled task. Purchases and revenue on
+    the same rows are owned by apply_order_events and left untouched here.
     """
     yesterday = timezone.now().date() - timedelta(days=1)
     
     try:
-        # Process each product
-        for product in Product.objects.all():
-            # Check if we already have metrics for this product/date
-            if ProductPerformance.objects.filter(product=product, date=yesterday).exists():
-                continue
-                
-            # Count product views
-            view_count = ProductView.objects.filter(
-                product=product,
-                view_time__date=yesterday
-            ).count()
-            
-            # Count purchase data
-            order_data = OrderItem.objects.filter(
-                product=product,
-                order__order_date__date=yesterday,
-                order__status='Completed'
-            ).aggregate(
-                units=Sum('quantity'),
-                revenue=Sum(F('product_price') * F('quantity'))
-            )
-            
-            purchase_count = order_data['units'] or 0
-            revenue = order_data['revenue'] or 0
-            
-            # TODO: Add cart additions when cart model is available
-            cart_additions = 0
-            
-            # Create performance record
-            ProductPerformance.objects.create(
-                product=product,
-                date=yesterday,
-                view_count=view_count,
-                cart_additions=cart_additions,
-                purchase_count=purchase_count,
-                revenue=revenue
+        view_counts = (
+            ProductView.objects.filter(view_time__date=yesterday)
+            .order_by().values('product').annotate(count=Count('id')).values_list('product', 'count')
+        )
+        for product_id, view_count in view_counts:
+            # Writes view_count alone, so purchases from pending order events are never counted twice
+            ProductPerformance.objects.update_or_create(
+                product_id=product_id, date=yesterday, defaults={'view_count': view_count}
             )
         
         logger.info(f"Product performance metrics for {yesterday} successfully aggregated.")
         return True
     except Exception as e:
         logger.error(f"Error aggregating product performance: {str(e)}")
-        return False
\ No newline at end of file
+        return False
+
+def apply_order_events(batch_size=500):
+    """
+    Apply one batch of the order event outbox to the daily metrics as deltas
+    
+    Orders count towards order_count on the day they were placed, and their
+    total and items count towards total_sales and product purchases while
+    they are Completed, as in the weekly and monthly aggregations. The
+    events are the only writer of daily sales rows and product purchases.
+    The deltas are applied with single UPDATEs and the events deleted in
+    the same transaction, so each event is applied exactly once. Events
+    locked by a concurrent drain are skipped. Returns the number of events
+    applied.
+    """
+    with transaction.atomic():
+        events = list(
+            OrderEvent.objects.select_for_update(skip_locked=True)
+            .order_by('id')
+            .values_list('id', 'order_id', 'previous_status', 'status', 'order_date', 'total_price')[:batch_size]
+        )
+        if not events:
+            return 0
+        
+        sales = {}  # day -> [orders placed, completed sales]
+        completed = {}  # order id -> (day, net change in completion: -1, 0 or 1)
+        for _, order_id, previous_status, status, order_date, total_price in events:
+            day = timezone.localdate(order_date)
+            day_sales = sales.setdefault(day, [0, Decimal('0')])
+            if not previous_status:
+                day_sales[0] += 1
+            change = int(status == 'Completed') - int(previous_status == 'Completed')
+            if change:
+                day_sales[1] += change * total_price
+                completed[order_id] = (day, completed.get(order_id, (day, 0))[1] + change)
+        
+        for day, (order_count, total_sales) in sales.items():
+            if not order_count and not total_sales:
+                continue
+            SalesMetric.objects.get_or_create(period_type='daily', date=day)
+            SalesMetric.objects.filter(period_type='daily', date=day).update(
+                order_count=F('order_count') + order_count,
+                total_sales=F('total_sales') + total_sales,
+            )
+        
+        purchases = {}  # (product id, day) -> [units, revenue]
+        items = OrderItem.objects.filter(
+            order_id__in=[order_id for order_id, (_, change) in completed.items() if change],
+            product__isnull=False,
+        ).values_list('order_id', 'product_id', 'quantity', 'product_price')
+        for order_id, product_id, quantity, price in items:
+            day, change = completed[order_id]
+            product_purchases = purchases.setdefault((product_id, day), [0, Decimal('0')])
+            product_purchases[0] += change * quantity
+            product_purchases[1] += change * quantity * price
+        
+        for (product_id, day), (units, revenue) in sorted(purchases.items()):
+            ProductPerformance.objects.get_or_create(product_id=product_id, date=day)
+            ProductPerformance.objects.filter(product_id=product_id, date=day).update(
+                purchase_count=F('purchase_count') + units,
+                revenue=F('revenue') + revenue,
+            )
+        
+        OrderEvent.objects.filter(id__in=[event[0] for event in events]).delete()
+    
+    return len(events)
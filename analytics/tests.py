@@ -1,3 +1,132 @@
 from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.utils import timezone
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
 
-# Create your tests here.
+from orders.archive import archive_orders
+from orders.models import Order, OrderEvent, OrderItem
+from orders.state_machine import transition
+from products.models import Category, Product
+from .models import ProductPerformance, ProductView, SalesMetric
+from .services import aggregate_product_performance, aggregate_weekly_sales_metrics, apply_order_events, start_of_day
+
+
+class OrderEventOutboxTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='shopper', password='pass12345', location='Lahore')
+        category = Category.objects.create(name='General')
+        self.product = Product.objects.create(
+            name='Widget', description='Test product', price=Decimal('20.00'), stock=10, category=category
+        )
+
+    def create_order(self, quantity=2):
+        order = Order.objects.create(user=self.user, total_price=Decimal('20.00') * quantity)
+        OrderItem.objects.create(order=order, product=self.product, product_name='Widget',
+                                 product_price=Decimal('20.00'), quantity=quantity)
+        return order
+
+    def events(self):
+        return list(OrderEvent.objects.order_by('id').values_list('order_id', 'previous_status', 'status'))
+
+    def test_saves_write_events(self):
+        order = self.create_order()
+        order.save()
+        order.status = 'Completed'
+        order.save()
+
+        self.assertEqual(self.events(), [(order.id, '', 'Pending'), (order.id, 'Pending', 'Completed')])
+
+    def test_bulk_transitions_write_events(self):
+        first, second = self.create_order(), self.create_order()
+        Order.objects.update(status='Delivered')
+        second.refresh_from_db()
+        second.status = 'Completed'
+        second.save()
+        OrderEvent.objects.all().delete()
+
+        transition(Order.objects.all(), 'Completed')
+
+        self.assertEqual(self.events(), [(first.id, 'Delivered', 'Completed')])
+        self.assertEqual(Order.objects.filter(status='Completed').count(), 2)
+
+    def test_events_applied_as_deltas(self):
+        order = self.create_order(quantity=3)
+        self.create_order(quantity=1)
+        Order.objects.filter(pk=order.pk).update(status='Delivered')
+        transition(Order.objects.filter(pk=order.pk), 'Completed')
+
+        self.assertEqual(apply_order_events(), 3)
+
+        today = timezone.localdate()
+        metric = SalesMetric.objects.get(period_type='daily', date=today)
+        self.assertEqual((metric.order_count, metric.total_sales), (2, Decimal('60.00')))
+        performance = ProductPerformance.objects.get(product=self.product, date=today)
+        self.assertEqual((performance.purchase_count, performance.revenue), (3, Decimal('60.00')))
+        self.assertFalse(OrderEvent.objects.exists())
+
+        # Leaving Completed takes the order back out of the sales
+        order.refresh_from_db()
+        order.status = 'Cancelled'
+        order.save()
+        apply_order_events()
+
+        metric.refresh_from_db()
+        performance.refresh_from_db()
+        self.assertEqual((metric.order_count, metric.total_sales), (2, Decimal('0.00')))
+        self.assertEqual((performance.purchase_count, performance.revenue), (0, Decimal('0.00')))
+
+    def test_view_aggregation_leaves_purchases_to_events(self):
+        yesterday = timezone.now() - timedelta(days=1)
+        order = self.create_order(quantity=3)
+        Order.objects.filter(pk=order.pk).update(status='Delivered', order_date=yesterday)
+        transition(Order.objects.filter(pk=order.pk), 'Completed')
+        OrderEvent.objects.update(order_date=yesterday)
+        for _ in range(2):
+            ProductView.objects.create(product=self.product)
+        ProductView.objects.update(view_time=yesterday)
+
+        # Run while the order's events are still pending
+        self.assertTrue(aggregate_product_performance())
+        apply_order_events()
+
+        performance = ProductPerformance.objects.get(product=self.product, date=yesterday.date())
+        self.assertEqual((performance.view_count, performance.purchase_count), (2, 3))
+        self.assertEqual(performance.revenue, Decimal('60.00'))
+
+    def test_drain_command_applies_in_batches(self):
+        for _ in range(5):
+            self.create_order()
+
+        out = StringIO()
+        call_command('drain_order_events', batch_size=2, stdout=out)
+
+        self.assertIn("Applied 5 order events", out.getvalue())
+        self.assertEqual(SalesMetric.objects.get(period_type='daily').order_count, 5)
+
+
+class SalesMetricTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='shopper', password='pass12345', location='Lahore')
+
+    def create_order(self, status, order_date):
+        order = Order.objects.create(user=self.user, total_price=Decimal('20.00'))
+        Order.objects.filter(pk=order.pk).update(status=status, order_date=order_date)
+        OrderEvent.objects.filter(order=order).delete()
+
+    def test_weekly_metrics_include_archived_orders(self):
+        today = timezone.localdate()
+        last_monday = today - timedelta(days=today.weekday() + 7)
+        noon = start_of_day(last_monday) + timedelta(hours=12)
+        self.create_order('Completed', noon)
+        archive_orders(before=noon + timedelta(hours=1))
+        self.create_order('Completed', noon + timedelta(days=2))
+        self.create_order('Pending', noon + timedelta(days=6))
+        self.create_order('Completed', noon + timedelta(days=7))
+
+        self.assertTrue(aggregate_weekly_sales_metrics())
+        metric = SalesMetric.objects.get(period_type='weekly')
+        self.assertEqual(metric.date, last_monday + timedelta(days=6))
+        self.assertEqual((metric.total_sales, metric.order_count), (Decimal('40.00'), 3))
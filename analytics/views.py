@@ -1,15 +1,17 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.utils import timezone
-from django.db.models import Sum, Count, Avg, F, Q, Min
+from django.db.models import Sum, Count, F, Q, Min
 from django.http import JsonResponse
-from datetime import datetime, timedelta
+from datetime import timedelta
 import json
 
 from .models import SalesMetric, ProductPerformance, PageView, ProductView, SearchQuery
+from .services import start_of_day
 from products.models import Product, Category
 from orders.models import Order, OrderItem
-from fraud_detection.models import FraudDetectionLog, TransactionData
+from fraud_detection.models import FraudDetectionLog
+from fraud_detection.services import daily_counter_totals, flag_reason_breakdown
 
 def is_admin(user):
     """Check if user is staff/admin"""
@@ -22,18 +24,19 @@ def analytics_dashboard(request):
     # Get date range from request parameters or use default (last 30 days)
     days = int(request.GET.get('days', 30))
     date_from = timezone.now().date() - timedelta(days=days)
+    since = start_of_day(date_from)
     
     # Get sales metrics
-    total_revenue = Order.objects.filter(order_date__date__gte=date_from, status='Completed').aggregate(
+    total_revenue = Order.objects.in_range(since).filter(status='Completed').aggregate(
         total=Sum('total_price')
     )['total'] or 0
     
     # Get order metrics
-    order_count = Order.objects.filter(order_date__date__gte=date_from).count()
+    order_count = Order.objects.in_range(since).count()
     avg_order_value = total_revenue / order_count if order_count > 0 else 0
     
     # Get daily sales data for chart
-    daily_sales = Order.objects.filter(order_date__date__gte=date_from).values(
+    daily_sales = Order.objects.in_range(since).values(
         'order_date__date'
     ).annotate(
         revenue=Sum('total_price'),
@@ -46,8 +49,7 @@ def analytics_dashboard(request):
     chart_order_data = [item['count'] for item in daily_sales]
     
     # Get top products by revenue
-    top_products = OrderItem.objects.filter(
-        order__order_date__date__gte=date_from,
+    top_products = OrderItem.objects.in_range(since).filter(
         order__status='Completed'
     ).values(
         'product_name'
@@ -86,10 +88,10 @@ def sales_analysis(request):
     # Get date range from request parameters or use default (last 30 days)
     days = int(request.GET.get('days', 30))
     date_from = timezone.now().date() - timedelta(days=days)
+    since = start_of_day(date_from)
     
     # Get sales by category
-    sales_by_category = OrderItem.objects.filter(
-        order__order_date__date__gte=date_from,
+    sales_by_category = OrderItem.objects.in_range(since).filter(
         order__status='Completed',
         product__isnull=False
     ).values(
@@ -118,8 +120,7 @@ def sales_analysis(request):
     # ).order_by('-revenue')
     
     # Get sales by day of week
-    sales_by_dow = Order.objects.filter(
-        order_date__date__gte=date_from,
+    sales_by_dow = Order.objects.in_range(since).filter(
         status='Completed'
     ).values(
         'order_date__week_day'
@@ -135,9 +136,7 @@ def sales_analysis(request):
         item['day_name'] = dow_names[(item['order_date__week_day'] - 2) % 7]
     
     # Get hourly distribution of orders
-    sales_by_hour = Order.objects.filter(
-        order_date__date__gte=date_from,
-    ).values(
+    sales_by_hour = Order.objects.in_range(since).values(
         'order_date__hour'
     ).annotate(
         revenue=Sum('total_price'),
@@ -184,10 +183,10 @@ def product_analytics(request):
     # Get date range from request parameters or use default (last 30 days)
     days = int(request.GET.get('days', 30))
     date_from = timezone.now().date() - timedelta(days=days)
+    since = start_of_day(date_from)
     
     # Get top selling products
-    top_sellers = OrderItem.objects.filter(
-        order__order_date__date__gte=date_from,
+    top_sellers = OrderItem.objects.in_range(since).filter(
         order__status='Completed'
     ).values(
         'product_name', 
@@ -209,16 +208,15 @@ def product_analytics(request):
     
     # Get conversion rate data (views to purchases)
     product_conversions = []
+    completed_items = OrderItem.objects.in_range(since).filter(order__status='Completed')
     for product in Product.objects.all()[:20]:  # Limit to avoid performance issues
         views = ProductView.objects.filter(
             product=product,
             view_time__date__gte=date_from
         ).count()
         
-        orders = OrderItem.objects.filter(
-            product=product,
-            order__order_date__date__gte=date_from,
-            order__status='Completed'
+        orders = completed_items.filter(
+            product=product
         ).aggregate(total=Sum('quantity'))['total'] or 0
         
         if views > 0:
@@ -263,10 +261,10 @@ def customer_analytics(request):
     # Get date range from request parameters or use default (last 30 days)
     days = int(request.GET.get('days', 30))
     date_from = timezone.now().date() - timedelta(days=days)
+    since = start_of_day(date_from)
     
     # Get top customers by order value
-    top_customers = Order.objects.filter(
-        order_date__date__gte=date_from,
+    top_customers = Order.objects.in_range(since).filter(
         status='Completed'
     ).values(
         'user__username',
@@ -278,9 +276,7 @@ def customer_analytics(request):
     ).order_by('-total_spent')[:10]
     
     # Get customer locations distribution (if location data is available)
-    locations = Order.objects.filter(
-        order_date__date__gte=date_from,
-    ).values(
+    locations = Order.objects.in_range(since).values(
         'user__location'
     ).annotate(
         count=Count('id'),
@@ -289,7 +285,7 @@ def customer_analytics(request):
     
     # Get new vs returning customer split
     # This is a simplified approach, it counts users who made their first order in the selected period
-    all_user_orders = Order.objects.values('user').annotate(
+    all_user_orders = Order.objects.in_range().values('user').annotate(
         first_order_date=Min('order_date'),
         order_count=Count('id')
     )
@@ -302,19 +298,18 @@ def customer_analytics(request):
     
     # Calculate approximate customer lifetime value
     # This is a simplified calculation
-    customer_ltv = Order.objects.filter(
-        status='Completed'
-    ).values(
-        'user'
-    ).annotate(
-        total_spent=Sum('total_price'),
-        order_count=Count('id')
-    ).aggregate(
-        avg_total=Avg('total_spent'),
-        avg_orders=Avg('order_count')
-    )
-    
-    avg_customer_value = customer_ltv.get('avg_total', 0) or 0
+    # Averaged here because per-customer totals may span the live and archive tables
+    customer_totals = [
+        customer['total_spent'] for customer in Order.objects.in_range().filter(
+            status='Completed'
+        ).values(
+            'user'
+        ).annotate(
+            total_spent=Sum('total_price')
+        )
+    ]
+    
+    avg_customer_value = sum(customer_totals) / len(customer_totals) if customer_totals else 0
       # Format location data for JavaScript
     location_names = [loc.get('user__location', 'Unknown') or 'Unknown' for loc in locations]
     location_counts = [loc['count'] for loc in locations]
@@ -342,15 +337,10 @@ def fraud_analytics(request):
     days = int(request.GET.get('days', 30))
     date_from = timezone.now().date() - timedelta(days=days)
     
-    # Get overall fraud metrics
-    total_transactions = TransactionData.objects.filter(
-        transaction_time__date__gte=date_from
-    ).count()
-    
-    flagged_transactions = FraudDetectionLog.objects.filter(
-        detection_time__date__gte=date_from,
-        is_flagged=True
-    ).count()
+    # Get overall fraud metrics from the per-day counters
+    counters = daily_counter_totals(since=date_from)
+    total_transactions = counters['total']
+    flagged_transactions = counters['flagged']
     
     fraud_rate = (flagged_transactions / total_transactions * 100) if total_transactions > 0 else 0
     
@@ -363,25 +353,9 @@ def fraud_analytics(request):
         count=Count('id')
     ).order_by('risk_score')
     
-    # Analyze common fraud flags
-    fraud_flags = []
-    for log in FraudDetectionLog.objects.filter(
-        detection_time__date__gte=date_from,
-        is_flagged=True
-    )[:100]:  # Limit to avoid performance issues
-        if log.flag_reasons and 'reasons' in log.flag_reasons:
-            for reason in log.flag_reasons['reasons']:
-                fraud_flags.append(reason)
-    
-    # Count occurrences of each flag
-    flag_counts = {}
-    for flag in fraud_flags:
-        flag_counts[flag] = flag_counts.get(flag, 0) + 1
-    
-    # Convert to list and sort
-    flag_summary = [{'reason': reason, 'count': count} 
-                   for reason, count in flag_counts.items()]
-    flag_summary.sort(key=lambda x: x['count'], reverse=True)
+    # Exact flag breakdown from one GROUP BY over the indexed flag table
+    since = start_of_day(date_from)
+    flag_summary = flag_reason_breakdown(since=since)
       # Format data for JavaScript
     risk_scores = [item['risk_score'] for item in risk_distribution]
     risk_counts = [item['count'] for item in risk_distribution]
@@ -413,8 +387,9 @@ def api_sales_chart_data(request):
     """API endpoint to get sales chart data"""
     days = int(request.GET.get('days', 30))
     date_from = timezone.now().date() - timedelta(days=days)
+    since = start_of_day(date_from)
     
-    daily_sales = Order.objects.filter(order_date__date__gte=date_from).values(
+    daily_sales = Order.objects.in_range(since).values(
         'order_date__date'
     ).annotate(
         revenue=Sum('total_price'),
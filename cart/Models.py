@@ -1,35 +1,147 @@
+from decimal import Decimal
+
 from django.db import models
+from django.db.models import Count, ExpressionWrapper, F, OuterRef, Prefetch, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.conf import settings
+from django.utils import timezone
 from products.models import Product
 
+
+def refresh_cart_totals(cart_ids):
+    """
+    Recompute the stored item count and total of the given carts (ids or a
+    queryset of ids) from their items, in one UPDATE.
+    """
+    items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    line_total = ExpressionWrapper(F('product__price') * F('quantity'), output_field=Cart._meta.get_field('total'))
+    Cart.objects.filter(pk__in=cart_ids).update(
+        item_count=Coalesce(Subquery(items.annotate(count=Count('id')).values('count')), 0),
+        total=Coalesce(
+            Subquery(items.annotate(total=Sum(line_total)).values('total')),
+            Decimal('0'),
+            output_field=Cart._meta.get_field('total'),
+        ),
+        updated_at=timezone.now(),
+    )
+
+
+class CartQuerySet(models.QuerySet):
+    def with_items(self):
+        """Carts with their items and the items' products, in two queries in all."""
+        return self.prefetch_related(
+            Prefetch('items', queryset=CartItem.objects.select_related('product').order_by('id'))
+        )
+
+
 class Cart(models.Model):
     """Cart model linked to user."""
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='cart')
+    # Read model kept up to date as items change, so listings need not load the items
+    item_count = models.PositiveIntegerField(default=0)
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    
+
+    objects = CartQuerySet.as_manager()
+
     def __str__(self):
         return f"Cart for {self.user.username}"
-    
+
+    def _prefetched_items(self):
+        return getattr(self, '_prefetched_objects_cache', {}).get('items')
+
+    def item_list(self):
+        """The cart's items with their products, reusing them if already prefetched."""
+        items = self._prefetched_items()
+        if items is not None:
+            return list(items)
+        return list(self.items.select_related('product').order_by('id'))
+
+    def clear(self):
+        """Remove every item from the cart."""
+        self.items.all().delete()
+        self.item_count = 0
+        self.total = Decimal('0')
+        self._prefetched_objects_cache = {}
+
     @property
     def total_price(self):
         """Calculate the total price of all items in the cart."""
-        return sum(item.subtotal for item in self.items.all())
-    
+        items = self._prefetched_items()
+        if items is None:
+            return self.total
+        return sum((item.subtotal for item in items), Decimal('0'))
+
     @property
     def total_items(self):
         """Calculate the total number of items in the cart."""
-        return self.items.count()
+        items = self._prefetched_items()
+        if items is None:
+            return self.item_count
+        return len(items)
+
+
+class CartItemQuerySet(models.QuerySet):
+    """Bulk writes to cart items also refresh the totals of the carts they touch."""
+
+    def _cart_ids(self):
+        # Reached through cart.items, the cart is already known
+        instance = self._hints.get('instance')
+        if isinstance(instance, Cart):
+            return [instance.pk]
+        return list(self.values_list('cart_id', flat=True).distinct())
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        refresh_cart_totals({obj.cart_id for obj in objs})
+        return objs
+
+    def update(self, **kwargs):
+        cart_ids = self._cart_ids()
+        rows = super().update(**kwargs)
+        refresh_cart_totals(cart_ids)
+        return rows
+
+    update.alters_data = True
+
+    def delete(self):
+        cart_ids = self._cart_ids()
+        result = super().delete()
+        refresh_cart_totals(cart_ids)
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
 
 class CartItem(models.Model):
     """CartItem model with product and quantity."""
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
-    
+
+    objects = CartItemQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # One line per product, which merges and upserts rely on
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
+
     def __str__(self):
         return f"{self.quantity} x {self.product.name} in {self.cart}"
-    
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        refresh_cart_totals([self.cart_id])
+
+    def delete(self, *args, **kwargs):
+        cart_id = self.cart_id
+        result = super().delete(*args, **kwargs)
+        refresh_cart_totals([cart_id])
+        return result
+
     @property
     def subtotal(self):
         """Calculate the total price for this item."""
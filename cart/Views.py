@@ -1,57 +1,136 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
-from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse
+from django.views.decorators.http import require_POST
+import json
 from products.models import Product
+from .anonymous import AnonymousCart
 from .models import Cart, CartItem
+from .services import LINE_AT_STOCK, LINE_CREATED, add_item, set_quantities
+
+# Visitors who are not logged in keep their cart in the cache (see cart.anonymous)
+# until they log in, so none of these views write to the database for them.
 
-@login_required
 def cart_view(request):
     """View current cart contents."""
-    # Get or create cart for the logged-in user
-    cart, created = Cart.objects.get_or_create(user=request.user)
+    if not request.user.is_authenticated:
+        return render(request, 'cart/cart.html', {'cart': AnonymousCart.load(request)})
+    
+    # Get or create cart for the logged-in user, with its items and their products
+    cart, created = Cart.objects.with_items().get_or_create(user=request.user)
     return render(request, 'cart/cart.html', {'cart': cart})
 
-@login_required
 def add_to_cart(request, product_id):
     """Add a product to the cart."""
     product = get_object_or_404(Product, id=product_id)
-    cart, created = Cart.objects.get_or_create(user=request.user)
     
-    # Check if product is already in cart
-    cart_item, item_created = CartItem.objects.get_or_create(cart=cart, product=product)
+    if not request.user.is_authenticated:
+        cart = AnonymousCart.load(request)
+        previous = cart.lines.get(product.id, 0)
+        quantity = cart.add(product)
+        if not quantity:
+            messages.error(request, f"{product.name} is out of stock.")
+        elif quantity == previous:
+            messages.warning(request, f"Your cart already holds all {product.stock} {product.name} in stock.")
+        else:
+            messages.success(request, f"{product.name} added to your cart.")
+        return cart.save(redirect('cart'))
     
-    if not item_created:
-        # If product already exists in cart, increment quantity
-        cart_item.quantity += 1
-        cart_item.save()
-        messages.success(request, f"Added another {product.name} to your cart.")
-    else:
+    if product.stock < 1:
+        messages.error(request, f"{product.name} is out of stock.")
+        return redirect('cart')
+    
+    cart, created = Cart.objects.get_or_create(user=request.user)
+    
+    # Bump the line in place, or create it if the product is not in the cart yet
+    outcome = add_item(cart, product)
+    if outcome == LINE_CREATED:
         messages.success(request, f"{product.name} added to your cart.")
+    elif outcome == LINE_AT_STOCK:
+        messages.warning(request, f"Your cart already holds all {product.stock} {product.name} in stock.")
+    else:
+        messages.success(request, f"Added another {product.name} to your cart.")
     
     return redirect('cart')
 
-@login_required
 def remove_from_cart(request, item_id):
     """Remove an item from the cart."""
-    cart_item = get_object_or_404(CartItem, id=item_id, cart__user=request.user)
+    if not request.user.is_authenticated:
+        # Anonymous cart lines are addressed by product
+        cart = AnonymousCart.load(request)
+        cart.remove(item_id)
+        messages.success(request, "Item removed from your cart.")
+        return cart.save(redirect('cart'))
+    
+    cart_item = get_object_or_404(CartItem.objects.select_related('product'), id=item_id, cart__user=request.user)
     product_name = cart_item.product.name
     cart_item.delete()
     
     messages.success(request, f"{product_name} removed from your cart.")
     return redirect('cart')
 
-@login_required
 def update_quantity(request, item_id):
     """Update the quantity of an item in the cart."""
-    if request.method == 'POST':
-        cart_item = get_object_or_404(CartItem, id=item_id, cart__user=request.user)
-        quantity = int(request.POST.get('quantity', 1))
-        
-        if quantity > 0 and quantity <= cart_item.product.stock:
+    if request.method != 'POST':
+        return redirect('cart')
+    
+    if request.user.is_authenticated:
+        cart = None
+        cart_item = get_object_or_404(CartItem.objects.select_related('product'), id=item_id, cart__user=request.user)
+    else:
+        cart = AnonymousCart.load(request)
+        cart_item = cart.get_item(item_id)
+        if cart_item is None:
+            return redirect('cart')
+    quantity = int(request.POST.get('quantity', 1))
+    
+    if quantity > 0 and quantity <= cart_item.product.stock:
+        if cart is None:
             cart_item.quantity = quantity
             cart_item.save()
-            messages.success(request, "Cart updated successfully.")
         else:
-            messages.error(request, f"Invalid quantity. Available stock: {cart_item.product.stock}")
+            cart.set_quantity(item_id, quantity)
+        messages.success(request, "Cart updated successfully.")
+    else:
+        messages.error(request, f"Invalid quantity. Available stock: {cart_item.product.stock}")
     
-    return redirect('cart')
+    response = redirect('cart')
+    return cart.save(response) if cart is not None else response
+
+def _parse_quantities(body):
+    """{product id: quantity} from a {"quantities": {"<product id>": <quantity>}} body, or None if malformed"""
+    try:
+        quantities = json.loads(body)['quantities']
+        parsed = {int(product_id): quantity for product_id, quantity in quantities.items()}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    if not all(isinstance(quantity, int) and quantity >= 0 for quantity in parsed.values()):
+        return None
+    return parsed
+
+@require_POST
+def update_cart(request):
+    """
+    Apply many quantity changes in one request, for the cart page's "Save changes".
+    Takes {"quantities": {"<product id>": <quantity>}} as JSON; zero removes the product.
+    Quantities above stock are capped, and the quantities applied are returned.
+    """
+    quantities = _parse_quantities(request.body)
+    if quantities is None:
+        return JsonResponse({'success': False, 'error': 'Expected {"quantities": {"<product id>": <quantity>}}'}, status=400)
+    
+    if request.user.is_authenticated:
+        cart, created = Cart.objects.get_or_create(user=request.user)
+        applied = set_quantities(cart, quantities)
+        cart.refresh_from_db(fields=['item_count', 'total'])
+    else:
+        cart = AnonymousCart.load(request)
+        applied = cart.set_quantities(quantities)
+    
+    response = JsonResponse({
+        'success': True,
+        'applied': {str(product_id): quantity for product_id, quantity in applied.items()},
+        'total_items': cart.total_items,
+        'total_price': str(cart.total_price),
+    })
+    return cart.save(response) if isinstance(cart, AnonymousCart) else response
@@ -8,6 +8,7 @@ class CartItemInline(admin.TabularInline):
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
     list_display = ['user', 'total_price', 'total_items', 'updated_at']
+    readonly_fields = ['item_count', 'total']
     inlines = [CartItemInline]
 
 @admin.register(CartItem)
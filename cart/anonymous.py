@@ -0,0 +1,176 @@
+"""
+Anonymous carts held in the cache
+
+Visitors who are not logged in get a cart keyed by a random token in a
+signed cookie. Its lines are kept in a Django cache as one compact string of
+product id and quantity pairs ("12:1,40:3"), so browsing and filling a cart
+never writes to the database. On login the lines are merged into the user's
+database cart with one bulk upsert (see merge_into_cart).
+
+Configure with the CART setting::
+
+    CART = {
+        'ANONYMOUS_CACHE': 'default',     # locmem or file based caches do for local use
+        'ANONYMOUS_TTL': 7 * 24 * 3600,   # seconds an untouched cart is kept
+    }
+
+Use a cache shared by all workers (Redis or Memcached) in production.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from decimal import Decimal
+import uuid
+
+from products.models import Product
+from .models import Cart, CartItem
+from .services import cap_quantities
+
+COOKIE_NAME = 'cart'
+COOKIE_SALT = 'cart.anonymous'
+DEFAULT_TTL = 7 * 24 * 3600
+
+
+def cart_settings():
+    """The CART setting with defaults filled in"""
+    config = getattr(settings, 'CART', {})
+    return {
+        'cache': config.get('ANONYMOUS_CACHE', 'default'),
+        'ttl': config.get('ANONYMOUS_TTL', DEFAULT_TTL),
+    }
+
+
+def encode_lines(lines):
+    """Serialize {product id: quantity} as "id:quantity" pairs"""
+    return ','.join(f'{product_id}:{quantity}' for product_id, quantity in lines.items())
+
+
+def decode_lines(value):
+    """Parse encode_lines() output, skipping malformed pairs"""
+    lines = {}
+    for pair in (value or '').split(','):
+        product_id, _, quantity = pair.partition(':')
+        if product_id.isdigit() and quantity.isdigit() and int(quantity) > 0:
+            lines[int(product_id)] = int(quantity)
+    return lines
+
+
+class AnonymousCart:
+    """
+    Cart of a visitor who is not logged in.
+
+    Offers the parts of the Cart API the cart page uses. Its items are
+    unsaved CartItem objects whose id is the product id, so the page's
+    update and remove links address lines by product.
+    """
+
+    def __init__(self, token=None, lines=None):
+        self.token = token
+        self.lines = lines or {}
+        self._items = None
+
+    @staticmethod
+    def cache():
+        return caches[cart_settings()['cache']]
+
+    @classmethod
+    def load(cls, request):
+        """The visitor's cart, empty if their cookie is missing or tampered with"""
+        token = request.get_signed_cookie(COOKIE_NAME, default=None, salt=COOKIE_SALT)
+        if token is None:
+            return cls()
+        return cls(token, decode_lines(cls.cache().get(f'cart:anonymous:{token}')))
+
+    def save(self, response):
+        """Store the lines and (re)issue the cookie naming them"""
+        ttl = cart_settings()['ttl']
+        self.token = self.token or uuid.uuid4().hex
+        self.cache().set(f'cart:anonymous:{self.token}', encode_lines(self.lines), ttl)
+        response.set_signed_cookie(COOKIE_NAME, self.token, salt=COOKIE_SALT, max_age=ttl,
+                                   httponly=True, samesite='Lax')
+        return response
+
+    def clear(self):
+        """Forget every line"""
+        if self.token:
+            self.cache().delete(f'cart:anonymous:{self.token}')
+        self.lines = {}
+        self._items = None
+
+    def add(self, product, quantity=1):
+        """Add quantity of product, capped by its stock; returns the new quantity"""
+        self.lines[product.id] = min(self.lines.get(product.id, 0) + quantity, product.stock)
+        if not self.lines[product.id]:
+            del self.lines[product.id]
+        self._items = None
+        return self.lines.get(product.id, 0)
+
+    def set_quantity(self, product_id, quantity):
+        self.lines[product_id] = quantity
+        self._items = None
+
+    def set_quantities(self, quantities):
+        """Set several quantities at once, capped by stock; zero removes a line"""
+        applied = cap_quantities(quantities)
+        for product_id, quantity in applied.items():
+            if quantity:
+                self.lines[product_id] = quantity
+            else:
+                self.lines.pop(product_id, None)
+        self._items = None
+        return applied
+
+    def remove(self, product_id):
+        self.lines.pop(product_id, None)
+        self._items = None
+
+    def item_list(self):
+        """The lines as unsaved cart items, loading their products in one query"""
+        if self._items is None:
+            products = Product.objects.in_bulk(list(self.lines))
+            self._items = [
+                CartItem(id=product_id, product=products[product_id], quantity=quantity)
+                for product_id, quantity in self.lines.items()
+                if product_id in products
+            ]
+        return self._items
+
+    def get_item(self, product_id):
+        return next((item for item in self.item_list() if item.id == product_id), None)
+
+    @property
+    def total_price(self):
+        return sum((item.subtotal for item in self.item_list()), Decimal('0'))
+
+    @property
+    def total_items(self):
+        return len(self.item_list())
+
+
+def merge_into_cart(user, lines):
+    """
+    Merge anonymous cart lines into the user's database cart. Quantities are
+    added to any already in the cart, capped by stock, and written with one
+    bulk upsert. Returns the number of lines written.
+    """
+    with transaction.atomic():
+        stock = dict(Product.objects.filter(id__in=list(lines)).values_list('id', 'stock'))
+        if not stock:
+            return 0
+        cart, _ = Cart.objects.get_or_create(user=user)
+        existing = dict(
+            cart.items.select_for_update().filter(product_id__in=list(stock)).values_list('product_id', 'quantity')
+        )
+
+        merged = []
+        for product_id, available in stock.items():
+            current = existing.get(product_id, 0)
+            # Never take away what the user's own cart already holds
+            quantity = max(current, min(current + lines[product_id], available))
+            if quantity and quantity != current:
+                merged.append(CartItem(cart=cart, product_id=product_id, quantity=quantity))
+        if merged:
+            CartItem.objects.bulk_create(
+                merged, update_conflicts=True, unique_fields=['cart', 'product'], update_fields=['quantity']
+            )
+    return len(merged)
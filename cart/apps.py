@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class CartConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'cart'
+
+    def ready(self):
+        """
+        Connect the signals keeping cart totals current as products change
+        and merging anonymous carts on login
+        """
+        import cart.signals
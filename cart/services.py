@@ -0,0 +1,87 @@
+"""
+Cart writes
+
+Adding a product never reads the cart line first. The line is bumped with
+one guarded UPDATE, capped at the product's current stock::
+
+    UPDATE cart_cartitem SET quantity = LEAST(quantity + <n>, (SELECT stock ...))
+    WHERE cart_id = <cart> AND product_id = <product> AND quantity < (SELECT stock ...)
+
+Only when no line was bumped is one inserted. If the line exists, because
+it already holds all the stock or a concurrent request inserted it first,
+the (cart, product) unique constraint rejects the insert and the UPDATE is
+run again, so two quick clicks always add two.
+
+Batches of quantity changes are applied in one transaction: one query for
+the products' stock, one DELETE for lines set to zero and one bulk upsert
+for the rest.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Least
+
+from products.models import Product
+from .models import CartItem
+
+# Outcomes of add_item
+LINE_CREATED = 'created'
+LINE_BUMPED = 'bumped'
+LINE_AT_STOCK = 'at_stock'
+
+
+def cap_quantities(quantities):
+    """
+    Cap {product id: quantity} at each product's stock in one query.
+    Products that no longer exist are dropped.
+    """
+    stock = dict(Product.objects.filter(pk__in=list(quantities)).values_list('id', 'stock'))
+    return {product_id: min(quantity, stock[product_id]) for product_id, quantity in quantities.items()
+            if product_id in stock}
+
+
+def add_item(cart, product, quantity=1):
+    """
+    Add quantity of product to cart, capped by its stock. Returns
+    LINE_CREATED if a new line was created, LINE_BUMPED if an existing one
+    grew, or LINE_AT_STOCK if it already held all the stock and is unchanged.
+    """
+    stock = Product.objects.filter(pk=OuterRef('product_id')).values('stock')[:1]
+
+    def bump():
+        return cart.items.filter(product=product, quantity__lt=Subquery(stock)).update(
+            quantity=Least(F('quantity') + quantity, Subquery(stock))
+        )
+
+    with transaction.atomic():
+        if bump():
+            return LINE_BUMPED
+        try:
+            with transaction.atomic():
+                CartItem.objects.create(cart=cart, product=product, quantity=min(quantity, product.stock))
+            return LINE_CREATED
+        except IntegrityError:
+            # The line exists: at the stock limit, or inserted by a concurrent request in the meantime
+            return LINE_BUMPED if bump() else LINE_AT_STOCK
+
+
+def set_quantities(cart, quantities):
+    """
+    Set the quantities of several products in cart at once; zero removes a
+    line. Quantities are capped by stock. Returns the quantities applied.
+    """
+    with transaction.atomic():
+        applied = cap_quantities(quantities)
+        removed = [product_id for product_id, quantity in applied.items() if not quantity]
+        if removed:
+            cart.items.filter(product_id__in=removed).delete()
+
+        # In product order, so concurrent batches lock lines in the same order
+        lines = [
+            CartItem(cart=cart, product_id=product_id, quantity=applied[product_id])
+            for product_id in sorted(applied) if applied[product_id]
+        ]
+        if lines:
+            CartItem.objects.bulk_create(
+                lines, update_conflicts=True, unique_fields=['cart', 'product'], update_fields=['quantity']
+            )
+    return applied
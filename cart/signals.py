@@ -0,0 +1,40 @@
+"""
+Signals keeping stored cart totals in step with product changes, and
+merging anonymous carts on login
+"""
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from products.models import Product
+from .anonymous import AnonymousCart, merge_into_cart
+from .models import Cart, refresh_cart_totals
+
+@receiver(post_save, sender=Product)
+def refresh_carts_for_price(sender, instance, created, update_fields=None, **kwargs):
+    """Reprice the carts holding a product whose price may have changed"""
+    if created or (update_fields is not None and 'price' not in update_fields):
+        return
+    refresh_cart_totals(Cart.objects.filter(items__product=instance).values('pk'))
+
+@receiver(pre_delete, sender=Product)
+def remember_carts_for_product(sender, instance, **kwargs):
+    """Note the carts holding a product before its cart items are cascaded away"""
+    instance._cart_ids = list(Cart.objects.filter(items__product=instance).values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Product)
+def refresh_carts_for_product(sender, instance, **kwargs):
+    """Recount the carts that held a deleted product"""
+    cart_ids = getattr(instance, '_cart_ids', None)
+    if cart_ids:
+        refresh_cart_totals(cart_ids)
+
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    """Move what the visitor put in their anonymous cart into their own cart"""
+    if request is None:
+        return
+    anonymous = AnonymousCart.load(request)
+    if anonymous.lines:
+        merge_into_cart(user, anonymous.lines)
+        anonymous.clear()
@@ -1,3 +1,251 @@
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+import json
+
+from products.models import Category, Product
+from .anonymous import decode_lines, encode_lines
+from .models import Cart, CartItem
+from .services import LINE_AT_STOCK, LINE_BUMPED, LINE_CREATED, add_item, set_quantities
+
+
+class CartTotalsTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='shopper', password='pass12345', location='Lahore')
+        self.cart = Cart.objects.create(user=self.user)
+        self.category = Category.objects.create(name='General')
+
+    def create_product(self, name, price):
+        return Product.objects.create(
+            name=name, description='Test product', price=Decimal(price), stock=10, category=self.category
+        )
+
+    def stored(self):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        return cart.item_count, cart.total
+
+    def test_totals_follow_item_changes(self):
+        widget = self.create_product('Widget', '20.00')
+        gadget = self.create_product('Gadget', '7.50')
+
+        item = CartItem.objects.create(cart=self.cart, product=widget, quantity=2)
+        CartItem.objects.bulk_create([CartItem(cart=self.cart, product=gadget, quantity=1)])
+        self.assertEqual(self.stored(), (2, Decimal('47.50')))
+
+        item.quantity = 3
+        item.save()
+        self.assertEqual(self.stored(), (2, Decimal('67.50')))
+
+        self.cart.items.filter(product=gadget).update(quantity=4)
+        self.assertEqual(self.stored(), (2, Decimal('90.00')))
+
+        item.delete()
+        self.assertEqual(self.stored(), (1, Decimal('30.00')))
+
+        self.cart.clear()
+        self.assertEqual(self.stored(), (0, Decimal('0.00')))
+
+    def test_totals_follow_product_changes(self):
+        widget = self.create_product('Widget', '20.00')
+        gadget = self.create_product('Gadget', '5.00')
+        CartItem.objects.create(cart=self.cart, product=widget, quantity=2)
+        CartItem.objects.create(cart=self.cart, product=gadget, quantity=1)
+
+        widget.price = Decimal('25.00')
+        widget.save()
+        self.assertEqual(self.stored(), (2, Decimal('55.00')))
+
+        gadget.delete()
+        self.assertEqual(self.stored(), (1, Decimal('50.00')))
+
+    def test_with_items_reuses_prefetched_items(self):
+        for index in range(5):
+            CartItem.objects.create(cart=self.cart, product=self.create_product(f'Product {index}', '10.00'), quantity=2)
+
+        with self.assertNumQueries(2):
+            cart = Cart.objects.with_items().get(pk=self.cart.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(cart.total_price, Decimal('100.00'))
+            self.assertEqual(cart.total_items, 5)
+            self.assertEqual(len(cart.item_list()), 5)
+            self.assertEqual([item.subtotal for item in cart.items.all()], [Decimal('20.00')] * 5)
+
+    def test_cart_page_queries_do_not_grow_with_items(self):
+        self.client.force_login(self.user)
+        CartItem.objects.create(cart=self.cart, product=self.create_product('First', '10.00'))
+        with self.assertNumQueries(4):
+            self.client.get(reverse('cart'))
+
+        for index in range(5):
+            CartItem.objects.create(cart=self.cart, product=self.create_product(f'Product {index}', '10.00'))
+        # Session, user, then the cart and its items with their products
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('cart'))
+        self.assertContains(response, 'Cart Items (6)')
+
+
+class AnonymousCartTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='General')
+        self.widget = Product.objects.create(
+            name='Widget', description='Test product', price=Decimal('20.00'), stock=5, category=category
+        )
+        self.gadget = Product.objects.create(
+            name='Gadget', description='Test product', price=Decimal('7.50'), stock=2, category=category
+        )
+        self.user = get_user_model().objects.create_user(username='shopper', password='pass12345', location='Lahore')
+
+    def test_lines_round_trip(self):
+        lines = {12: 1, 40: 3}
+        self.assertEqual(encode_lines(lines), '12:1,40:3')
+        self.assertEqual(decode_lines('12:1,40:3,junk,7:0'), lines)
+
+    def test_browsing_cart_does_not_write_to_database(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('add_to_cart', args=[self.widget.id]))
+            self.client.get(reverse('add_to_cart', args=[self.widget.id]))
+            self.client.get(reverse('add_to_cart', args=[self.gadget.id]))
+            self.client.post(reverse('update_quantity', args=[self.gadget.id]), {'quantity': 2})
+            response = self.client.get(reverse('cart'))
+
+        writes = [query['sql'] for query in queries if not query['sql'].lstrip().upper().startswith('SELECT')]
+        self.assertEqual(writes, [])
+        self.assertFalse(Cart.objects.exists())
+        self.assertContains(response, 'Cart Items (2)')
+        self.assertEqual(response.context['cart'].total_price, Decimal('55.00'))
+
+    def test_add_is_capped_by_stock(self):
+        for _ in range(2):
+            self.client.get(reverse('add_to_cart', args=[self.gadget.id]))
+
+        response = self.client.get(reverse('add_to_cart', args=[self.gadget.id]), follow=True)
+        self.assertContains(response, 'Your cart already holds all 2 Gadget in stock.')
+        self.assertEqual(response.context['cart'].lines, {self.gadget.id: 2})
+
+    def test_remove_line(self):
+        self.client.get(reverse('add_to_cart', args=[self.widget.id]))
+        self.client.get(reverse('remove_from_cart', args=[self.widget.id]))
+
+        response = self.client.get(reverse('cart'))
+        self.assertEqual(response.context['cart'].total_items, 0)
+
+    def test_login_merges_into_database_cart(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.widget, quantity=1)
+        self.client.get(reverse('add_to_cart', args=[self.widget.id]))
+        self.client.get(reverse('add_to_cart', args=[self.widget.id]))
+        self.client.get(reverse('add_to_cart', args=[self.gadget.id]))
+
+        self.client.post(reverse('login'), {'username': 'shopper', 'password': 'pass12345'})
+
+        quantities = dict(cart.items.values_list('product_id', 'quantity'))
+        self.assertEqual(quantities, {self.widget.id: 3, self.gadget.id: 1})
+        cart.refresh_from_db()
+        self.assertEqual((cart.item_count, cart.total), (2, Decimal('67.50')))
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('cart')).context['cart'].lines, {})
+
+
+class CartUpdateTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='General')
+        self.widget = Product.objects.create(
+            name='Widget', description='Test product', price=Decimal('20.00'), stock=5, category=category
+        )
+        self.gadget = Product.objects.create(
+            name='Gadget', description='Test product', price=Decimal('7.50'), stock=2, category=category
+        )
+        self.user = get_user_model().objects.create_user(username='shopper', password='pass12345', location='Lahore')
+        self.cart = Cart.objects.create(user=self.user)
+
+    def quantities(self):
+        return dict(self.cart.items.values_list('product_id', 'quantity'))
+
+    def update_cart(self, quantities):
+        return self.client.post(reverse('update_cart'), json.dumps({'quantities': quantities}),
+                                content_type='application/json')
+
+    def test_add_item_upserts_and_caps_at_stock(self):
+        self.assertEqual(add_item(self.cart, self.widget), LINE_CREATED)
+        self.assertEqual(add_item(self.cart, self.widget, quantity=2), LINE_BUMPED)
+        self.assertEqual(self.quantities(), {self.widget.id: 3})
+
+        self.assertEqual(add_item(self.cart, self.widget, quantity=10), LINE_BUMPED)
+        self.assertEqual(self.quantities(), {self.widget.id: 5})
+        self.assertEqual(add_item(self.cart, self.widget), LINE_AT_STOCK)
+        self.assertEqual(self.quantities(), {self.widget.id: 5})
+
+    def test_add_to_cart_reports_stock_limit(self):
+        CartItem.objects.create(cart=self.cart, product=self.gadget, quantity=2)
+        self.client.force_login(self.user)
+
+        response = self.client.get(reverse('add_to_cart', args=[self.gadget.id]), follow=True)
+
+        self.assertContains(response, 'Your cart already holds all 2 Gadget in stock.')
+        self.assertNotContains(response, 'Added another')
+        self.assertEqual(self.quantities(), {self.gadget.id: 2})
+
+    def test_add_to_cart_bumps_without_reading_the_line(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('add_to_cart', args=[self.widget.id]))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('add_to_cart', args=[self.widget.id]))
+
+        line_reads = [query['sql'] for query in queries
+                      if query['sql'].startswith('SELECT') and 'FROM "cart_cartitem"' in query['sql']]
+        self.assertEqual(line_reads, [])
+        self.assertEqual(self.quantities(), {self.widget.id: 2})
+
+    def test_out_of_stock_product_is_not_added(self):
+        Product.objects.filter(pk=self.gadget.pk).update(stock=0)
+        self.client.force_login(self.user)
+
+        self.client.get(reverse('add_to_cart', args=[self.gadget.id]))
+
+        self.assertEqual(self.quantities(), {})
+
+    def test_set_quantities_applies_batch(self):
+        CartItem.objects.create(cart=self.cart, product=self.widget, quantity=1)
+        CartItem.objects.create(cart=self.cart, product=self.gadget, quantity=1)
+
+        applied = set_quantities(self.cart, {self.widget.id: 9, self.gadget.id: 0, 999: 1})
+
+        self.assertEqual(applied, {self.widget.id: 5, self.gadget.id: 0})
+        self.assertEqual(self.quantities(), {self.widget.id: 5})
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.item_count, self.cart.total), (1, Decimal('100.00')))
+
+    def test_update_cart_endpoint(self):
+        CartItem.objects.create(cart=self.cart, product=self.widget, quantity=1)
+        self.client.force_login(self.user)
+
+        response = self.update_cart({str(self.widget.id): 3, str(self.gadget.id): 2})
+
+        self.assertEqual(response.json(), {
+            'success': True,
+            'applied': {str(self.widget.id): 3, str(self.gadget.id): 2},
+            'total_items': 2,
+            'total_price': '75.00',
+        })
+        self.assertEqual(self.quantities(), {self.widget.id: 3, self.gadget.id: 2})
+
+    def test_update_cart_rejects_malformed_body(self):
+        self.client.force_login(self.user)
+
+        self.assertEqual(self.update_cart({str(self.widget.id): -1}).status_code, 400)
+        self.assertEqual(self.update_cart(['not', 'a', 'dict']).status_code, 400)
+        self.assertEqual(self.quantities(), {})
+
+    def test_update_cart_for_anonymous_visitor(self):
+        self.client.get(reverse('add_to_cart', args=[self.widget.id]))
+
+        response = self.update_cart({str(self.widget.id): 4, str(self.gadget.id): 1})
 
-# Create your tests here.
+        self.assertEqual(response.json()['total_price'], '87.50')
+        self.assertEqual(self.client.get(reverse('cart')).context['cart'].lines, {self.widget.id: 4, self.gadget.id: 1})
+        self.assertFalse(CartItem.objects.exists())
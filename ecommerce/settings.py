@@ -30,6 +30,9 @@ SECRET_KEY = os.getenv('SECRET_KEY')
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = os.getenv('DEBUG', 'False') == 'True'
 
+# Set while running the test suite, where per-process caches are good enough
+TESTING = os.getenv('TESTING', 'False') == 'True'
+
 ALLOWED_HOSTS = []
 
 
@@ -49,6 +52,7 @@ INSTALLED_APPS = [
     'cart',
     'orders',
     'fraud_detection',  # Added fraud_detection app
+    'analytics',  # Sales and product metrics, fed by the order event outbox
 ]
 
 MIDDLEWARE = [
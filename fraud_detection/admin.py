@@ -3,7 +3,10 @@ from django.utils import timezone
 from django.urls import reverse
 from django.utils.html import format_html
 import json
-from .models import TransactionData, FraudDetectionLog, FraudConfirmation
+from .models import (
+    TransactionData, FraudDetectionLog, FraudFlag, FraudConfirmation, UserFraudProfile, ExportWatermark, FraudDailyCounter,
+    FraudCluster, FraudClusterMember, ShadowEvaluation,
+)
 
 @admin.register(TransactionData)
 class TransactionDataAdmin(admin.ModelAdmin):
@@ -47,11 +50,23 @@ class FraudDetectionLogAdmin(admin.ModelAdmin):
     
     display_reasons.short_description = 'Flag Reasons'
 
+@admin.register(FraudFlag)
+class FraudFlagAdmin(admin.ModelAdmin):
+    list_display = ['id', 'log', 'code', 'points', 'observed_value', 'detection_time']
+    list_filter = ['code', 'detection_time']
+    raw_id_fields = ['log']
+
+@admin.register(ShadowEvaluation)
+class ShadowEvaluationAdmin(admin.ModelAdmin):
+    list_display = ['id', 'log', 'code', 'fired', 'live_flagged', 'would_flag', 'elapsed_ms', 'over_budget', 'evaluated_at']
+    list_filter = ['code', 'fired', 'would_flag', 'over_budget', 'evaluated_at']
+    raw_id_fields = ['log']
+
 @admin.register(FraudConfirmation)
 class FraudConfirmationAdmin(admin.ModelAdmin):
     list_display = ['id', 'transaction_link', 'is_confirmed', 'confirmation_status', 'created_at']
-    list_filter = ['is_confirmed', 'created_at', 'expiry_time']
-    readonly_fields = ['confirmation_key', 'created_at']
+    list_filter = ['status', 'is_confirmed', 'created_at', 'expiry_time']
+    readonly_fields = ['confirmation_key', 'created_at', 'archived_at']
     actions = ['extend_expiry_time']
     
     def transaction_link(self, obj):
@@ -65,6 +80,8 @@ class FraudConfirmationAdmin(admin.ModelAdmin):
         """Display confirmation status with color coding."""
         if obj.is_confirmed:
             return format_html('<span style="color: green;">Confirmed</span>')
+        elif obj.status == 'expired':
+            return format_html('<span style="color: gray;">Expired (archived)</span>')
         elif obj.is_expired:
             return format_html('<span style="color: red;">Expired</span>')
         else:
@@ -74,10 +91,46 @@ class FraudConfirmationAdmin(admin.ModelAdmin):
     
     def extend_expiry_time(self, request, queryset):
         """Action to extend expiry time by 30 minutes."""
-        for confirmation in queryset:
-            if not confirmation.is_confirmed and confirmation.is_expired:
-                confirmation.expiry_time = timezone.now() + timezone.timedelta(minutes=30)
-                confirmation.save()
-        self.message_user(request, f"Extended expiry time for {queryset.count()} confirmations.")
+        # Holds already swept have had their orders cancelled and cannot be revived
+        now = timezone.now()
+        updated = queryset.filter(status='pending', expiry_time__lt=now).update(
+            expiry_time=now + timezone.timedelta(minutes=30)
+        )
+        self.message_user(request, f"Extended expiry time for {updated} confirmations.")
+    
+    extend_expiry_time.short_description = "Extend expiry time by 30 minutes"
+
+@admin.register(UserFraudProfile)
+class UserFraudProfileAdmin(admin.ModelAdmin):
+    list_display = ['user', 'order_count', 'order_average', 'updated_at']
+    search_fields = ['user__username', 'user__email']
+    readonly_fields = ['order_count', 'total_spent', 'order_average', 'hour_histogram', 'updated_at']
+
+@admin.register(ExportWatermark)
+class ExportWatermarkAdmin(admin.ModelAdmin):
+    list_display = ['name', 'last_transaction_id', 'updated_at']
+    readonly_fields = ['updated_at']
+
+@admin.register(FraudDailyCounter)
+class FraudDailyCounterAdmin(admin.ModelAdmin):
+    list_display = ['day', 'total', 'flagged', 'confirmed', 'expired']
+    date_hierarchy = 'day'
+
+class FraudClusterMemberInline(admin.TabularInline):
+    model = FraudClusterMember
+    raw_id_fields = ['user']
+    extra = 0
+
+@admin.register(FraudCluster)
+class FraudClusterAdmin(admin.ModelAdmin):
+    list_display = ['id', 'size', 'transaction_count', 'flagged_count', 'display_flag_rate', 'updated_at']
+    ordering = ['-size']
+    readonly_fields = ['size', 'transaction_count', 'flagged_count', 'updated_at']
+    inlines = [FraudClusterMemberInline]
+    
+    def display_flag_rate(self, obj):
+        """Share of the cluster's checkouts that were flagged."""
+        rate = obj.flag_rate
+        return '-' if rate is None else f"{rate:.0%}"
     
-    extend_expiry_time.short_description = "Extend expiry time by 30 minutes"
\ No newline at end of file
+    display_flag_rate.short_description = 'Flag Rate'
@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class FraudDetectionConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'fraud_detection'
+
+    def ready(self):
+        """
+        Connect signals and system checks and compile the fraud rule registry at startup
+        """
+        import fraud_detection.checks
+        import fraud_detection.signals
+        from .rules import get_plan
+        get_plan()
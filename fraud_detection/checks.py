@@ -0,0 +1,19 @@
+"""
+System checks for the fraud detection settings
+"""
+from django.core.checks import Tags, Warning, register
+
+from .velocity import velocity_cache_problem
+
+
+@register(Tags.caches)
+def check_velocity_cache(app_configs, **kwargs):
+    """Warn at startup when the velocity counters would use a per-process cache"""
+    problem = velocity_cache_problem()
+    if problem is None:
+        return []
+    return [Warning(
+        f"{problem}. Velocity rules are skipped until this is fixed.",
+        hint="Point FRAUD_DETECTION['VELOCITY_CACHE'] at a cache shared by all workers, such as Redis or Memcached.",
+        id='fraud_detection.W001',
+    )]
@@ -0,0 +1,100 @@
+"""
+Streaming CSV export of transaction data for model training
+"""
+from django.db import transaction as db_transaction
+import csv
+
+from .models import ExportWatermark, TransactionData
+
+EXPORT_HEADER = [
+    'Transaction ID',
+    'User ID',
+    'Order Total',
+    'Location Match',
+    'Is First Purchase',
+    'Account Age (days)',
+    'Transaction Hour',
+    'Address Match',
+    'Risk Score',
+    'Is Flagged',
+    'Was Confirmed',
+    'Timestamp'
+]
+
+DEFAULT_CHUNK_SIZE = 2000
+
+
+class Echo:
+    """File-like object whose write() returns the value, for streaming csv.writer output"""
+
+    def write(self, value):
+        return value
+
+
+def export_queryset(since=None, until=None, after_id=None):
+    """Transactions to export, with everything a row needs joined in"""
+    queryset = TransactionData.objects.select_related('user', 'fraud_log', 'confirmation').order_by('id')
+    if since:
+        queryset = queryset.filter(transaction_time__date__gte=since)
+    if until:
+        queryset = queryset.filter(transaction_time__date__lt=until)
+    if after_id:
+        queryset = queryset.filter(id__gt=after_id)
+    return queryset
+
+
+def export_row(transaction):
+    """CSV row for one transaction loaded by export_queryset"""
+    confirmation = getattr(transaction, 'confirmation', None)
+    fraud_log = getattr(transaction, 'fraud_log', None)
+
+    return [
+        transaction.id,
+        transaction.user_id,
+        transaction.order_total,
+        transaction.confirmed_location == transaction.registration_location,
+        transaction.is_first_purchase,
+        (transaction.transaction_time - transaction.user.date_joined).days,
+        transaction.transaction_time.hour,
+        transaction.shipping_address == transaction.billing_address,
+        fraud_log.risk_score if fraud_log else None,
+        fraud_log.is_flagged if fraud_log else None,
+        confirmation.is_confirmed if confirmation else None,
+        transaction.transaction_time.strftime('%Y-%m-%d %H:%M:%S')
+    ]
+
+
+def stream_csv(queryset, chunk_size=DEFAULT_CHUNK_SIZE, watermark=None):
+    """
+    Yield CSV lines for the queryset, fetching rows in chunks.
+
+    If a watermark name is given, it is advanced to the last exported
+    transaction once the final row has been produced, so an export that is
+    interrupted part-way is repeated in full next time.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_HEADER)
+
+    last_id = None
+    for transaction in queryset.iterator(chunk_size=chunk_size):
+        last_id = transaction.id
+        yield writer.writerow(export_row(transaction))
+
+    if watermark and last_id is not None:
+        advance_watermark(watermark, last_id)
+
+
+def get_watermark(name):
+    """Last transaction ID exported under a watermark name, or 0"""
+    return ExportWatermark.objects.filter(name=name).values_list('last_transaction_id', flat=True).first() or 0
+
+
+def advance_watermark(name, last_id):
+    """Move a watermark forward; never moves it backwards"""
+    with db_transaction.atomic():
+        watermark, created = ExportWatermark.objects.select_for_update().get_or_create(
+            name=name, defaults={'last_transaction_id': last_id}
+        )
+        if not created and last_id > watermark.last_transaction_id:
+            watermark.last_transaction_id = last_id
+            watermark.save()
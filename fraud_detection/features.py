@@ -0,0 +1,137 @@
+"""
+Transaction feature snapshot used by the fraud detection rules
+"""
+from django.utils import timezone
+from django.db.models import Avg, Count
+
+from orders.models import Order
+from .profiles import get_profile
+from .rings import cluster_stats
+from .velocity import DIMENSION_IP, DIMENSION_SHIPPING, DIMENSION_USER, get_velocity_counter
+
+# Lookback of the velocity features, in hours
+VELOCITY_HOURS = 24
+
+
+class TransactionFeatures:
+    """
+    In-memory snapshot of everything the fraud rules need for one checkout.
+
+    Loading costs three queries: one for the cart items with their products
+    (none if the cart was loaded with Cart.objects.with_items()), one
+    primary key read of the user's fraud profile (or an aggregate over the
+    order table if no profile exists yet) and one lookup of the linked
+    account cluster. Recent order counts per user, IP address and shipping
+    address come from the velocity counters. Rules are then evaluated
+    against the snapshot without touching the database.
+    """
+
+    def __init__(self, user, items, confirmed_location, shipping_address, billing_address,
+                 order_count=0, order_average=None, recent_order_count=0, hour_histogram=None,
+                 ip_address=None, ip_order_count=None, shipping_order_count=None,
+                 cluster_size=None, cluster_flag_rate=None, now=None):
+        self.user = user
+        self.items = items
+        self.confirmed_location = confirmed_location
+        self.registration_location = user.location
+        self.shipping_address = shipping_address
+        self.billing_address = billing_address
+        self.ip_address = ip_address
+        self.now = now or timezone.now()
+
+        # Order history
+        self.order_count = order_count
+        self.is_first_purchase = order_count == 0
+        self.user_order_average = order_average or 0
+        self.recent_order_count = recent_order_count
+        self.hour_histogram = hour_histogram
+
+        # Checkouts from the same IP address / to the same shipping address by any user
+        self.ip_order_count = ip_order_count
+        self.shipping_order_count = shipping_order_count
+
+        # Accounts linked by shared addresses, devices or IPs, and how often they were flagged
+        self.cluster_size = cluster_size
+        self.cluster_flag_rate = cluster_flag_rate
+
+        # Derived values
+        self.order_total = sum((item.product.price * item.quantity for item in items), 0)
+        self.account_age = self.now - user.date_joined
+        self.local_hour = timezone.localtime(self.now).hour
+
+    @classmethod
+    def load(cls, user, cart, confirmed_location, shipping_address, billing_address, ip_address=None,
+             link_attributes=None):
+        """Load the snapshot for a user's cart; link_attributes come from rings.link_attributes"""
+        now = timezone.now()
+        items = cart.item_list()
+
+        profile = get_profile(user)
+        if profile is not None:
+            history = {
+                'count': profile.order_count,
+                'average': profile.order_average,
+                'hours': profile.hour_histogram or None,
+            }
+        else:
+            # Profile not built yet, fall back to aggregating the order table
+            history = Order.objects.filter(user=user).aggregate(
+                count=Count('id'),
+                average=Avg('total_price'),
+            )
+            history['hours'] = None
+
+        velocity = get_velocity_counter().checkout_counts(
+            user.pk, ip_address, shipping_address, hours=VELOCITY_HOURS, when=now
+        )
+
+        cluster_size, cluster_flag_rate = cluster_stats(user.pk, link_attributes or {})
+
+        return cls(
+            user=user,
+            items=items,
+            confirmed_location=confirmed_location,
+            shipping_address=shipping_address,
+            billing_address=billing_address,
+            order_count=history['count'],
+            order_average=history['average'],
+            recent_order_count=velocity[DIMENSION_USER],
+            hour_histogram=history['hours'],
+            ip_address=ip_address,
+            ip_order_count=velocity[DIMENSION_IP],
+            shipping_order_count=velocity[DIMENSION_SHIPPING],
+            cluster_size=cluster_size,
+            cluster_flag_rate=cluster_flag_rate,
+            now=now,
+        )
+
+    def high_value_quantity(self, min_price):
+        """Largest quantity of a single product priced above min_price"""
+        quantities = {}
+        for item in self.items:
+            if item.product.price > min_price:
+                quantities[item.product.id] = quantities.get(item.product.id, 0) + item.quantity
+        return max(quantities.values(), default=0)
+
+    @property
+    def hour_order_share(self):
+        """Share of the user's past orders placed at the current local hour"""
+        if not self.hour_histogram or not sum(self.hour_histogram):
+            return None
+        return self.hour_histogram[self.local_hour] / sum(self.hour_histogram)
+
+    def cart_snapshot(self):
+        """JSON representation of the cart for FraudConfirmation"""
+        return {
+            'items': [
+                {
+                    'product_id': item.product.id,
+                    'product_name': item.product.name,
+                    'quantity': item.quantity,
+                    'price': str(item.product.price),
+                    'subtotal': str(item.product.price * item.quantity)
+                }
+                for item in self.items
+            ],
+            'total': str(self.order_total)
+        }
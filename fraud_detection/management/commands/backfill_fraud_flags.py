@@ -0,0 +1,148 @@
+"""
+Backfill FraudFlag rows from the reasons stored in FraudDetectionLog JSON
+"""
+from collections import defaultdict
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+import re
+
+from fraud_detection.datasets import load_transaction_columns
+from fraud_detection.models import FraudDetectionLog, FraudFlag, TransactionData
+from fraud_detection.rules import compile_plan
+
+# Reason text prefixes produced by each rule, with a pattern capturing the observed value
+REASON_PATTERNS = [
+    ('amount_spike', re.compile(r'^Order amount \(\$([\d.]+)\)')),
+    ('location_mismatch', re.compile(r'^Location mismatch')),
+    ('new_account_large_order', re.compile(r'^New account .*large order \(\$([\d.]+)\)')),
+    ('order_frequency', re.compile(r'^High order frequency: (\d+)')),
+    ('ip_velocity', re.compile(r'^High checkout velocity from IP .*: (\d+)')),
+    ('shipping_velocity', re.compile(r'^High checkout velocity to shipping address: (\d+)')),
+    ('fraud_ring', re.compile(r'^Account linked to a cluster of (\d+) accounts')),
+    ('address_mismatch', re.compile(r'^Address mismatch')),
+    ('unusual_hour', re.compile(r'^Unusual order time: (\d+)')),
+    ('bulk_high_value', re.compile(r'^Bulk order of high-value item: (\d+)')),
+]
+
+# Reason texts count the current order, while observed values count prior ones
+INCLUDES_CURRENT_ORDER = {'order_frequency', 'ip_velocity', 'shipping_velocity'}
+
+UNKNOWN_CODE = 'unknown'
+
+
+def parse_reason(reason):
+    """Return (code, observed value) for a stored reason text"""
+    for code, pattern in REASON_PATTERNS:
+        match = pattern.match(reason)
+        if match:
+            observed = float(match.group(1)) if match.groups() else None
+            if observed is not None and code in INCLUDES_CURRENT_ORDER:
+                observed -= 1
+            return code, observed
+    return UNKNOWN_CODE, None
+
+
+class Command(BaseCommand):
+    help = (
+        "Create FraudFlag rows for flagged logs recorded before reason codes were stored, and for "
+        "rules a short-circuited evaluation never reached"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Logs processed per transaction")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        # Points and completed rules come from the current configuration; historical
+        # weights and thresholds were not recorded
+        config = getattr(settings, 'FRAUD_DETECTION', {})
+        plan = compile_plan(config={**config, 'SHORT_CIRCUIT': False})
+        weights = {rule.code: rule.weight for rule in plan.rules}
+
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+            self.stdout.write(self.style.WARNING(
+                "NumPy is not installed, so only stored reasons are backfilled (pip install numpy)"
+            ))
+
+        logs = FraudDetectionLog.objects.filter(is_flagged=True).order_by('id')
+        last_id = 0
+        processed = 0
+        created = 0
+
+        while True:
+            batch = list(
+                logs.filter(id__gt=last_id).values_list('id', 'flag_reasons', 'detection_time')[:batch_size]
+            )
+            if not batch:
+                break
+
+            stored = defaultdict(set)
+            existing = FraudFlag.objects.filter(log_id__in=[row[0] for row in batch]).values_list('log_id', 'code')
+            for log_id, code in existing:
+                stored[log_id].add(code)
+
+            flags = []
+            for log_id, flag_reasons, detection_time in batch:
+                # Logs with flags already had their reasons parsed or written live
+                if log_id in stored:
+                    continue
+                for reason in (flag_reasons or {}).get('reasons', []):
+                    code, observed = parse_reason(reason)
+                    stored[log_id].add(code)
+                    flags.append(FraudFlag(
+                        log_id=log_id,
+                        code=code,
+                        points=weights.get(code, 0),
+                        observed_value=observed,
+                        detection_time=detection_time,
+                    ))
+
+            if np is not None:
+                flags.extend(self.missing_flags(np, plan, batch, stored))
+
+            with transaction.atomic():
+                FraudFlag.objects.bulk_create(flags, batch_size=batch_size)
+
+            last_id = batch[-1][0]
+            processed += len(batch)
+            created += len(flags)
+            self.stdout.write(f"Processed {processed} logs...")
+
+        self.stdout.write(self.style.SUCCESS(f"Created {created} flags for {processed} flagged logs"))
+
+    def missing_flags(self, np, plan, batch, stored):
+        """
+        Flags for rules that fire on the batch's transactions but are not stored,
+        such as those a short-circuited live evaluation stopped before.
+        """
+        detection_times = {log_id: detection_time for log_id, _, detection_time in batch}
+        columns = load_transaction_columns(
+            np, TransactionData.objects.filter(fraud_log__in=list(detection_times)), extra_columns=['fraud_log__id']
+        )
+        _, fired = plan.evaluate_arrays(columns)
+        log_ids = columns['fraud_log__id'].astype(int)
+
+        flags = []
+        for rule in plan.rules:
+            if rule.code not in fired:
+                continue
+            # Rules observing a computed value, rather than a column, store no observed value
+            observed = columns.get(rule.rule.observed) if isinstance(rule.rule.observed, str) else None
+            for index in np.flatnonzero(fired[rule.code]):
+                log_id = int(log_ids[index])
+                if rule.code in stored[log_id]:
+                    continue
+                value = None if observed is None or np.isnan(observed[index]) else float(observed[index])
+                flags.append(FraudFlag(
+                    log_id=log_id,
+                    code=rule.code,
+                    points=rule.weight,
+                    observed_value=value,
+                    detection_time=detection_times[log_id],
+                ))
+        return flags
@@ -0,0 +1,56 @@
+"""
+Rebuild the per-user fraud feature store from order history
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+import heapq
+
+from orders.models import ArchivedOrder, Order
+from fraud_detection.models import UserFraudProfile
+from fraud_detection.profiles import EXCLUDED_STATUS
+
+
+class Command(BaseCommand):
+    help = "Rebuild every UserFraudProfile from the live and archived order tables in a single streaming pass"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of profiles written per INSERT")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        # Live and archived orders merged into one stream sorted by user and date
+        orders = heapq.merge(
+            *(
+                model.objects.order_by('user_id', 'order_date').values_list(
+                    'user_id', 'order_date', 'total_price', 'status'
+                ).iterator(chunk_size=2000)
+                for model in (Order, ArchivedOrder)
+            ),
+            key=lambda order: order[:2],
+        )
+
+        written = 0
+        batch = []
+        profile = None
+
+        with transaction.atomic():
+            UserFraudProfile.objects.all().delete()
+
+            for user_id, order_date, total_price, status in orders:
+                if profile is None or profile.user_id != user_id:
+                    if profile is not None:
+                        batch.append(profile)
+                    if len(batch) >= batch_size:
+                        UserFraudProfile.objects.bulk_create(batch)
+                        written += len(batch)
+                        batch = []
+                    profile = UserFraudProfile(user_id=user_id)
+                profile.add_order(order_date, total_price, counted=status != EXCLUDED_STATUS)
+
+            if profile is not None:
+                batch.append(profile)
+            UserFraudProfile.objects.bulk_create(batch)
+            written += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} fraud profiles."))
@@ -0,0 +1,64 @@
+"""
+Recompute the per-day fraud dashboard counters from the underlying tables
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+from fraud_detection.management.commands.rescore_transactions import parse_date
+from fraud_detection.models import TransactionData, FraudConfirmation, FraudDailyCounter
+
+
+class Command(BaseCommand):
+    help = "Correct drift in FraudDailyCounter by recounting scored transactions, flags and confirmation outcomes per day"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="Only reconcile days on or after this date (YYYY-MM-DD)")
+
+    def handle(self, *args, **options):
+        since = parse_date(options['since']) if options['since'] else None
+
+        sources = [
+            ('total', TransactionData.objects.filter(fraud_log__isnull=False), 'transaction_time'),
+            ('flagged', TransactionData.objects.filter(fraud_log__is_flagged=True), 'transaction_time'),
+            ('confirmed', FraudConfirmation.objects.filter(status='confirmed'), 'created_at'),
+            ('expired', FraudConfirmation.objects.filter(status='expired'), 'created_at'),
+        ]
+
+        # One GROUP BY per counter
+        actual = {}
+        for field, queryset, date_field in sources:
+            if since:
+                queryset = queryset.filter(**{f'{date_field}__date__gte': since})
+            rows = queryset.order_by().annotate(day=TruncDate(date_field)).values('day').annotate(count=Count('id'))
+            for row in rows:
+                actual.setdefault(row['day'], dict.fromkeys(FraudDailyCounter.COUNTER_FIELDS, 0))[field] = row['count']
+
+        with transaction.atomic():
+            existing = FraudDailyCounter.objects.select_for_update()
+            if since:
+                existing = existing.filter(day__gte=since)
+            stored = {counter.day: counter for counter in existing}
+
+            changed = []
+            created = []
+            for day in sorted(set(actual) | set(stored)):
+                counts = actual.get(day, dict.fromkeys(FraudDailyCounter.COUNTER_FIELDS, 0))
+                counter = stored.get(day)
+                if counter is None:
+                    created.append(FraudDailyCounter(day=day, **counts))
+                    continue
+                drift = {field: counts[field] - getattr(counter, field) for field in FraudDailyCounter.COUNTER_FIELDS}
+                if any(drift.values()):
+                    self.stdout.write(f"  {day}: " + ', '.join(f"{field} {delta:+d}" for field, delta in drift.items() if delta))
+                    for field, value in counts.items():
+                        setattr(counter, field, value)
+                    changed.append(counter)
+
+            FraudDailyCounter.objects.bulk_create(created)
+            FraudDailyCounter.objects.bulk_update(changed, FraudDailyCounter.COUNTER_FIELDS)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Reconciled {len(actual)} day(s): {len(created)} created, {len(changed)} corrected"
+        ))
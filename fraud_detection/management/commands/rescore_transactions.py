@@ -0,0 +1,159 @@
+"""
+Re-score historical transactions against candidate rule configurations
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from datetime import datetime
+import json
+import time
+
+from fraud_detection.datasets import load_transaction_columns
+from fraud_detection.models import TransactionData
+from fraud_detection.rules import compile_plan
+
+SCORE_BUCKET_SIZE = 10
+
+
+class Command(BaseCommand):
+    help = (
+        "Evaluate the fraud rule set vectorized over historical TransactionData and report "
+        "flag rate, confirmation rate and score distribution for candidate configurations"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--config', action='append', default=[], metavar='FILE',
+                            help="JSON file with a FRAUD_DETECTION-style candidate configuration (repeatable)")
+        parser.add_argument('--set', action='append', default=[], metavar='RULE.PARAM=VALUE', dest='overrides',
+                            help="Override one rule setting in an ad-hoc candidate, e.g. amount_spike.multiplier=3 "
+                                 "or flag_threshold=50 (repeatable)")
+        parser.add_argument('--since', help="Only re-score transactions on or after this date (YYYY-MM-DD)")
+        parser.add_argument('--until', help="Only re-score transactions before this date (YYYY-MM-DD)")
+        parser.add_argument('--chunk-size', type=int, default=50000,
+                            help="Rows fetched from the database per chunk")
+
+    def handle(self, *args, **options):
+        try:
+            import numpy as np
+        except ImportError:
+            raise CommandError("rescore_transactions requires NumPy (pip install numpy)")
+
+        candidates = self.build_candidates(options)
+
+        started = time.perf_counter()
+        columns = self.load_columns(np, options)
+        loaded = time.perf_counter()
+
+        rows = len(columns['order_total'])
+        self.stdout.write(f"Loaded {rows} transactions in {loaded - started:.2f}s")
+        if not rows:
+            return
+
+        for name, config in candidates:
+            plan = compile_plan(config=config)
+            scores, fired = plan.evaluate_arrays(columns)
+            self.report(np, name, plan, columns, scores, fired)
+
+        self.stdout.write(f"Scored {len(candidates)} configuration(s) in {time.perf_counter() - loaded:.2f}s")
+
+    def build_candidates(self, options):
+        """Return (name, config) pairs, always starting with the live configuration"""
+        current = getattr(settings, 'FRAUD_DETECTION', {})
+        candidates = [('current', current)]
+
+        for path in options['config']:
+            try:
+                with open(path) as handle:
+                    candidate = json.load(handle)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Could not read candidate configuration {path}: {e}")
+            candidates.append((path, merge_config(current, candidate)))
+
+        if options['overrides']:
+            candidate = {'RULES': {}}
+            for override in options['overrides']:
+                key, sep, raw_value = override.partition('=')
+                if not sep:
+                    raise CommandError(f"Invalid --set value '{override}', expected RULE.PARAM=VALUE")
+                try:
+                    value = json.loads(raw_value)
+                except ValueError:
+                    value = raw_value
+
+                if key.lower() == 'flag_threshold':
+                    candidate['FLAG_THRESHOLD'] = value
+                elif '.' in key:
+                    code, param = key.split('.', 1)
+                    candidate['RULES'].setdefault(code, {})[param] = value
+                else:
+                    raise CommandError(f"Invalid --set key '{key}', expected RULE.PARAM or flag_threshold")
+            candidates.append((' '.join(options['overrides']), merge_config(current, candidate)))
+
+        return candidates
+
+    def load_columns(self, np, options):
+        """Stream the selected TransactionData rows into a dict of float arrays"""
+        queryset = TransactionData.objects.all()
+        if options['since']:
+            queryset = queryset.filter(transaction_time__date__gte=parse_date(options['since']))
+        if options['until']:
+            queryset = queryset.filter(transaction_time__date__lt=parse_date(options['until']))
+        return load_transaction_columns(np, queryset, chunk_size=options['chunk_size'])
+
+    def report(self, np, name, plan, columns, scores, fired):
+        """Print flag rate, confirmation rate and score distribution for one candidate"""
+        rows = len(scores)
+        flagged = scores >= plan.flag_threshold
+        flagged_count = int(flagged.sum())
+
+        # Customer confirmation outcomes only exist for transactions flagged live
+        outcomes = columns['was_confirmed']
+        known = flagged & ~np.isnan(outcomes)
+        known_count = int(known.sum())
+        confirmed_count = int((outcomes[known] == 1).sum())
+
+        self.stdout.write('')
+        self.stdout.write(self.style.MIGRATE_HEADING(f"Candidate: {name}"))
+        self.stdout.write(f"  Flag threshold: {plan.flag_threshold}")
+        self.stdout.write(f"  Flagged: {flagged_count} of {rows} ({flagged_count / rows * 100:.1f}%)")
+        if known_count:
+            self.stdout.write(
+                f"  Confirmation rate: {confirmed_count} of {known_count} flagged with an outcome "
+                f"({confirmed_count / known_count * 100:.1f}% confirmed by the customer)"
+            )
+        else:
+            self.stdout.write("  Confirmation rate: no recorded outcomes among flagged transactions")
+
+        p50, p90, p99 = np.percentile(scores, [50, 90, 99])
+        self.stdout.write(f"  Score p50/p90/p99: {p50:.0f} / {p90:.0f} / {p99:.0f}  (max {scores.max():.0f})")
+
+        self.stdout.write("  Score distribution:")
+        buckets = np.bincount((scores // SCORE_BUCKET_SIZE).astype(int))
+        for index, count in enumerate(buckets):
+            if count:
+                low = index * SCORE_BUCKET_SIZE
+                self.stdout.write(f"    {low:>3}-{low + SCORE_BUCKET_SIZE - 1:<3} {int(count):>10} ({count / rows * 100:.1f}%)")
+
+        self.stdout.write("  Rules fired:")
+        for rule in plan.rules:
+            if rule.code in fired:
+                self.stdout.write(f"    {rule.code:<26} {int(fired[rule.code].sum()):>10}")
+            else:
+                self.stdout.write(f"    {rule.code:<26} {'n/a':>10}  (no vectorized form)")
+
+
+def merge_config(base, candidate):
+    """Overlay a candidate FRAUD_DETECTION dict on the live one, rule by rule"""
+    merged = dict(base)
+    merged.update({key: value for key, value in candidate.items() if key != 'RULES'})
+    rules = {code: dict(options) for code, options in base.get('RULES', {}).items()}
+    for code, options in candidate.get('RULES', {}).items():
+        rules.setdefault(code, {}).update(options)
+    merged['RULES'] = rules
+    return merged
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(f"Invalid date '{value}', expected YYYY-MM-DD")
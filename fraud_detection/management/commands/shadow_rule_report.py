@@ -0,0 +1,63 @@
+"""
+Compare live and shadow flag rates from recorded shadow evaluations
+"""
+from django.core.management.base import BaseCommand
+from django.db.models import Avg, Count, Max, Q
+from django.utils import timezone
+from datetime import timedelta
+
+from fraud_detection.models import ShadowEvaluation
+
+
+class Command(BaseCommand):
+    help = (
+        "Report, per shadow rule, how often it fired, the live flag rate against the flag rate "
+        "with the rule adopted, and how often it exceeded its time budget"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help="Report on the last N days of evaluations")
+        parser.add_argument('--rule', help="Only report this shadow rule code")
+
+    def handle(self, *args, **options):
+        evaluations = ShadowEvaluation.objects.filter(
+            evaluated_at__gte=timezone.now() - timedelta(days=options['days'])
+        )
+        if options['rule']:
+            evaluations = evaluations.filter(code=options['rule'])
+
+        rows = evaluations.values('code', 'replaces').annotate(
+            evaluated=Count('id'),
+            fired_count=Count('id', filter=Q(fired=True)),
+            live_flagged_count=Count('id', filter=Q(live_flagged=True)),
+            would_flag_count=Count('id', filter=Q(would_flag=True)),
+            newly_flagged=Count('id', filter=Q(would_flag=True, live_flagged=False)),
+            cleared=Count('id', filter=Q(would_flag=False, live_flagged=True)),
+            over_budget_count=Count('id', filter=Q(over_budget=True)),
+            avg_ms=Avg('elapsed_ms'),
+            max_ms=Max('elapsed_ms'),
+        ).order_by('code')
+
+        if not rows:
+            self.stdout.write(f"No shadow evaluations in the last {options['days']} day(s)")
+            return
+
+        for row in rows:
+            evaluated = row['evaluated']
+            title = f"Shadow rule: {row['code']}"
+            if row['replaces']:
+                title += f" (replacing {row['replaces']})"
+
+            self.stdout.write('')
+            self.stdout.write(self.style.MIGRATE_HEADING(title))
+            self.stdout.write(f"  Evaluated: {evaluated}")
+            self.stdout.write(f"  Fired: {row['fired_count']} ({row['fired_count'] / evaluated * 100:.1f}%)")
+            self.stdout.write(
+                f"  Flag rate: live {row['live_flagged_count'] / evaluated * 100:.1f}%, "
+                f"adopted {row['would_flag_count'] / evaluated * 100:.1f}% "
+                f"({row['newly_flagged']} newly flagged, {row['cleared']} cleared)"
+            )
+            self.stdout.write(
+                f"  Latency: avg {row['avg_ms']:.3f}ms, max {row['max_ms']:.3f}ms, "
+                f"{row['over_budget_count']} over budget"
+            )
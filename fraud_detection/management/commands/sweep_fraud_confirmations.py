@@ -0,0 +1,71 @@
+"""
+Expire lapsed FraudConfirmation holds, cancel their Verification orders
+and return expired stock holds to inventory
+"""
+from django.core.management.base import BaseCommand
+import time
+
+from fraud_detection.models import FraudConfirmation
+from fraud_detection.services import sweep_expired_confirmations
+from orders.inventory import release_expired_holds
+
+
+class Command(BaseCommand):
+    help = (
+        "Expire pending fraud confirmations past their expiry time in bounded batches, "
+        "cancelling the orders they held and returning expired stock holds. "
+        "Safe to run from several processes at once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Confirmations expired per transaction")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep running, sweeping every --interval seconds")
+        parser.add_argument('--interval', type=float, default=60,
+                            help="Seconds between sweeps with --loop")
+        parser.add_argument('--backfill-status', action='store_true',
+                            help="First set the status of confirmations created before the status column existed")
+
+    def handle(self, *args, **options):
+        if options['backfill_status']:
+            self.backfill_status()
+
+        try:
+            while True:
+                self.sweep(options['batch_size'])
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write("Sweeper stopped")
+
+    def sweep(self, batch_size):
+        """Expire batches until the backlog is drained"""
+        expired_total = cancelled_total = 0
+        while True:
+            expired, cancelled = sweep_expired_confirmations(batch_size)
+            expired_total += expired
+            cancelled_total += cancelled
+            if expired < batch_size:
+                break
+
+        # Holds of orders cancelled above are already released; this catches the rest
+        released_total = 0
+        while True:
+            released = release_expired_holds(batch_size)
+            released_total += released
+            if released < batch_size:
+                break
+
+        if expired_total or released_total:
+            self.stdout.write(
+                f"Expired {expired_total} confirmations, cancelled {cancelled_total} orders, "
+                f"released {released_total} expired stock holds"
+            )
+        return expired_total
+
+    def backfill_status(self):
+        confirmed = FraudConfirmation.objects.filter(is_confirmed=True).exclude(status='confirmed').update(status='confirmed')
+        # Holds already expired before the column existed are left to the sweep so their orders are cancelled
+        self.stdout.write(f"Marked {confirmed} confirmations as confirmed")
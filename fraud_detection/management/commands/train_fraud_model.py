@@ -0,0 +1,75 @@
+"""
+Train the in-process fraud risk model from historical transactions
+"""
+from django.core.management.base import BaseCommand, CommandError
+from datetime import datetime
+import time
+
+from fraud_detection.datasets import load_transaction_columns
+from fraud_detection.ml import FEATURE_NAMES, RiskModel, feature_matrix, model_cache, model_settings
+from fraud_detection.models import TransactionData
+
+
+class Command(BaseCommand):
+    help = (
+        "Train the logistic regression fraud risk model on TransactionData and save it where "
+        "checkout workers will pick it up on their next reload check"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help="Model file to write (defaults to FRAUD_DETECTION['ML_MODEL_PATH'])")
+        parser.add_argument('--since', help="Only train on transactions on or after this date (YYYY-MM-DD)")
+        parser.add_argument('--epochs', type=int, default=500)
+        parser.add_argument('--learning-rate', type=float, default=0.5)
+        parser.add_argument('--l2', type=float, default=0.001, help="L2 regularization strength")
+        parser.add_argument('--chunk-size', type=int, default=50000,
+                            help="Rows fetched from the database per chunk")
+
+    def handle(self, *args, **options):
+        try:
+            import numpy as np
+        except ImportError:
+            raise CommandError("train_fraud_model requires NumPy (pip install numpy)")
+
+        queryset = TransactionData.objects.all()
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError(f"Invalid date '{options['since']}', expected YYYY-MM-DD")
+            queryset = queryset.filter(transaction_time__date__gte=since)
+
+        started = time.perf_counter()
+        columns = load_transaction_columns(np, queryset, chunk_size=options['chunk_size'])
+        rows = len(columns['order_total'])
+        if not rows:
+            raise CommandError("No transactions to train on.")
+
+        # A flagged transaction the customer never confirmed is treated as fraud;
+        # confirmed and unflagged transactions are treated as legitimate
+        labels = ((columns['is_flagged'] == 1) & (columns['was_confirmed'] != 1)).astype(float)
+        positives = int(labels.sum())
+        if positives == 0 or positives == rows:
+            raise CommandError("Training data needs both fraudulent and legitimate transactions.")
+
+        matrix = feature_matrix(np, columns)
+        model = RiskModel.fit(
+            np, matrix, labels,
+            epochs=options['epochs'],
+            learning_rate=options['learning_rate'],
+            l2=options['l2'],
+        )
+
+        probabilities = np.clip(model.predict_proba(np, matrix), 1e-9, 1 - 1e-9)
+        log_loss = -np.mean(labels * np.log(probabilities) + (1 - labels) * np.log(1 - probabilities))
+        accuracy = np.mean((probabilities >= 0.5) == (labels == 1))
+
+        output = options['output'] or model_settings()['path']
+        model.save(np, output)
+        model_cache.clear()
+
+        self.stdout.write(f"Trained on {rows} transactions ({positives} fraudulent) in {time.perf_counter() - started:.2f}s")
+        self.stdout.write(f"  Log loss: {log_loss:.4f}  Accuracy: {accuracy * 100:.1f}%")
+        for name, weight in zip(FEATURE_NAMES, model.weights):
+            self.stdout.write(f"  {name:<22} {weight:+.4f}")
+        self.stdout.write(self.style.SUCCESS(f"Saved fraud risk model to {output}"))
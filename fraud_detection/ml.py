@@ -0,0 +1,230 @@
+"""
+In-process logistic regression risk model
+
+The model is trained offline by ``manage.py train_fraud_model`` and saved as
+a single .npy vector. Each worker memory-maps the file, caches the parsed
+model and reloads it when the file's modification time changes. Scoring a
+checkout is a single eight-term dot product in plain Python.
+"""
+from django.conf import settings
+import math
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Header values identifying the serialized model layout
+MODEL_MAGIC = 7310.0
+MODEL_VERSION = 1.0
+
+# Model inputs, in vector order; all derived from export_transaction_data columns
+FEATURE_NAMES = [
+    'log_order_total',
+    'log_amount_ratio',
+    'location_match',
+    'address_match',
+    'is_first_purchase',
+    'log_account_age_days',
+    'hour_sin',
+    'hour_cos',
+]
+
+DEFAULT_RELOAD_CHECK_SECONDS = 1.0
+
+
+def model_settings():
+    """Resolve ML options from the FRAUD_DETECTION setting"""
+    config = getattr(settings, 'FRAUD_DETECTION', {})
+    return {
+        'path': config.get('ML_MODEL_PATH') or os.path.join(settings.BASE_DIR, 'fraud_model.npy'),
+        'blend_weight': float(config.get('ML_BLEND_WEIGHT', 0)),
+        'reload_check_seconds': config.get('ML_RELOAD_CHECK_SECONDS', DEFAULT_RELOAD_CHECK_SECONDS),
+    }
+
+
+def feature_matrix(np, columns):
+    """Build the model input matrix from loaded transaction columns"""
+    order_total = np.maximum(columns['order_total'], 0)
+    average = np.nan_to_num(columns['user_order_average'])
+    ratio = np.divide(order_total, average, out=np.zeros_like(order_total), where=average > 0)
+    age_days = np.maximum(np.nan_to_num(columns['account_age_hours']), 0) / 24
+    hour_angle = 2 * math.pi * np.nan_to_num(columns['local_hour']) / 24
+
+    return np.column_stack([
+        np.log1p(order_total),
+        np.log1p(ratio),
+        columns['location_match'],
+        columns['address_match'],
+        columns['is_first_purchase'],
+        np.log1p(age_days),
+        np.sin(hour_angle),
+        np.cos(hour_angle),
+    ])
+
+
+def snapshot_vector(features):
+    """Model inputs for a live TransactionFeatures snapshot, as a plain list"""
+    order_total = max(float(features.order_total), 0.0)
+    average = float(features.user_order_average or 0)
+    ratio = order_total / average if average > 0 else 0.0
+    age_days = max(features.account_age.total_seconds(), 0) / 86400
+    hour_angle = 2 * math.pi * features.local_hour / 24
+
+    return [
+        math.log1p(order_total),
+        math.log1p(ratio),
+        float(features.confirmed_location == features.registration_location),
+        float(features.shipping_address == features.billing_address),
+        float(features.is_first_purchase),
+        math.log1p(age_days),
+        math.sin(hour_angle),
+        math.cos(hour_angle),
+    ]
+
+
+class RiskModel:
+    """Standardized logistic regression over FEATURE_NAMES"""
+
+    def __init__(self, mean, scale, weights, bias):
+        self.mean = mean
+        self.scale = scale
+        self.weights = weights
+        self.bias = float(bias)
+        # Fold standardization into the weights so scoring is one dot product
+        self._coefficients = [float(w / s) for w, s in zip(weights, scale)]
+        self._intercept = self.bias - sum(float(w * m / s) for w, m, s in zip(weights, mean, scale))
+
+    @classmethod
+    def fit(cls, np, matrix, labels, epochs=500, learning_rate=0.5, l2=0.001):
+        """Train with full-batch gradient descent on standardized inputs"""
+        mean = matrix.mean(axis=0)
+        scale = matrix.std(axis=0)
+        scale[scale == 0] = 1.0
+        standardized = (matrix - mean) / scale
+
+        rows, width = standardized.shape
+        weights = np.zeros(width)
+        bias = 0.0
+        for _ in range(epochs):
+            predictions = 1 / (1 + np.exp(-(standardized @ weights + bias)))
+            error = predictions - labels
+            weights -= learning_rate * (standardized.T @ error / rows + l2 * weights)
+            bias -= learning_rate * error.mean()
+
+        return cls(mean, scale, weights, bias)
+
+    def predict_proba(self, np, matrix):
+        """Fraud probability for each row of an input matrix"""
+        logits = (matrix - self.mean) / self.scale @ self.weights + self.bias
+        return 1 / (1 + np.exp(-logits))
+
+    def score(self, vector):
+        """Fraud probability for a single input vector"""
+        logit = self._intercept + sum(c * x for c, x in zip(self._coefficients, vector))
+        if logit < -30:
+            return 0.0
+        return 1 / (1 + math.exp(-logit))
+
+    def to_array(self, np):
+        width = len(self.weights)
+        return np.concatenate([
+            [MODEL_MAGIC, MODEL_VERSION, width],
+            self.mean, self.scale, self.weights, [self.bias],
+        ]).astype(np.float64)
+
+    @classmethod
+    def from_array(cls, data):
+        if len(data) < 3 or data[0] != MODEL_MAGIC or data[1] != MODEL_VERSION:
+            raise ValueError("Not a fraud risk model file")
+        width = int(data[2])
+        if width != len(FEATURE_NAMES) or len(data) != 3 + 3 * width + 1:
+            raise ValueError("Fraud risk model does not match the current feature set")
+        body = data[3:]
+        return cls(
+            mean=body[:width],
+            scale=body[width:2 * width],
+            weights=body[2 * width:3 * width],
+            bias=body[3 * width],
+        )
+
+    def save(self, np, path):
+        """Write the model atomically so workers never map a partial file"""
+        temporary = f"{path}.tmp"
+        with open(temporary, 'wb') as handle:
+            np.save(handle, self.to_array(np))
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+        return cls.from_array(np.load(path, mmap_mode='r'))
+
+
+class ModelCache:
+    """Per-process model cache keyed on the file's modification time"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._path = None
+        self._mtime = None
+        self._model = None
+        self._checked_at = 0.0
+
+    def get(self, path, reload_check_seconds=DEFAULT_RELOAD_CHECK_SECONDS):
+        """Return the cached model, reloading it if the file changed"""
+        now = time.monotonic()
+        if path == self._path and now - self._checked_at < reload_check_seconds:
+            return self._model
+
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                self._path, self._mtime, self._model = path, None, None
+                return None
+
+            if path != self._path or mtime != self._mtime:
+                try:
+                    self._model = RiskModel.load(path)
+                    logger.info(f"Loaded fraud risk model from {path}")
+                except (ImportError, OSError, ValueError) as e:
+                    logger.error(f"Could not load fraud risk model from {path}: {str(e)}")
+                    self._model = None
+                self._path, self._mtime = path, mtime
+            return self._model
+
+    def clear(self):
+        with self._lock:
+            self._path = self._mtime = self._model = None
+            self._checked_at = 0.0
+
+
+model_cache = ModelCache()
+
+
+def blending_enabled():
+    """Whether a model probability is blended into the risk score"""
+    return model_settings()['blend_weight'] > 0
+
+
+def blended_score(features, rule_score):
+    """
+    Blend the rule score with the model's fraud probability for a snapshot.
+
+    Returns (score, probability); probability is None and the rule score is
+    returned unchanged when blending is disabled or no usable model exists.
+    """
+    options = model_settings()
+    weight = min(max(options['blend_weight'], 0.0), 1.0)
+    if weight == 0:
+        return rule_score, None
+
+    model = model_cache.get(options['path'], options['reload_check_seconds'])
+    if model is None:
+        return rule_score, None
+
+    probability = model.score(snapshot_vector(features))
+    return int(round((1 - weight) * rule_score + weight * probability * 100)), probability
@@ -1,5 +1,8 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
 from django.conf import settings
+from django.utils import timezone
+from decimal import Decimal
 import uuid
 import json
 
@@ -18,6 +21,16 @@ class TransactionData(models.Model):
     is_first_purchase = models.BooleanField(default=False)
     user_order_average = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     
+    # Rule inputs recorded at scoring time so history can be re-scored offline
+    prior_order_count = models.IntegerField(null=True, blank=True)
+    recent_order_count = models.IntegerField(null=True, blank=True, help_text="Orders placed by the user in the current and previous 23 hourly velocity counter buckets, cancelled ones included; empty if the counter was unavailable")
+    high_value_quantity = models.IntegerField(null=True, blank=True, help_text="Largest quantity of a single high-value product in the cart")
+    hour_order_share = models.FloatField(null=True, blank=True, help_text="Share of the user's past orders placed at this hour")
+    ip_order_count = models.IntegerField(null=True, blank=True, help_text="Checkouts from the same IP address in the 24 hours before checkout")
+    shipping_order_count = models.IntegerField(null=True, blank=True, help_text="Checkouts to the same shipping address in the 24 hours before checkout")
+    cluster_size = models.IntegerField(null=True, blank=True, help_text="Accounts linked to the user by shared addresses, devices or IPs, including the user")
+    cluster_flag_rate = models.FloatField(null=True, blank=True, help_text="Share of the linked accounts' checkouts that were flagged")
+    
     def __str__(self):
         return f"Transaction {self.id} by {self.user.username} for ${self.order_total}"
 
@@ -34,25 +47,59 @@ class FraudDetectionLog(models.Model):
     def __str__(self):
         return f"Fraud check for Transaction {self.transaction.id} - {'FLAGGED' if self.is_flagged else 'PASSED'}"
 
-    def add_flag_reason(self, reason):
+    def add_flag_reason(self, reason, save=True):
         """Add a reason why transaction was flagged"""
         reasons = self.flag_reasons.copy() if self.flag_reasons else {}
         if 'reasons' not in reasons:
             reasons['reasons'] = []
         reasons['reasons'].append(reason)
         self.flag_reasons = reasons
-        self.save()
+        if save:
+            self.save()
+
+class FraudFlag(models.Model):
+    """
+    One rule that fired on a flagged transaction, for exact reason breakdowns
+    """
+    log = models.ForeignKey(FraudDetectionLog, on_delete=models.CASCADE, related_name='flags')
+    code = models.CharField(max_length=50, help_text="Code of the rule that fired")
+    points = models.IntegerField(help_text="Points the rule added to the risk score")
+    observed_value = models.FloatField(null=True, blank=True, help_text="Value the rule judged, e.g. the order total")
+    detection_time = models.DateTimeField(help_text="Copied from the log so breakdowns need no join")
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['code', 'detection_time']),
+            models.Index(fields=['detection_time']),
+        ]
+    
+    def __str__(self):
+        return f"{self.code} on log {self.log_id} ({self.points} points)"
 
 class FraudConfirmation(models.Model):
     """
     Store pending transactions requiring user confirmation
     """
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('confirmed', 'Confirmed'),
+        ('expired', 'Expired'),
+    )
+    
     transaction = models.OneToOneField(TransactionData, on_delete=models.CASCADE, related_name='confirmation')
+    order = models.OneToOneField('orders.Order', on_delete=models.SET_NULL, null=True, blank=True, related_name='fraud_confirmation', help_text="Order held until the customer confirms")
     confirmation_key = models.UUIDField(default=uuid.uuid4, editable=False)
     is_confirmed = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     expiry_time = models.DateTimeField()
     cart_snapshot = models.JSONField(default=dict, help_text="JSON representation of cart at time of transaction")
     created_at = models.DateTimeField(auto_now_add=True)
+    archived_at = models.DateTimeField(null=True, blank=True, help_text="When the sweeper expired this hold")
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expiry_time']),
+        ]
     
     def __str__(self):
         return f"Confirmation for Transaction {self.transaction.id} - {'Confirmed' if self.is_confirmed else 'Pending'}"
@@ -62,3 +109,161 @@ class FraudConfirmation(models.Model):
         """Check if the confirmation link has expired"""
         from django.utils import timezone
         return self.expiry_time < timezone.now()
+
+
+class UserFraudProfile(models.Model):
+    """
+    Incrementally maintained order history features for one user
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='fraud_profile')
+    order_count = models.PositiveIntegerField(default=0, help_text="Lifetime orders, excluding cancelled ones")
+    total_spent = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    order_average = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    hour_histogram = models.JSONField(default=list, help_text="Number of orders placed in each local hour of the day")
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"Fraud profile for user {self.user_id} ({self.order_count} orders)"
+    
+    def add_order(self, order_date, total_price, counted=True):
+        """Record a new order; cancelled orders only count towards timing features"""
+        if counted:
+            self._adjust_totals(1, total_price)
+        
+        histogram = list(self.hour_histogram or []) or [0] * 24
+        histogram[timezone.localtime(order_date).hour] += 1
+        self.hour_histogram = histogram
+    
+    def remove_order(self, total_price):
+        """Drop a cancelled order from the lifetime totals"""
+        self._adjust_totals(-1, -total_price)
+    
+    def restore_order(self, total_price):
+        """Count an order again after it leaves the cancelled state"""
+        self._adjust_totals(1, total_price)
+    
+    def _adjust_totals(self, count_delta, amount_delta):
+        self.order_count = max(self.order_count + count_delta, 0)
+        self.total_spent = Decimal(self.total_spent) + Decimal(amount_delta)
+        if self.order_count:
+            self.order_average = (self.total_spent / self.order_count).quantize(Decimal('0.01'))
+        else:
+            self.total_spent = Decimal('0.00')
+            self.order_average = Decimal('0.00')
+
+
+class ShadowEvaluation(models.Model):
+    """
+    Outcome of one shadow rule on a scored transaction; never affects the live flag
+    """
+    log = models.ForeignKey(FraudDetectionLog, on_delete=models.CASCADE, related_name='shadow_evaluations')
+    code = models.CharField(max_length=50, help_text="Code of the shadow rule")
+    replaces = models.CharField(max_length=50, blank=True, help_text="Live rule the candidate would replace if adopted")
+    fired = models.BooleanField(default=False)
+    points = models.IntegerField(default=0, help_text="Points the rule would have added")
+    live_flagged = models.BooleanField(help_text="Copied from the log so reports need no join")
+    would_flag = models.BooleanField(help_text="Whether the transaction would be flagged with the rule adopted")
+    elapsed_ms = models.FloatField()
+    over_budget = models.BooleanField(default=False, help_text="Evaluation took longer than the shadow time budget")
+    evaluated_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['code', 'evaluated_at']),
+        ]
+    
+    def __str__(self):
+        return f"Shadow {self.code} on log {self.log_id} ({'fired' if self.fired else 'passed'})"
+
+
+class ExportWatermark(models.Model):
+    """
+    Last transaction included in an incremental data export
+    """
+    name = models.CharField(max_length=100, unique=True, help_text="Identifies the export consumer")
+    last_transaction_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"Export watermark '{self.name}' at transaction {self.last_transaction_id}"
+
+
+class FraudDailyCounter(models.Model):
+    """
+    Per-day fraud dashboard counts, maintained as events happen
+    
+    Scored transactions and flags are bucketed by transaction day and
+    confirmation outcomes by the day the hold was created.
+    """
+    COUNTER_FIELDS = ('total', 'flagged', 'confirmed', 'expired')
+    
+    day = models.DateField(unique=True)
+    total = models.PositiveIntegerField(default=0)
+    flagged = models.PositiveIntegerField(default=0)
+    confirmed = models.PositiveIntegerField(default=0)
+    expired = models.PositiveIntegerField(default=0)
+    
+    def __str__(self):
+        return f"Fraud counters for {self.day}"
+    
+    @classmethod
+    def increment(cls, day, **deltas):
+        """Atomically add to one day's counters, creating the row if needed"""
+        changes = {field: F(field) + delta for field, delta in deltas.items() if delta}
+        if not changes or cls.objects.filter(day=day).update(**changes):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(day=day, **deltas)
+        except IntegrityError:
+            # Another process created the row first
+            cls.objects.filter(day=day).update(**changes)
+
+
+class FraudCluster(models.Model):
+    """
+    Accounts linked by shared addresses, devices or IP addresses
+    """
+    size = models.PositiveIntegerField(default=0, help_text="Accounts in the cluster")
+    transaction_count = models.PositiveIntegerField(default=0, help_text="Scored checkouts by the cluster's accounts")
+    flagged_count = models.PositiveIntegerField(default=0, help_text="Flagged checkouts by the cluster's accounts")
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"Fraud cluster {self.id} ({self.size} accounts)"
+    
+    @property
+    def flag_rate(self):
+        if not self.transaction_count:
+            return None
+        return self.flagged_count / self.transaction_count
+
+
+class FraudClusterMember(models.Model):
+    """
+    The cluster an account currently belongs to
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='fraud_cluster_membership')
+    cluster = models.ForeignKey(FraudCluster, on_delete=models.CASCADE, related_name='members')
+    
+    def __str__(self):
+        return f"User {self.user_id} in cluster {self.cluster_id}"
+
+
+class FraudLinkAttribute(models.Model):
+    """
+    Hashed address, device fingerprint or IP address seen at checkout, and
+    the cluster of accounts that used it
+    """
+    KIND_CHOICES = (
+        ('address', 'Address'),
+        ('device', 'Device'),
+        ('ip', 'IP address'),
+    )
+    
+    digest = models.CharField(max_length=40, unique=True)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    cluster = models.ForeignKey(FraudCluster, on_delete=models.CASCADE, related_name='attributes')
+    
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.digest[:8]} in cluster {self.cluster_id}"
@@ -0,0 +1,169 @@
+"""
+Background fraud scoring for checkouts
+
+With ``FRAUD_DETECTION['ASYNC_SCORING']`` enabled, checkout creates the
+order in the Scoring state and returns at once. Once the checkout
+transaction commits, the fraud service is handed to a bounded thread pool
+which records the transaction, runs the rules and moves the order to
+Pending or Verification. Clients poll the order status endpoint for the
+outcome.
+
+    FRAUD_DETECTION = {
+        'ASYNC_SCORING': True,
+        'SCORING_WORKERS': 4,       # 0 scores inline after commit
+        'SCORING_QUEUE_SIZE': 100,  # checkouts waiting for a worker
+    }
+
+When the backlog is full the checkout is scored inline, so load degrades to
+the synchronous behaviour instead of queueing without bound.
+"""
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections, transaction
+from django.dispatch import receiver
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import logging
+
+from orders.inventory import InsufficientStock, reserve_stock
+from orders.models import Order
+from orders.state_machine import transition
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCORING_WORKERS = 4
+DEFAULT_SCORING_QUEUE_SIZE = 100
+
+
+def scoring_settings():
+    """Resolve pipeline options from the FRAUD_DETECTION setting"""
+    config = getattr(settings, 'FRAUD_DETECTION', {})
+    return {
+        'async': config.get('ASYNC_SCORING', False),
+        'workers': config.get('SCORING_WORKERS', DEFAULT_SCORING_WORKERS),
+        'queue_size': config.get('SCORING_QUEUE_SIZE', DEFAULT_SCORING_QUEUE_SIZE),
+    }
+
+
+class ScoringPool:
+    """Thread pool that refuses work once its backlog is full"""
+
+    def __init__(self, workers, queue_size):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fraud-scoring')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, fn, *args):
+        """Schedule fn(*args); returns False without scheduling when the pool is saturated"""
+        if not self._slots.acquire(blocking=False):
+            return False
+        try:
+            future = self.executor.submit(fn, *args)
+        except RuntimeError:
+            # Executor shut down (interpreter exiting)
+            self._slots.release()
+            return False
+        future.add_done_callback(lambda f: self._slots.release())
+        return True
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_scoring_pool():
+    """Return the process-wide scoring pool, or None if scoring runs inline"""
+    global _pool
+    options = scoring_settings()
+    if options['workers'] <= 0:
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ScoringPool(options['workers'], options['queue_size'])
+    return _pool
+
+
+@receiver(setting_changed)
+def reset_scoring_pool(sender, setting, **kwargs):
+    """Drop the pool when FRAUD_DETECTION is overridden (e.g. in tests)"""
+    global _pool
+    if setting == 'FRAUD_DETECTION' and _pool is not None:
+        _pool.executor.shutdown(wait=False)
+        _pool = None
+
+
+def score_order(service, order_id):
+    """
+    Score a checkout whose order is in the Scoring state and release it.
+
+    Flagged orders move to Verification with a FraudConfirmation attached
+    and their stock held; clean orders move to Pending with their stock
+    reserved. Either is cancelled if the stock has run out meanwhile. Every
+    move goes through the order state machine, so an order cancelled while
+    it was being scored stays cancelled. On error the order is left in
+    Scoring for staff to review.
+    """
+    try:
+        order = Order.objects.get(pk=order_id, status='Scoring')
+    except Order.DoesNotExist:
+        logger.warning(f"Order {order_id} is no longer awaiting fraud scoring")
+        return None
+
+    scoring = Order.objects.filter(pk=order_id, status='Scoring')
+    try:
+        service.collect_transaction_data()
+        try:
+            if service.run_fraud_detection():
+                released = service.create_fraud_confirmation(order=order) is not None
+            else:
+                with transaction.atomic():
+                    # Lock the order first, so stock is only reserved for one still in Scoring
+                    released = scoring.select_for_update().exists()
+                    if released:
+                        reserve_stock(service.features.items)
+                        transition(scoring, 'Pending')
+        except InsufficientStock as e:
+            logger.info(f"Cancelling order {order_id}: {e}")
+            released = bool(transition(scoring, 'Cancelled'))
+    except Exception:
+        logger.exception(f"Fraud scoring failed for order {order_id}")
+        return None
+
+    if not released:
+        # Moved on (by staff, say) while it was being scored
+        logger.warning(f"Order {order_id} left the Scoring state before it was scored")
+        return None
+    order.refresh_from_db(fields=['status'])
+    return order.status
+
+
+def _run_in_worker(fn, *args):
+    # Worker threads own their connections; drop stale ones around each job
+    close_old_connections()
+    try:
+        fn(*args)
+    finally:
+        close_old_connections()
+
+
+def run_in_background(fn, *args, inline_when_full=True):
+    """
+    Run fn(*args) on the scoring pool, or inline when the pool is disabled.
+
+    When the pool is saturated the work runs inline, or is dropped if
+    inline_when_full is False. Returns False only if the work was dropped.
+    """
+    pool = get_scoring_pool()
+    if pool is not None and pool.submit(_run_in_worker, fn, *args):
+        return True
+    if pool is not None:
+        if not inline_when_full:
+            return False
+        logger.warning(f"Fraud scoring backlog full, running {fn.__name__} inline")
+    fn(*args)
+    return True
+
+
+def submit_scoring(service, order_id):
+    """Score on the pool, or inline when the pool is disabled or saturated"""
+    run_in_background(score_order, service, order_id)
@@ -0,0 +1,65 @@
+"""
+Maintenance of the per-user fraud feature store
+"""
+from django.db import transaction
+from django.utils import timezone
+import logging
+
+from .models import UserFraudProfile
+
+logger = logging.getLogger(__name__)
+
+# Orders in this status do not count towards lifetime totals
+EXCLUDED_STATUS = 'Cancelled'
+
+
+def get_profile(user):
+    """Read a user's fraud profile by primary key, or None if it has not been built"""
+    return UserFraudProfile.objects.filter(pk=user.pk).first()
+
+
+def record_order(order):
+    """Add a newly created order to its user's profile"""
+    with transaction.atomic(savepoint=False):
+        profile, created = UserFraudProfile.objects.select_for_update().get_or_create(user_id=order.user_id)
+        profile.add_order(order.order_date, order.total_price, counted=order.status != EXCLUDED_STATUS)
+        profile.save()
+
+
+def record_status_change(order, previous_status):
+    """Adjust lifetime totals when an order enters or leaves the cancelled state"""
+    was_excluded = previous_status == EXCLUDED_STATUS
+    is_excluded = order.status == EXCLUDED_STATUS
+    if was_excluded == is_excluded:
+        return
+
+    with transaction.atomic(savepoint=False):
+        profile, created = UserFraudProfile.objects.select_for_update().get_or_create(user_id=order.user_id)
+        if is_excluded:
+            profile.remove_order(order.total_price)
+        else:
+            profile.restore_order(order.total_price)
+        profile.save()
+
+
+def record_bulk_cancellation(orders):
+    """
+    Remove orders cancelled by a bulk UPDATE from their users' lifetime totals.
+
+    Takes (user_id, total_price) pairs for orders that were counted before
+    the update; profiles are locked and saved once per user.
+    """
+    totals = {}
+    for user_id, total_price in orders:
+        totals.setdefault(user_id, []).append(total_price)
+    if not totals:
+        return
+
+    with transaction.atomic(savepoint=False):
+        profiles = list(UserFraudProfile.objects.select_for_update().filter(user_id__in=totals))
+        now = timezone.now()
+        for profile in profiles:
+            for total_price in totals[profile.user_id]:
+                profile.remove_order(total_price)
+            profile.updated_at = now
+        UserFraudProfile.objects.bulk_update(profiles, ['order_count', 'total_spent', 'order_average', 'updated_at'])
@@ -0,0 +1,212 @@
+"""
+Linking index of accounts that share addresses, devices or IP addresses
+
+Every scored checkout contributes hashed link attributes: the normalized
+shipping and billing addresses, the IP address and a device fingerprint
+(user agent plus network prefix). Accounts sharing any attribute belong to
+the same FraudCluster, so a ring of accounts that each look harmless on
+their own shows up as one cluster with a high flag rate.
+
+Clusters are kept as a union-find with union by size: membership and
+attribute rows point straight at their cluster, and when a checkout links
+two clusters the smaller one is relabelled into the larger. Each row is
+relabelled at most log2(n) times over the index's lifetime, and finding a
+user's cluster is a single indexed read. The rebuild_fraud_clusters command
+recomputes the index from history with an in-memory DisjointSet.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+import hashlib
+import ipaddress
+import logging
+
+from .models import FraudCluster, FraudClusterMember, FraudLinkAttribute
+from .velocity import normalize_address
+
+logger = logging.getLogger(__name__)
+
+KIND_ADDRESS = 'address'
+KIND_DEVICE = 'device'
+KIND_IP = 'ip'
+
+# Attempts at linking before giving up on a checkout racing concurrent merges
+LINK_ATTEMPTS = 3
+
+
+class DisjointSet:
+    """Union-find over hashable items with union by size and path halving"""
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def add(self, item):
+        if item not in self.parent:
+            self.parent[item] = item
+            self.size[item] = 1
+
+    def find(self, item):
+        """Representative of the item's set, adding the item if it is new"""
+        self.add(item)
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        """Merge the sets holding a and b and return the new representative"""
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return root_a
+        if self.size[root_a] < self.size[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.size[root_a] += self.size[root_b]
+        return root_a
+
+    def groups(self):
+        """Map each representative to the items in its set"""
+        groups = {}
+        for item in self.parent:
+            groups.setdefault(self.find(item), []).append(item)
+        return groups
+
+
+def _digest(kind, value):
+    return hashlib.sha1(f'{kind}:{value}'.encode('utf-8')).hexdigest()
+
+
+def _network(ip):
+    """The /24 (IPv4) or /64 (IPv6) network of an address, or None if unparseable"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    prefix = 24 if address.version == 4 else 64
+    return str(ipaddress.ip_network(f'{address}/{prefix}', strict=False))
+
+
+def link_attributes(shipping_address, billing_address, device_info):
+    """
+    Hashed link attributes of one checkout as a dict of digest to kind.
+
+    The device fingerprint combines the user agent with the network prefix,
+    so one browser is followed across addresses handed out by the same ISP
+    without linking everyone who runs a common browser.
+    """
+    attributes = {}
+    for address in (shipping_address, billing_address):
+        if address and address.strip():
+            attributes[_digest(KIND_ADDRESS, normalize_address(address))] = KIND_ADDRESS
+
+    device_info = device_info or {}
+    ip = device_info.get('ip_address')
+    if ip:
+        attributes[_digest(KIND_IP, ip)] = KIND_IP
+        network = _network(ip)
+        user_agent = device_info.get('user_agent')
+        if network and user_agent:
+            attributes[_digest(KIND_DEVICE, f'{user_agent}|{network}')] = KIND_DEVICE
+    return attributes
+
+
+def cluster_stats(user_id, attributes):
+    """
+    Size and flag rate of the cluster this checkout belongs to, in one query.
+
+    The clusters holding the user or any of the checkout's attributes are
+    the ones linking would merge, so their combined size counts the user
+    even before the checkout is linked. Returns (size, flag rate), with a
+    rate of None when the cluster has no scored checkouts yet.
+    """
+    members = FraudClusterMember.objects.filter(user_id=user_id)
+    matches = Q(id__in=members.values('cluster_id'))
+    if attributes:
+        matches |= Q(id__in=FraudLinkAttribute.objects.filter(digest__in=list(attributes)).values('cluster_id'))
+
+    rows = FraudCluster.objects.filter(matches).annotate(
+        has_user=Exists(members.filter(cluster_id=OuterRef('pk')))
+    ).values_list('size', 'transaction_count', 'flagged_count', 'has_user')
+
+    size = transactions = flagged = 0
+    is_member = False
+    for cluster_size, transaction_count, flagged_count, has_user in rows:
+        size += cluster_size
+        transactions += transaction_count
+        flagged += flagged_count
+        is_member = is_member or has_user
+
+    if not is_member:
+        size += 1
+    return size, (flagged / transactions if transactions else None)
+
+
+class _LinkConflict(Exception):
+    """A concurrent merge changed the clusters being linked"""
+
+
+def link_checkout(user_id, attributes, is_flagged):
+    """
+    Add one scored checkout to the index, merging every cluster it touches
+    into the largest one.
+    """
+    for _ in range(LINK_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                _link(user_id, attributes, is_flagged)
+            return
+        except (_LinkConflict, IntegrityError):
+            continue
+    logger.warning(f"Could not link checkout of user {user_id} after {LINK_ATTEMPTS} attempts")
+
+
+def _link(user_id, attributes, is_flagged):
+    known = dict(
+        FraudLinkAttribute.objects.filter(digest__in=list(attributes)).values_list('digest', 'cluster_id')
+    )
+    own_cluster = FraudClusterMember.objects.filter(user_id=user_id).values_list('cluster_id', flat=True).first()
+    cluster_ids = set(known.values())
+    if own_cluster is not None:
+        cluster_ids.add(own_cluster)
+
+    # Lock in id order so concurrent merges of overlapping clusters cannot deadlock
+    clusters = list(FraudCluster.objects.select_for_update().filter(id__in=cluster_ids).order_by('id'))
+    if len(clusters) < len(cluster_ids):
+        raise _LinkConflict()
+
+    if clusters:
+        root = max(clusters, key=lambda cluster: (cluster.size, -cluster.id))
+        merged = [cluster for cluster in clusters if cluster.id != root.id]
+    else:
+        root = FraudCluster.objects.create()
+        merged = []
+
+    if merged:
+        merged_ids = [cluster.id for cluster in merged]
+        FraudClusterMember.objects.filter(cluster_id__in=merged_ids).update(cluster=root)
+        FraudLinkAttribute.objects.filter(cluster_id__in=merged_ids).update(cluster=root)
+        FraudCluster.objects.filter(id__in=merged_ids).delete()
+
+    size = sum(cluster.size for cluster in merged)
+    if own_cluster is None:
+        FraudClusterMember.objects.create(user_id=user_id, cluster=root)
+        size += 1
+
+    new_digests = [digest for digest in attributes if digest not in known]
+    if new_digests:
+        FraudLinkAttribute.objects.bulk_create(
+            [FraudLinkAttribute(digest=digest, kind=attributes[digest], cluster=root) for digest in new_digests],
+            ignore_conflicts=True,
+        )
+        # A concurrent checkout may have claimed one of them for another cluster
+        if FraudLinkAttribute.objects.filter(digest__in=new_digests).exclude(cluster=root).exists():
+            raise _LinkConflict()
+
+    FraudCluster.objects.filter(id=root.id).update(
+        size=F('size') + size,
+        transaction_count=F('transaction_count') + sum(cluster.transaction_count for cluster in merged) + 1,
+        flagged_count=F('flagged_count') + sum(cluster.flagged_count for cluster in merged) + int(is_flagged),
+        updated_at=timezone.now(),
+    )
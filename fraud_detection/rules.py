@@ -0,0 +1,602 @@
+"""
+Declarative fraud rule registry and compiled evaluation plan
+
+Each rule declares the features it reads, its weight and its thresholds.
+Weights and thresholds can be overridden from settings, e.g.::
+
+    FRAUD_DETECTION = {
+        'FLAG_THRESHOLD': 40,
+        'RULES': {
+            'amount_spike': {'weight': 30, 'multiplier': 3},
+            'unusual_hour': {'enabled': False},
+        },
+    }
+
+The registry is compiled once at startup into an EvaluationPlan that orders
+rules by weight, skips rules whose inputs are missing and stops as soon as
+the flag threshold has been reached.
+
+Rules registered with ``shadow=True``, and variants of live rules listed
+under ``SHADOW_RULES``, are left out of the live plan and trialled by
+fraud_detection.shadow instead::
+
+    FRAUD_DETECTION = {
+        'SHADOW_RULES': {
+            'amount_spike_strict': {'rule': 'amount_spike', 'multiplier': 1.5},
+        },
+    }
+"""
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from datetime import timedelta
+from decimal import Decimal
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLAG_THRESHOLD = 40
+
+# Registered rules in declaration order
+RULES = []
+
+
+class Rule:
+    """A single fraud rule with its inputs, weight and default thresholds"""
+
+    def __init__(self, code, check, features, weight, thresholds=None, description='', observed=None,
+                 shadow=False):
+        self.code = code
+        self.check = check
+        self.features = tuple(features)
+        self.weight = weight
+        self.thresholds = dict(thresholds or {})
+        self.description = description
+        self.observed = observed
+        self.shadow = shadow
+        self.vectorized = None
+
+    def __repr__(self):
+        return f"<Rule {self.code} ({self.weight} points)>"
+
+    def observe(self, snapshot, thresholds):
+        """Numeric value the rule judged, recorded with each flag"""
+        if self.observed is None:
+            return None
+        if callable(self.observed):
+            value = self.observed(snapshot, thresholds)
+        else:
+            value = getattr(snapshot, self.observed, None)
+        return float(value) if value is not None else None
+
+
+def register_rule(code, features, weight, thresholds=None, observed=None, shadow=False):
+    """
+    Decorator registering a rule check.
+
+    The check receives the feature snapshot and the resolved thresholds and
+    returns a reason string when the rule fires, or None otherwise.
+    ``observed`` names the feature (or is a callable taking the snapshot and
+    thresholds) whose value is stored with the flag. Shadow rules are only
+    evaluated in shadow mode until promoted with ``{'shadow': False}``.
+    """
+    def decorator(check):
+        RULES.append(Rule(
+            code=code,
+            check=check,
+            features=features,
+            weight=weight,
+            thresholds=thresholds,
+            description=(check.__doc__ or '').strip(),
+            observed=observed,
+            shadow=shadow,
+        ))
+        return check
+    return decorator
+
+
+def rule_label(code):
+    """Human readable name of a rule code"""
+    for rule in RULES:
+        if rule.code == code:
+            return rule.description or code
+    return code
+
+
+class VectorizedCheck:
+    """Array form of a rule used for offline re-scoring"""
+
+    def __init__(self, check, inputs):
+        self.check = check
+        self.inputs = tuple(inputs)
+
+
+def vectorized_rule(code, inputs):
+    """
+    Decorator attaching an array implementation to a registered rule.
+
+    The check receives a dict of NumPy float arrays (booleans as 0/1, missing
+    values as NaN) and the resolved thresholds, and returns a boolean array.
+    Only array operators are used, so NumPy is not needed on the checkout path.
+    """
+    def decorator(check):
+        for rule in RULES:
+            if rule.code == code:
+                rule.vectorized = VectorizedCheck(check, inputs)
+                return check
+        raise LookupError(f"No fraud rule registered with code '{code}'")
+    return decorator
+
+
+class CompiledRule:
+    """A rule bound to its effective weight and thresholds"""
+
+    def __init__(self, rule, weight, thresholds, code=None, replaces=None):
+        self.rule = rule
+        self.code = code or rule.code
+        # Live rule a shadow variant would replace if adopted
+        self.replaces = replaces
+        self.features = rule.features
+        self.weight = weight
+        self.thresholds = thresholds
+
+    def has_inputs(self, snapshot):
+        """Check whether every feature the rule reads is available"""
+        return all(getattr(snapshot, name, None) is not None for name in self.features)
+
+
+class RuleHit:
+    """A rule that fired during evaluation"""
+
+    def __init__(self, code, points, reason, observed=None):
+        self.code = code
+        self.points = points
+        self.reason = reason
+        self.observed = observed
+
+
+class EvaluationResult:
+    """Outcome of running an EvaluationPlan against one feature snapshot"""
+
+    def __init__(self, flag_threshold):
+        self.flag_threshold = flag_threshold
+        self.score = 0
+        self.hits = []
+        self.skipped = []
+        self.timings = {}
+        self.short_circuited = False
+
+    @property
+    def is_flagged(self):
+        return self.score >= self.flag_threshold
+
+    @property
+    def reasons(self):
+        return [hit.reason for hit in self.hits]
+
+    def timings_ms(self):
+        """Per-rule evaluation time in milliseconds"""
+        return {code: round(seconds * 1000, 3) for code, seconds in self.timings.items()}
+
+
+class EvaluationPlan:
+    """
+    Ordered, pre-resolved list of rules.
+
+    Rules are evaluated heaviest first so the flag threshold is reached with
+    as few checks as possible. Per-rule timings are accumulated in-process.
+    """
+
+    def __init__(self, rules, flag_threshold=DEFAULT_FLAG_THRESHOLD, short_circuit=True):
+        self.rules = sorted(rules, key=lambda rule: -rule.weight)
+        self.flag_threshold = flag_threshold
+        self.short_circuit = short_circuit
+        self._stats = {rule.code: [0, 0.0, 0.0] for rule in self.rules}
+        self._stats_lock = threading.Lock()
+
+    def evaluate(self, snapshot, short_circuit=None, record_timings=True):
+        """
+        Evaluate every applicable rule against a feature snapshot. Pass
+        short_circuit=False to get the full rule score regardless of the
+        plan's setting, and record_timings=False to keep an off-path
+        evaluation out of the per-rule timing report.
+        """
+        if short_circuit is None:
+            short_circuit = self.short_circuit
+        result = EvaluationResult(self.flag_threshold)
+        self._evaluate_rules(result, snapshot, self.rules, short_circuit, record_timings)
+        return result
+
+    def complete(self, result, snapshot):
+        """
+        Evaluate the rules a short-circuited result stopped before, so that
+        its hits, reasons and score cover every rule that fires. Returns the
+        result.
+        """
+        if result.short_circuited:
+            evaluated = set(result.timings) | set(result.skipped)
+            result.short_circuited = False
+            remaining = [rule for rule in self.rules if rule.code not in evaluated]
+            self._evaluate_rules(result, snapshot, remaining, False, True)
+        return result
+
+    def _evaluate_rules(self, result, snapshot, rules, short_circuit, record_timings):
+        for rule in rules:
+            if short_circuit and result.is_flagged:
+                result.short_circuited = True
+                break
+
+            if not rule.has_inputs(snapshot):
+                result.skipped.append(rule.code)
+                continue
+
+            started = time.perf_counter()
+            reason = rule.rule.check(snapshot, rule.thresholds)
+            elapsed = time.perf_counter() - started
+
+            result.timings[rule.code] = elapsed
+            if record_timings:
+                self._record_timing(rule.code, elapsed)
+
+            if reason:
+                result.hits.append(RuleHit(rule.code, rule.weight, reason, rule.rule.observe(snapshot, rule.thresholds)))
+                result.score += rule.weight
+
+    def threshold(self, code, name, default=None):
+        """Effective threshold of a compiled rule, or default if the rule is disabled"""
+        for rule in self.rules:
+            if rule.code == code:
+                return rule.thresholds.get(name, default)
+        return default
+
+    def evaluate_arrays(self, columns):
+        """
+        Score many transactions at once from a dict of equal-length float arrays.
+
+        Missing values are NaN; a rule is skipped for rows where any of its
+        inputs is NaN. Scores are full rule sums, as live flagged checkouts are
+        completed and unflagged ones never reach the short-circuit.
+        Returns (scores, fired) where fired maps rule code to a boolean array.
+        """
+        import numpy as np
+
+        scores = np.zeros(len(columns['order_total']))
+        fired = {}
+
+        for rule in self.rules:
+            vectorized = rule.rule.vectorized
+            if vectorized is None:
+                continue
+
+            hits = vectorized.check(columns, rule.thresholds)
+            for name in vectorized.inputs:
+                hits = hits & (columns[name] == columns[name])  # NaN never equals itself
+
+            scores = scores + hits * rule.weight
+            fired[rule.code] = hits
+
+        return scores, fired
+
+    def _record_timing(self, code, elapsed):
+        with self._stats_lock:
+            stats = self._stats[code]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    def timing_report(self):
+        """Aggregate evaluation time per rule since startup, slowest first"""
+        with self._stats_lock:
+            report = [
+                {
+                    'code': code,
+                    'calls': calls,
+                    'total_ms': round(total * 1000, 3),
+                    'avg_ms': round(total * 1000 / calls, 3) if calls else 0,
+                    'max_ms': round(slowest * 1000, 3),
+                }
+                for code, (calls, total, slowest) in self._stats.items()
+            ]
+        report.sort(key=lambda row: row['total_ms'], reverse=True)
+        return report
+
+
+def compile_plan(rules=None, config=None):
+    """Resolve settings overrides against the registry and build a plan"""
+    if config is None:
+        config = getattr(settings, 'FRAUD_DETECTION', {})
+    overrides = config.get('RULES', {})
+
+    compiled = []
+    for rule in (RULES if rules is None else rules):
+        options = dict(overrides.get(rule.code, {}))
+        if not options.pop('enabled', True) or options.pop('shadow', rule.shadow):
+            continue
+        weight = options.pop('weight', rule.weight)
+        thresholds = dict(rule.thresholds)
+        thresholds.update(options)
+        compiled.append(CompiledRule(rule, weight, thresholds))
+
+    return EvaluationPlan(
+        compiled,
+        flag_threshold=config.get('FLAG_THRESHOLD', DEFAULT_FLAG_THRESHOLD),
+        short_circuit=config.get('SHORT_CIRCUIT', True),
+    )
+
+
+def compile_shadow_rules(rules=None, config=None):
+    """
+    Resolve the shadow rules: registered shadow rules (or live rules moved
+    to shadow with ``{'shadow': True}``) plus the SHADOW_RULES variants of
+    registered rules
+    """
+    if config is None:
+        config = getattr(settings, 'FRAUD_DETECTION', {})
+    overrides = config.get('RULES', {})
+    registry = RULES if rules is None else rules
+
+    compiled = []
+    for rule in registry:
+        options = dict(overrides.get(rule.code, {}))
+        if not options.pop('enabled', True) or not options.pop('shadow', rule.shadow):
+            continue
+        weight = options.pop('weight', rule.weight)
+        thresholds = dict(rule.thresholds)
+        thresholds.update(options)
+        compiled.append(CompiledRule(rule, weight, thresholds))
+
+    by_code = {rule.code: rule for rule in registry}
+    for code, options in config.get('SHADOW_RULES', {}).items():
+        options = dict(options)
+        base = by_code.get(options.pop('rule', code))
+        if base is None:
+            logger.warning(f"Shadow rule '{code}' refers to an unknown rule, ignoring it")
+            continue
+        # Variants start from the live configuration of the rule they would replace
+        live = dict(overrides.get(base.code, {}))
+        live.pop('enabled', None)
+        live.pop('shadow', None)
+        weight = options.pop('weight', live.pop('weight', base.weight))
+        thresholds = dict(base.thresholds)
+        thresholds.update(live)
+        thresholds.update(options)
+        compiled.append(CompiledRule(base, weight, thresholds, code=code, replaces=base.code))
+
+    return compiled
+
+
+_plan = None
+
+
+def get_plan():
+    """Return the evaluation plan compiled at startup"""
+    global _plan
+    if _plan is None:
+        _plan = compile_plan()
+    return _plan
+
+
+@receiver(setting_changed)
+def reset_plan(sender, setting, **kwargs):
+    """Recompile when FRAUD_DETECTION is overridden (e.g. in tests)"""
+    global _plan
+    if setting == 'FRAUD_DETECTION':
+        _plan = None
+
+
+# Rule 1: Flag if order amount is 200% higher than user's average order
+@register_rule(
+    'amount_spike',
+    features=['order_total', 'user_order_average', 'is_first_purchase'],
+    weight=25,
+    thresholds={'multiplier': 2},
+    observed='order_total',
+)
+def amount_spike(f, t):
+    """Order amount far above the user's average order"""
+    if not f.is_first_purchase and f.user_order_average > 0:
+        # Thresholds from settings may be floats, which Decimal refuses to multiply
+        if f.order_total > (f.user_order_average * Decimal(str(t['multiplier']))):
+            return f"Order amount (${f.order_total}) is significantly higher than user's average (${f.user_order_average})"
+
+
+@vectorized_rule('amount_spike', inputs=['order_total', 'user_order_average', 'is_first_purchase'])
+def amount_spike_array(c, t):
+    return (c['is_first_purchase'] == 0) & (c['user_order_average'] > 0) & (
+        c['order_total'] > c['user_order_average'] * t['multiplier']
+    )
+
+
+# Rule 2: Flag if user confirms a different location during checkout than registration
+@register_rule(
+    'location_mismatch',
+    features=['confirmed_location', 'registration_location'],
+    weight=20,
+)
+def location_mismatch(f, t):
+    """Checkout location differs from registration location"""
+    if f.confirmed_location != f.registration_location:
+        return f"Location mismatch: Checkout location '{f.confirmed_location}' differs from registration location '{f.registration_location}'"
+
+
+@vectorized_rule('location_mismatch', inputs=['location_match'])
+def location_mismatch_array(c, t):
+    return c['location_match'] == 0
+
+
+# Rule 3: Flag if account is less than 48 hours old and order exceeds $150
+@register_rule(
+    'new_account_large_order',
+    features=['account_age', 'order_total'],
+    weight=30,
+    thresholds={'max_age_hours': 48, 'min_total': 150},
+    observed='order_total',
+)
+def new_account_large_order(f, t):
+    """Young account placing a large order"""
+    account_age = f.account_age
+    if account_age < timedelta(hours=t['max_age_hours']) and f.order_total > t['min_total']:
+        return f"New account (age: {account_age.days} days, {int(account_age.seconds/3600)} hours) with large order (${f.order_total})"
+
+
+@vectorized_rule('new_account_large_order', inputs=['account_age_hours', 'order_total'])
+def new_account_large_order_array(c, t):
+    return (c['account_age_hours'] < t['max_age_hours']) & (c['order_total'] > t['min_total'])
+
+
+# Rule 4: Flag if user has placed 4+ orders in last 24 hours
+@register_rule(
+    'order_frequency',
+    features=['recent_order_count'],
+    weight=20,
+    thresholds={'min_previous_orders': 3},
+    observed='recent_order_count',
+)
+def order_frequency(f, t):
+    """Many orders by the same user within 24 hours"""
+    if f.recent_order_count >= t['min_previous_orders']:
+        return f"High order frequency: {f.recent_order_count + 1} orders in the last 24 hours"
+
+
+@vectorized_rule('order_frequency', inputs=['recent_order_count'])
+def order_frequency_array(c, t):
+    return c['recent_order_count'] >= t['min_previous_orders']
+
+
+# Rule 4b: Flag if many checkouts come from the same IP address within 24 hours
+@register_rule(
+    'ip_velocity',
+    features=['ip_order_count'],
+    weight=15,
+    thresholds={'min_previous_orders': 10},
+    observed='ip_order_count',
+)
+def ip_velocity(f, t):
+    """Many checkouts from the same IP address within 24 hours"""
+    if f.ip_order_count >= t['min_previous_orders']:
+        return f"High checkout velocity from IP {f.ip_address}: {f.ip_order_count + 1} checkouts in the last 24 hours"
+
+
+@vectorized_rule('ip_velocity', inputs=['ip_order_count'])
+def ip_velocity_array(c, t):
+    return c['ip_order_count'] >= t['min_previous_orders']
+
+
+# Rule 4c: Flag if many checkouts ship to the same address within 24 hours
+@register_rule(
+    'shipping_velocity',
+    features=['shipping_order_count'],
+    weight=15,
+    thresholds={'min_previous_orders': 5},
+    observed='shipping_order_count',
+)
+def shipping_velocity(f, t):
+    """Many checkouts shipping to the same address within 24 hours"""
+    if f.shipping_order_count >= t['min_previous_orders']:
+        return f"High checkout velocity to shipping address: {f.shipping_order_count + 1} checkouts in the last 24 hours"
+
+
+@vectorized_rule('shipping_velocity', inputs=['shipping_order_count'])
+def shipping_velocity_array(c, t):
+    return c['shipping_order_count'] >= t['min_previous_orders']
+
+
+# Rule 4d: Flag if the account is linked to a ring of accounts that are often flagged
+@register_rule(
+    'fraud_ring',
+    features=['cluster_size', 'cluster_flag_rate'],
+    weight=25,
+    thresholds={'min_accounts': 3, 'min_flag_rate': 0.3},
+    observed='cluster_size',
+)
+def fraud_ring(f, t):
+    """Account linked to often-flagged accounts by shared addresses, devices or IPs"""
+    if f.cluster_size >= t['min_accounts'] and f.cluster_flag_rate >= t['min_flag_rate']:
+        return f"Account linked to a cluster of {f.cluster_size} accounts with {f.cluster_flag_rate:.0%} of checkouts flagged"
+
+
+@vectorized_rule('fraud_ring', inputs=['cluster_size', 'cluster_flag_rate'])
+def fraud_ring_array(c, t):
+    return (c['cluster_size'] >= t['min_accounts']) & (c['cluster_flag_rate'] >= t['min_flag_rate'])
+
+
+# Rule 5: Flag if shipping/billing addresses differ and order exceeds $200
+@register_rule(
+    'address_mismatch',
+    features=['shipping_address', 'billing_address', 'order_total'],
+    weight=15,
+    thresholds={'min_total': 200},
+    observed='order_total',
+)
+def address_mismatch(f, t):
+    """Shipping and billing addresses differ on a large order"""
+    if f.shipping_address != f.billing_address and f.order_total > t['min_total']:
+        return f"Address mismatch with order exceeding ${t['min_total']}"
+
+
+@vectorized_rule('address_mismatch', inputs=['address_match', 'order_total'])
+def address_mismatch_array(c, t):
+    return (c['address_match'] == 0) & (c['order_total'] > t['min_total'])
+
+
+# Rule 6: Flag if checkout occurs between 1am-5am local time and differs from user's usual patterns
+@register_rule(
+    'unusual_hour',
+    features=['local_hour'],
+    weight=10,
+    thresholds={'start_hour': 1, 'end_hour': 5, 'min_history': 5, 'usual_share': 0.2},
+    observed='local_hour',
+)
+def unusual_hour(f, t):
+    """Checkout in the small hours when the user rarely orders then"""
+    if not t['start_hour'] <= f.local_hour <= t['end_hour']:
+        return None
+
+    # With enough history, an hour the user regularly orders at is not unusual
+    share = getattr(f, 'hour_order_share', None)
+    if share is not None and getattr(f, 'order_count', 0) >= t['min_history'] and share >= t['usual_share']:
+        return None
+
+    return f"Unusual order time: {f.local_hour}:00 (unusual for this user)"
+
+
+@vectorized_rule('unusual_hour', inputs=['local_hour'])
+def unusual_hour_array(c, t):
+    in_window = (c['local_hour'] >= t['start_hour']) & (c['local_hour'] <= t['end_hour'])
+    # NaN history compares False, so rows without it count as unusual like the live rule
+    usual = (c['prior_order_count'] >= t['min_history']) & (c['hour_order_share'] >= t['usual_share'])
+    return in_window & ~usual
+
+
+# Rule 7: Flag if order contains 5+ of the same high-value item
+@register_rule(
+    'bulk_high_value',
+    features=['items'],
+    weight=25,
+    thresholds={'min_price': 50, 'min_quantity': 5},
+    observed=lambda f, t: f.high_value_quantity(t['min_price']),
+)
+def bulk_high_value(f, t):
+    """Bulk quantity of a single high-value product"""
+    high_value_items = {}
+    for item in f.items:
+        if item.product.price > t['min_price']:
+            if item.product.id in high_value_items:
+                high_value_items[item.product.id]['quantity'] += item.quantity
+            else:
+                high_value_items[item.product.id] = {
+                    'name': item.product.name,
+                    'quantity': item.quantity
+                }
+
+    for data in high_value_items.values():
+        if data['quantity'] >= t['min_quantity']:
+            return f"Bulk order of high-value item: {data['quantity']} x {data['name']}"
+
+
+@vectorized_rule('bulk_high_value', inputs=['high_value_quantity'])
+def bulk_high_value_array(c, t):
+    # Quantities were recorded with the live min_price, so only min_quantity can be tuned offline
+    return c['high_value_quantity'] >= t['min_quantity']
@@ -1,42 +1,137 @@
+from django.conf import settings
 from django.utils import timezone
-from django.db.models import Avg, Count
-import json
 from datetime import timedelta
-from .models import TransactionData, FraudDetectionLog, FraudConfirmation
+from .features import TransactionFeatures
+from .pipeline import run_in_background
+from .rings import link_attributes, link_checkout
+from .rules import get_plan, rule_label
+from .shadow import submit_shadow
+from .ml import blended_score, blending_enabled
+from .velocity import DIMENSION_IP, DIMENSION_SHIPPING, get_velocity_counter, normalize_address
+from .models import TransactionData, FraudDetectionLog, FraudConfirmation, FraudFlag, FraudDailyCounter
+from orders.inventory import hold_stock
+from orders.state_machine import transition
 from orders.models import Order, OrderItem
 from django.db import transaction
+from django.db.models import Count, Sum
 import logging
 
 logger = logging.getLogger(__name__)
 
+def request_device_info(request):
+    """
+    Client IP address and user agent from request headers.
+    
+    The IP address is REMOTE_ADDR unless FRAUD_DETECTION['TRUSTED_PROXY_COUNT']
+    says how many reverse proxies of our own append to X-Forwarded-For; the
+    client is then the hop the outermost of them saw. Hops further left are
+    supplied by the client and never trusted.
+    """
+    if request is None:
+        return {'user_agent': '', 'ip_address': None}
+    
+    ip = request.META.get('REMOTE_ADDR')
+    proxy_count = getattr(settings, 'FRAUD_DETECTION', {}).get('TRUSTED_PROXY_COUNT', 0)
+    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    if proxy_count and x_forwarded_for:
+        hops = [hop.strip() for hop in x_forwarded_for.split(',') if hop.strip()]
+        if len(hops) >= proxy_count:
+            ip = hops[-proxy_count]
+    
+    return {
+        'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+        'ip_address': ip,
+    }
+
+def flag_reason_breakdown(since=None, until=None):
+    """
+    Count flags per rule code over an optional detection time range, most
+    frequent first, as dicts with code, reason (a readable label) and count
+    """
+    flags = FraudFlag.objects.all()
+    if since:
+        flags = flags.filter(detection_time__gte=since)
+    if until:
+        flags = flags.filter(detection_time__lt=until)
+    
+    rows = flags.values('code').annotate(count=Count('id')).order_by('-count', 'code')
+    return [{'code': row['code'], 'reason': rule_label(row['code']), 'count': row['count']} for row in rows]
+
+def daily_counter_totals(since=None, until=None):
+    """
+    Sum the per-day dashboard counters over an optional date range, reading
+    one row per day instead of counting the underlying tables
+    """
+    counters = FraudDailyCounter.objects.all()
+    if since:
+        counters = counters.filter(day__gte=since)
+    if until:
+        counters = counters.filter(day__lt=until)
+    
+    totals = counters.aggregate(**{field: Sum(field) for field in FraudDailyCounter.COUNTER_FIELDS})
+    return {field: value or 0 for field, value in totals.items()}
+
+def sweep_expired_confirmations(batch_size=500, now=None):
+    """
+    Expire one batch of lapsed confirmation holds and cancel their orders.
+    
+    Rows locked by a concurrent sweeper are skipped, so several sweepers can
+    run at once. Returns (confirmations expired, orders cancelled).
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        batch = list(
+            FraudConfirmation.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', is_confirmed=False, expiry_time__lt=now)
+            .order_by('expiry_time')
+            .values_list('id', 'order_id', 'cart_snapshot__order_id', 'created_at')[:batch_size]
+        )
+        if not batch:
+            return 0, 0
+        
+        # Older holds only reference their order through the cart snapshot
+        order_ids = {order_id or snapshot_order_id for _, order_id, snapshot_order_id, _ in batch} - {None}
+        FraudConfirmation.objects.filter(id__in=[row[0] for row in batch]).update(status='expired', archived_at=now)
+        
+        # Bulk UPDATE skips post_save, so adjust the dashboard counters per creation day
+        expired_per_day = {}
+        for created_at in (row[3] for row in batch):
+            day = timezone.localdate(created_at)
+            expired_per_day[day] = expired_per_day.get(day, 0) + 1
+        for day, count in expired_per_day.items():
+            FraudDailyCounter.increment(day, expired=count)
+        
+        # One batched transition: outbox events, held stock and fraud profiles included
+        cancelled = transition(Order.objects.filter(id__in=order_ids, status='Verification'), 'Cancelled', now=now)
+    
+    return len(batch), len(cancelled)
+
 class FraudDetectionService:
     """Service class for fraud detection operations"""
     
-    def __init__(self, user, cart, confirmed_location, shipping_address, billing_address):
-        """Initialize with transaction data"""
+    def __init__(self, user, cart, confirmed_location, shipping_address, billing_address, request=None):
+        """Initialize with transaction data; request supplies the client's IP and user agent"""
         self.user = user
         self.cart = cart
         self.confirmed_location = confirmed_location
         self.shipping_address = shipping_address
         self.billing_address = billing_address
-        self.order_total = cart.total_price
+        self.device_info = request_device_info(request)
+        self.link_attributes = link_attributes(shipping_address, billing_address, self.device_info)
+        
+        # Load everything the rules need up front so they run without further queries
+        self.features = TransactionFeatures.load(
+            user, cart, confirmed_location, shipping_address, billing_address,
+            ip_address=self.device_info['ip_address'],
+            link_attributes=self.link_attributes
+        )
+        self.order_total = self.features.order_total
         self.transaction_data = None
         self.fraud_log = None
     
     def collect_transaction_data(self):
         """Collect and store all transaction data"""
-        # Calculate user's previous order average
-        user_orders = Order.objects.filter(user=self.user)
-        order_average = user_orders.aggregate(avg=Avg('total_price'))['avg'] or 0.00
-        
-        # Check if this is user's first purchase
-        is_first_purchase = user_orders.count() == 0
-        
-        # Get user's device info (in a real system, this would be collected from request headers)
-        device_info = {
-            'user_agent': 'Demo User Agent',
-            'ip_address': '127.0.0.1',
-        }
+        features = self.features
         
         # Create transaction data
         self.transaction_data = TransactionData.objects.create(
@@ -44,15 +139,32 @@ class FraudDetectionService:
             order_total=self.order_total,
             confirmed_location=self.confirmed_location,
             registration_location=self.user.location,
-            device_info=device_info,
+            device_info=self.device_info,
             shipping_address=self.shipping_address,
             billing_address=self.billing_address,
-            is_first_purchase=is_first_purchase,
-            user_order_average=order_average
+            is_first_purchase=features.is_first_purchase,
+            user_order_average=features.user_order_average,
+            prior_order_count=features.order_count,
+            recent_order_count=features.recent_order_count,
+            high_value_quantity=features.high_value_quantity(
+                get_plan().threshold('bulk_high_value', 'min_price', 50)
+            ),
+            hour_order_share=features.hour_order_share,
+            ip_order_count=features.ip_order_count,
+            shipping_order_count=features.shipping_order_count,
+            cluster_size=features.cluster_size,
+            cluster_flag_rate=features.cluster_flag_rate
         )
         
-        # Create fraud log
-        self.fraud_log = FraudDetectionLog.objects.create(
+        # Count this checkout against its IP and shipping address; the user's
+        # own counter is advanced when the order is saved
+        velocity = get_velocity_counter()
+        velocity.record(DIMENSION_IP, features.ip_address, features.now)
+        if self.shipping_address:
+            velocity.record(DIMENSION_SHIPPING, normalize_address(self.shipping_address), features.now)
+        
+        # Fraud log is built in memory and saved once the rules have run
+        self.fraud_log = FraudDetectionLog(
             transaction=self.transaction_data,
             is_flagged=False,
             risk_score=0
@@ -62,141 +174,117 @@ class FraudDetectionService:
     
     def run_fraud_detection(self):
         """Run all fraud detection rules and return whether the transaction is flagged"""
-        risk_score = 0
+        # Blending needs the full rule score, not a partial sum that stopped at the threshold
+        plan = get_plan()
+        result = plan.evaluate(self.features, short_circuit=False if blending_enabled() else None)
         
-        # Rule 1: Flag if order amount is 200% higher than user's average order
-        if not self.transaction_data.is_first_purchase and self.transaction_data.user_order_average > 0:
-            if self.order_total > (self.transaction_data.user_order_average * 2):
-                self.fraud_log.add_flag_reason(
-                    f"Order amount (${self.order_total}) is significantly higher than user's average (${self.transaction_data.user_order_average})"
-                )
-                risk_score += 25
-        
-        # Rule 2: Flag if user confirms a different location during checkout than registration
-        if self.transaction_data.confirmed_location != self.transaction_data.registration_location:
-            self.fraud_log.add_flag_reason(
-                f"Location mismatch: Checkout location '{self.transaction_data.confirmed_location}' differs from registration location '{self.transaction_data.registration_location}'"
-            )
-            risk_score += 20
+        # A flagged checkout is reviewed by hand, so record every rule it fires
+        if result.is_flagged:
+            plan.complete(result, self.features)
         
-        # Rule 3: Flag if account is less than 48 hours old and order exceeds $150
-        account_age = timezone.now() - self.user.date_joined
-        if account_age < timedelta(hours=48) and self.order_total > 150:
-            self.fraud_log.add_flag_reason(
-                f"New account (age: {account_age.days} days, {int(account_age.seconds/3600)} hours) with large order (${self.order_total})"
-            )
-            risk_score += 30
+        for reason in result.reasons:
+            self.fraud_log.add_flag_reason(reason, save=False)
         
-        # Rule 4: Flag if user has placed 4+ orders in last 24 hours
-        recent_order_count = Order.objects.filter(
-            user=self.user,
-            order_date__gte=timezone.now() - timedelta(hours=24)
-        ).count()
+        # Keep per-rule latency next to the reasons so slow rules are visible
+        self.fraud_log.flag_reasons['timings_ms'] = result.timings_ms()
         
-        if recent_order_count >= 3:  # 3 previous orders + current = 4
-            self.fraud_log.add_flag_reason(
-                f"High order frequency: {recent_order_count + 1} orders in the last 24 hours"
-            )
-            risk_score += 20
+        # Blend in the ML model's probability when a model is configured
+        risk_score, probability = blended_score(self.features, result.score)
+        if probability is not None:
+            self.fraud_log.flag_reasons['ml_probability'] = round(probability, 4)
+            self.fraud_log.flag_reasons['rule_score'] = result.score
         
-        # Rule 5: Flag if shipping/billing addresses differ and order exceeds $200
-        if self.shipping_address != self.billing_address and self.order_total > 200:
-            self.fraud_log.add_flag_reason(
-                f"Address mismatch with order exceeding $200"
-            )
-            risk_score += 15
+        # Update risk score and flagged status, persisting the log in a single write
+        # The model can add risk but never clears a checkout the rules flag on their own
+        self.fraud_log.risk_score = risk_score
+        self.fraud_log.is_flagged = result.is_flagged or risk_score >= result.flag_threshold
+        self.fraud_log.save()
         
-        # Rule 6: Flag if checkout occurs between 1am-5am local time and differs from user's usual patterns
-        current_hour = timezone.localtime().hour
-        if 1 <= current_hour <= 5:
-            # Check user's previous order hours (simplified for demo)
-            unusual_hour = True  # In a real system, you'd determine this from history
-            
-            if unusual_hour:
-                self.fraud_log.add_flag_reason(
-                    f"Unusual order time: {current_hour}:00 (unusual for this user)"
-                )
-                risk_score += 10
-        
-        # Rule 7: Flag if order contains 5+ of the same high-value item
-        high_value_items = {}
-        for item in self.cart.items.all():
-            if item.product.price > 50:  # Define high value as > $50
-                if item.product.id in high_value_items:
-                    high_value_items[item.product.id]['quantity'] += item.quantity
-                else:
-                    high_value_items[item.product.id] = {
-                        'name': item.product.name,
-                        'quantity': item.quantity
-                    }
-        
-        for product_id, data in high_value_items.items():
-            if data['quantity'] >= 5:
-                self.fraud_log.add_flag_reason(
-                    f"Bulk order of high-value item: {data['quantity']} x {data['name']}"
+        # One row per fired rule so dashboards can group flags by code
+        if self.fraud_log.is_flagged and result.hits:
+            FraudFlag.objects.bulk_create([
+                FraudFlag(
+                    log=self.fraud_log,
+                    code=hit.code,
+                    points=hit.points,
+                    observed_value=hit.observed,
+                    detection_time=self.fraud_log.detection_time
                 )
-                risk_score += 25
-                break
+                for hit in result.hits
+            ])
         
-        # Update risk score and flagged status
-        self.fraud_log.risk_score = risk_score
-        self.fraud_log.is_flagged = risk_score >= 40  # Flag if risk score reaches threshold
-        self.fraud_log.save()
+        # Link the account to others sharing its attributes off the request path
+        transaction.on_commit(lambda: run_in_background(
+            link_checkout, self.user.pk, self.link_attributes, self.fraud_log.is_flagged
+        ))
+        
+        # Trial candidate rules off the request path; they never change is_flagged
+        transaction.on_commit(lambda: submit_shadow(self.features, self.fraud_log, result))
         
         return self.fraud_log.is_flagged
     
-    def create_fraud_confirmation(self):
-        """Create a fraud confirmation entry for flagged transactions"""
+    def create_fraud_confirmation(self, order=None):
+        """
+        Create a fraud confirmation entry for flagged transactions.
+        
+        A Verification order is created from the loaded cart items, unless an
+        existing order (placed in the Scoring state) is given to attach to,
+        and the cart is cleared. The order's stock is held until the
+        confirmation expires; raises InsufficientStock, creating nothing, if
+        it cannot be held. Returns None if the given order has already left
+        the Scoring state.
+        """
         if not self.fraud_log.is_flagged:
             return None
             
-        # Create cart snapshot
-        cart_items = []
-        for item in self.cart.items.all():
-            cart_items.append({
-                'product_id': item.product.id,
-                'product_name': item.product.name,
-                'quantity': item.quantity,
-                'price': str(item.product.price),
-                'subtotal': str(item.subtotal)
-            })
-            
-        cart_snapshot = {
-            'items': cart_items,
-            'total': str(self.cart.total_price)
-        }
+        # Create cart snapshot from the already loaded items
+        cart_snapshot = self.features.cart_snapshot()
         
         # Set expiry time 30 minutes from now
         expiry_time = timezone.now() + timedelta(minutes=30)
         
-        # Create order with Verification status
         with transaction.atomic():
-            # Create order
-            pending_order = Order.objects.create(
-                user=self.user,
-                total_price=self.order_total,
-                status='Verification'  # Set status to Requires Verification
-            )
-            
-            # Create order items
-            for item in self.cart.items.all():
-                OrderItem.objects.create(
-                    order=pending_order,
-                    product_name=item.product.name,
-                    product_price=item.product.price,
-                    quantity=item.quantity,
-                    product=item.product
+            if order is not None:
+                # Hold the existing order until the customer confirms
+                if not transition(Order.objects.filter(pk=order.pk, status='Scoring'), 'Verification'):
+                    return None
+                order.status = 'Verification'
+                pending_order = order
+            else:
+                # Create order with Verification status
+                pending_order = Order.objects.create(
+                    user=self.user,
+                    total_price=self.order_total,
+                    status='Verification'  # Set status to Requires Verification
                 )
-        
-        # Create confirmation
-        confirmation = FraudConfirmation.objects.create(
-            transaction=self.transaction_data,
-            expiry_time=expiry_time,
-            cart_snapshot=cart_snapshot
-        )
-        
-        # Store order ID in the cart snapshot for reference
-        confirmation.cart_snapshot['order_id'] = pending_order.id
-        confirmation.save()
+                
+                # Create order items
+                OrderItem.objects.bulk_create([
+                    OrderItem(
+                        order=pending_order,
+                        product_name=item.product.name,
+                        product_price=item.product.price,
+                        quantity=item.quantity,
+                        product=item.product
+                    )
+                    for item in self.features.items
+                ])
+                
+                # The held order now owns the cart's items
+                self.cart.clear()
+            
+            # Hold the stock for as long as the customer has to confirm
+            hold_stock(pending_order, self.features.items, expiry_time)
+            
+            # Store order ID in the cart snapshot for reference
+            cart_snapshot['order_id'] = pending_order.id
+            
+            # Create confirmation
+            confirmation = FraudConfirmation.objects.create(
+                transaction=self.transaction_data,
+                order=pending_order,
+                expiry_time=expiry_time,
+                cart_snapshot=cart_snapshot
+            )
         
         return confirmation
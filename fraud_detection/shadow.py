@@ -0,0 +1,165 @@
+"""
+Shadow evaluation of candidate fraud rules on live traffic
+
+Shadow rules (see rules.compile_shadow_rules) run after the checkout
+commits, on the scoring pool, against the same feature snapshot as the live
+rules. Each outcome is stored as a ShadowEvaluation next to the
+FraudDetectionLog together with whether the transaction would have been
+flagged had the rule been adopted. The live flag is never changed.
+
+    FRAUD_DETECTION = {
+        'SHADOW_RULES': {'amount_spike_strict': {'rule': 'amount_spike', 'multiplier': 1.5}},
+        'SHADOW_BUDGET_MS': 5,        # per-rule time budget
+        'SHADOW_MAX_OVERRUNS': 100,   # overruns before a rule is suspended
+    }
+
+A running check cannot be interrupted, so the budget is enforced after the
+fact: evaluations slower than the budget are recorded as overruns, and a
+rule that overruns SHADOW_MAX_OVERRUNS times is suspended in that process
+until the settings change or the process restarts. When the pool is
+saturated shadow work is dropped rather than run on the request thread;
+drops are counted and logged.
+
+Whether a transaction would be flagged with a candidate adopted is judged
+on the full rule score, before any model blending. If the live plan
+stopped at the flag threshold, the worker evaluates it again in full.
+"""
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+import threading
+import time
+import logging
+
+from .models import ShadowEvaluation
+from .pipeline import run_in_background
+from .rules import compile_shadow_rules, get_plan
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHADOW_BUDGET_MS = 5
+DEFAULT_SHADOW_MAX_OVERRUNS = 100
+
+# Drops are logged on the first and then every this many
+DROP_LOG_INTERVAL = 100
+
+
+class ShadowPlan:
+    """Compiled shadow rules with in-process overrun and drop counters"""
+
+    def __init__(self, rules, budget_ms=DEFAULT_SHADOW_BUDGET_MS, max_overruns=DEFAULT_SHADOW_MAX_OVERRUNS):
+        self.rules = rules
+        self.budget_ms = budget_ms
+        self.max_overruns = max_overruns
+        self.overruns = {rule.code: 0 for rule in rules}
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def active_rules(self):
+        """Rules not suspended for overrunning their budget"""
+        with self._lock:
+            return [rule for rule in self.rules if self.overruns[rule.code] < self.max_overruns]
+
+    def evaluate(self, snapshot, fraud_log, live_points, flag_threshold):
+        """
+        Unsaved ShadowEvaluation rows for one scored transaction.
+
+        live_points maps the codes of the live rules that fired to their
+        points, with the plan evaluated in full, so a variant is judged as a
+        replacement for its live rule.
+        """
+        rule_score = sum(live_points.values())
+        evaluations = []
+        for rule in self.active_rules():
+            if not rule.has_inputs(snapshot):
+                continue
+
+            started = time.perf_counter()
+            try:
+                reason = rule.rule.check(snapshot, rule.thresholds)
+            except Exception:
+                logger.exception(f"Shadow rule {rule.code} failed")
+                continue
+            elapsed_ms = (time.perf_counter() - started) * 1000
+
+            over_budget = elapsed_ms > self.budget_ms
+            if over_budget:
+                self._record_overrun(rule.code)
+
+            points = rule.weight if reason else 0
+            adopted_score = rule_score - live_points.get(rule.replaces, 0) + points
+            evaluations.append(ShadowEvaluation(
+                log=fraud_log,
+                code=rule.code,
+                replaces=rule.replaces or '',
+                fired=bool(reason),
+                points=points,
+                live_flagged=fraud_log.is_flagged,
+                would_flag=adopted_score >= flag_threshold,
+                elapsed_ms=elapsed_ms,
+                over_budget=over_budget,
+            ))
+        return evaluations
+
+    def _record_overrun(self, code):
+        with self._lock:
+            self.overruns[code] += 1
+            suspended = self.overruns[code] == self.max_overruns
+        if suspended:
+            logger.warning(
+                f"Shadow rule {code} exceeded its {self.budget_ms}ms budget {self.max_overruns} times, suspending it"
+            )
+
+    def record_drop(self):
+        with self._lock:
+            self.dropped += 1
+            dropped = self.dropped
+        if dropped == 1 or dropped % DROP_LOG_INTERVAL == 0:
+            logger.warning(f"Scoring pool saturated, {dropped} shadow evaluations dropped so far")
+
+
+def compile_shadow_plan(config=None):
+    if config is None:
+        config = getattr(settings, 'FRAUD_DETECTION', {})
+    return ShadowPlan(
+        compile_shadow_rules(config=config),
+        budget_ms=config.get('SHADOW_BUDGET_MS', DEFAULT_SHADOW_BUDGET_MS),
+        max_overruns=config.get('SHADOW_MAX_OVERRUNS', DEFAULT_SHADOW_MAX_OVERRUNS),
+    )
+
+
+_shadow_plan = None
+
+
+def get_shadow_plan():
+    """Return the shadow plan compiled at startup"""
+    global _shadow_plan
+    if _shadow_plan is None:
+        _shadow_plan = compile_shadow_plan()
+    return _shadow_plan
+
+
+@receiver(setting_changed)
+def reset_shadow_plan(sender, setting, **kwargs):
+    """Recompile (and clear the counters) when FRAUD_DETECTION is overridden"""
+    global _shadow_plan
+    if setting == 'FRAUD_DETECTION':
+        _shadow_plan = None
+
+
+def record_shadow(plan, snapshot, fraud_log, live_result):
+    """Evaluate the shadow rules against the live rules' result and store their outcomes"""
+    if live_result.short_circuited:
+        # Off the request path, so it stays out of the live rules' timing report
+        live_result = get_plan().evaluate(snapshot, short_circuit=False, record_timings=False)
+    live_points = {hit.code: hit.points for hit in live_result.hits}
+    ShadowEvaluation.objects.bulk_create(plan.evaluate(snapshot, fraud_log, live_points, live_result.flag_threshold))
+
+
+def submit_shadow(snapshot, fraud_log, live_result):
+    """Queue shadow evaluation of a scored transaction, dropping it if the pool is full"""
+    plan = get_shadow_plan()
+    if not plan.rules:
+        return
+    if not run_in_background(record_shadow, plan, snapshot, fraud_log, live_result, inline_when_full=False):
+        plan.record_drop()
@@ -0,0 +1,69 @@
+"""
+Signals keeping fraud detection data in sync with orders and dashboard counters
+"""
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+import logging
+
+from orders.models import Order
+from orders.state_machine import orders_transitioned
+from .models import FraudDetectionLog, FraudConfirmation, FraudDailyCounter
+from .profiles import EXCLUDED_STATUS, record_bulk_cancellation, record_order, record_status_change
+from .velocity import DIMENSION_USER, get_velocity_counter
+
+logger = logging.getLogger(__name__)
+
+@receiver(post_save, sender=Order)
+def update_fraud_profile(sender, instance, created, **kwargs):
+    """
+    Keep the user's fraud profile and order velocity current as orders are
+    created or change status; the status an order was loaded with is
+    tracked by orders.signals
+    """
+    if created:
+        record_order(instance)
+        get_velocity_counter().record(DIMENSION_USER, instance.user_id, instance.order_date)
+    elif instance._loaded_status is not None and instance._loaded_status != instance.status:
+        record_status_change(instance, instance._loaded_status)
+
+@receiver(orders_transitioned, sender=Order)
+def update_fraud_profiles(sender, orders, status, **kwargs):
+    """
+    Take orders cancelled by a batched transition out of their users'
+    lifetime totals, one profile save per user
+    """
+    if status == EXCLUDED_STATUS:
+        record_bulk_cancellation(
+            (user_id, total_price) for _, previous, user_id, _, total_price in orders if previous != EXCLUDED_STATUS
+        )
+
+@receiver(post_save, sender=FraudDetectionLog)
+def count_transaction(sender, instance, created, **kwargs):
+    """
+    Count each scored transaction, and whether it was flagged, on the
+    transaction's day with a single UPDATE when its log is first written
+    """
+    if created:
+        FraudDailyCounter.increment(
+            timezone.localdate(instance.transaction.transaction_time),
+            total=1,
+            flagged=int(instance.is_flagged),
+        )
+
+@receiver(post_init, sender=FraudConfirmation)
+def remember_confirmation_status(sender, instance, **kwargs):
+    """
+    Remember the status a confirmation was loaded with so outcomes are counted once
+    """
+    instance._loaded_status = instance.__dict__.get('status')
+
+@receiver(post_save, sender=FraudConfirmation)
+def count_confirmation_outcome(sender, instance, created, **kwargs):
+    """
+    Count confirmations reaching the confirmed or expired state; bulk expiry
+    by the sweeper updates the counters itself
+    """
+    if instance.status != instance._loaded_status and instance.status in ('confirmed', 'expired'):
+        FraudDailyCounter.increment(timezone.localdate(instance.created_at), **{instance.status: 1})
+    instance._loaded_status = instance.status
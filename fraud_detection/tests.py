@@ -1,3 +1,1270 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from django.utils import timezone
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
+import importlib.util
+import uuid
 
-# Create your tests here.
+from products.models import Category, Product
+from cart.models import Cart, CartItem
+from orders.models import Order
+from orders.state_machine import transition
+from .models import (
+    TransactionData, FraudDetectionLog, FraudFlag, FraudConfirmation, UserFraudProfile, ExportWatermark,
+    FraudDailyCounter,
+)
+from .services import FraudDetectionService
+from .rules import compile_plan, get_plan
+
+
+class FraudTestMixin:
+    """Shared fixtures for fraud detection tests"""
+
+    def setUp(self):
+        # The tests' local-memory cache stands in for a shared one
+        testing = override_settings(TESTING=True)
+        testing.enable()
+        self.addCleanup(testing.disable)
+        # Velocity counters live in the cache, which outlives test transactions
+        cache.clear()
+
+    def create_user(self, username='shopper', location='Lahore', **kwargs):
+        return get_user_model().objects.create_user(
+            username=username, password='pass12345', location=location, **kwargs
+        )
+
+    def create_cart(self, user, items):
+        """Create a cart holding (price, quantity) pairs"""
+        category, _ = Category.objects.get_or_create(name='General')
+        cart = Cart.objects.create(user=user)
+        for index, (price, quantity) in enumerate(items):
+            product = Product.objects.create(
+                name=f'Product {index}',
+                description='Test product',
+                price=Decimal(price),
+                stock=100,
+                category=category,
+            )
+            CartItem.objects.create(cart=cart, product=product, quantity=quantity)
+        return cart
+
+
+class FraudDetectionServiceTests(FraudTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.user.date_joined = timezone.now() - timedelta(days=30)
+        self.user.save()
+
+    def run_service(self, cart, location='Lahore', shipping='Street 1', billing='Street 1'):
+        service = FraudDetectionService(self.user, cart, location, shipping, billing)
+        service.collect_transaction_data()
+        is_flagged = service.run_fraud_detection()
+        return service, is_flagged
+
+    def test_clean_transaction_passes(self):
+        cart = self.create_cart(self.user, [('20.00', 1)])
+        service, is_flagged = self.run_service(cart)
+
+        self.assertFalse(is_flagged)
+        log = FraudDetectionLog.objects.get(transaction=service.transaction_data)
+        self.assertEqual(log.risk_score, 0)
+        self.assertTrue(TransactionData.objects.get().is_first_purchase)
+
+    @override_settings(FRAUD_DETECTION={'SHORT_CIRCUIT': False})
+    def test_flagged_transaction_records_all_reasons(self):
+        Order.objects.create(user=self.user, total_price=Decimal('10.00'))
+        cart = self.create_cart(self.user, [('60.00', 5)])
+        service, is_flagged = self.run_service(
+            cart, location='Karachi', shipping='Street 1', billing='Street 2'
+        )
+
+        self.assertTrue(is_flagged)
+        log = FraudDetectionLog.objects.get(transaction=service.transaction_data)
+        # Amount spike, location mismatch, address mismatch and bulk high-value items
+        self.assertGreaterEqual(log.risk_score, 85)
+        self.assertGreaterEqual(len(log.flag_reasons['reasons']), 4)
+
+    def test_rules_run_against_snapshot_without_queries(self):
+        cart = self.create_cart(self.user, [('60.00', 5), ('15.00', 2)])
+        service = FraudDetectionService(self.user, cart, 'Karachi', 'A', 'B')
+        service.collect_transaction_data()
+
+        # Only the fraud log INSERT, its daily counter UPDATE and one bulk INSERT
+        # of its flags reach the database
+        FraudDailyCounter.objects.create(day=timezone.localdate())
+        with self.assertNumQueries(3):
+            service.run_fraud_detection()
+
+    def test_flags_stored_with_codes_and_observed_values(self):
+        cart = self.create_cart(self.user, [('60.00', 5)])
+        service, is_flagged = self.run_service(cart, location='Karachi')
+
+        self.assertTrue(is_flagged)
+        flags = {flag.code: flag for flag in FraudFlag.objects.filter(log=service.fraud_log)}
+        self.assertEqual(set(flags), {'bulk_high_value', 'location_mismatch'})
+        self.assertEqual(flags['bulk_high_value'].points, 25)
+        self.assertEqual(flags['bulk_high_value'].observed_value, 5)
+        self.assertIsNone(flags['location_mismatch'].observed_value)
+        self.assertEqual(flags['location_mismatch'].detection_time, service.fraud_log.detection_time)
+
+    def test_flagged_transaction_stores_rules_after_the_cutoff(self):
+        Order.objects.create(user=self.user, total_price=Decimal('10.00'))
+        cart = self.create_cart(self.user, [('60.00', 5)])
+        service, is_flagged = self.run_service(cart, location='Karachi', billing='Street 2')
+
+        self.assertTrue(is_flagged)
+        # The heavy rules reach the threshold, yet the lighter ones are still recorded
+        flags = dict(FraudFlag.objects.filter(log=service.fraud_log).values_list('code', 'points'))
+        self.assertEqual(set(flags), {'amount_spike', 'bulk_high_value', 'location_mismatch', 'address_mismatch'})
+        self.assertEqual(service.fraud_log.risk_score, sum(flags.values()))
+        self.assertEqual(len(service.fraud_log.flag_reasons['reasons']), 4)
+
+    def test_clean_transaction_stores_no_flags(self):
+        cart = self.create_cart(self.user, [('20.00', 1)])
+        self.run_service(cart)
+        self.assertFalse(FraudFlag.objects.exists())
+
+    def test_backfill_parses_legacy_reasons(self):
+        from io import StringIO
+
+        cart = self.create_cart(self.user, [('20.00', 1)])
+        service, is_flagged = self.run_service(cart)
+        log = service.fraud_log
+        log.is_flagged = True
+        log.flag_reasons = {'reasons': [
+            "High order frequency: 5 orders in the last 24 hours",
+            "Order amount ($300.00) is significantly higher than user's average ($50.00)",
+            "Something the rules never said",
+        ]}
+        log.save()
+
+        call_command('backfill_fraud_flags', stdout=StringIO())
+        flags = {flag.code: flag.observed_value for flag in FraudFlag.objects.filter(log=log)}
+        self.assertEqual(flags, {'order_frequency': 4.0, 'amount_spike': 300.0, 'unknown': None})
+
+        # Re-running adds nothing
+        call_command('backfill_fraud_flags', stdout=StringIO())
+        self.assertEqual(FraudFlag.objects.filter(log=log).count(), 3)
+
+    def test_backfill_completes_short_circuited_flags(self):
+        from io import StringIO
+
+        cart = self.create_cart(self.user, [('60.00', 5)])
+        service, is_flagged = self.run_service(cart, location='Karachi')
+        log = service.fraud_log
+        # As stored before flagged results were completed, when the cutoff hid location_mismatch
+        FraudFlag.objects.filter(log=log, code='location_mismatch').delete()
+
+        call_command('backfill_fraud_flags', stdout=StringIO())
+        flags = {flag.code: flag for flag in FraudFlag.objects.filter(log=log)}
+        self.assertEqual(set(flags), {'bulk_high_value', 'location_mismatch'})
+        self.assertEqual(flags['location_mismatch'].points, 20)
+        self.assertEqual(flags['location_mismatch'].detection_time, log.detection_time)
+
+    def test_dashboard_breakdown_groups_by_code(self):
+        for location in ('Karachi', 'Quetta'):
+            cart = self.create_cart(self.user, [('60.00', 5)])
+            self.run_service(cart, location=location)
+            cart.delete()
+        staff = self.create_user(username='staff', is_staff=True)
+        self.client.force_login(staff)
+
+        response = self.client.get(reverse('fraud_dashboard'))
+        reason_counts = response.context['reason_counts']
+        self.assertEqual(reason_counts['Checkout location differs from registration location'], 2)
+        self.assertEqual(reason_counts['Bulk quantity of a single high-value product'], 2)
+
+    def test_sweeper_expires_holds_and_cancels_orders(self):
+        from io import StringIO
+
+        Order.objects.create(user=self.user, total_price=Decimal('40.00'))
+        confirmations = []
+        for location in ('Karachi', 'Quetta', 'Multan'):
+            cart = self.create_cart(self.user, [('60.00', 5)])
+            service, is_flagged = self.run_service(cart, location=location)
+            confirmations.append(service.create_fraud_confirmation())
+            cart.delete()
+        self.assertEqual(UserFraudProfile.objects.get(pk=self.user.pk).order_count, 4)
+
+        lapsed, confirmed, live = confirmations
+        FraudConfirmation.objects.filter(pk__in=[lapsed.pk, confirmed.pk]).update(
+            expiry_time=timezone.now() - timedelta(minutes=1)
+        )
+        FraudConfirmation.objects.filter(pk=confirmed.pk).update(is_confirmed=True, status='confirmed')
+
+        out = StringIO()
+        call_command('sweep_fraud_confirmations', '--batch-size', '1', stdout=out)
+        self.assertIn('Expired 1 confirmations, cancelled 1 orders', out.getvalue())
+
+        lapsed.refresh_from_db()
+        self.assertEqual(lapsed.status, 'expired')
+        self.assertIsNotNone(lapsed.archived_at)
+        self.assertEqual(Order.objects.get(pk=lapsed.order_id).status, 'Cancelled')
+        self.assertEqual(Order.objects.get(pk=live.order_id).status, 'Verification')
+        self.assertEqual(FraudConfirmation.objects.get(pk=confirmed.pk).status, 'confirmed')
+
+        # The cancelled order's held stock is back, the live order's is still held
+        self.assertEqual(Product.objects.get(orderitem__order_id=lapsed.order_id).stock, 100)
+        self.assertEqual(Product.objects.get(orderitem__order_id=live.order_id).stock, 95)
+
+        # The cancelled order leaves the lifetime totals as if it had been saved
+        profile = UserFraudProfile.objects.get(pk=self.user.pk)
+        self.assertEqual(profile.order_count, 3)
+        self.assertEqual(profile.total_spent, Decimal('640.00'))
+
+        # Nothing left to sweep
+        out = StringIO()
+        call_command('sweep_fraud_confirmations', stdout=out)
+        self.assertEqual(out.getvalue(), '')
+
+    def test_confirmation_converts_stock_hold(self):
+        from orders.models import StockHold
+
+        cart = self.create_cart(self.user, [('60.00', 5)])
+        service, is_flagged = self.run_service(cart, location='Karachi')
+        confirmation = service.create_fraud_confirmation()
+        product = Product.objects.get(orderitem__order_id=confirmation.order_id)
+
+        self.assertFalse(cart.items.exists())
+        self.assertEqual(StockHold.objects.get(order_id=confirmation.order_id).quantity, 5)
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 95)
+
+        self.client.force_login(self.user)
+        self.client.post(reverse('confirm_transaction', args=[confirmation.confirmation_key]))
+
+        self.assertEqual(Order.objects.get(pk=confirmation.order_id).status, 'Processing')
+        self.assertFalse(StockHold.objects.exists())
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 95)
+
+    def test_confirming_cancelled_order_keeps_it_cancelled(self):
+        cart = self.create_cart(self.user, [('60.00', 5)])
+        service, is_flagged = self.run_service(cart, location='Karachi')
+        confirmation = service.create_fraud_confirmation()
+        transition(Order.objects.filter(pk=confirmation.order_id), 'Cancelled')
+
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('confirm_transaction', args=[confirmation.confirmation_key]))
+
+        self.assertRedirects(response, reverse('order_history'), fetch_redirect_response=False)
+        self.assertEqual(Order.objects.get(pk=confirmation.order_id).status, 'Cancelled')
+        self.assertEqual(FraudConfirmation.objects.get(pk=confirmation.pk).status, 'pending')
+        self.assertEqual(Product.objects.get(orderitem__order_id=confirmation.order_id).stock, 100)
+
+    def test_confirmation_not_counted_when_stock_ran_out(self):
+        from orders.models import StockHold
+
+        cart = self.create_cart(self.user, [('60.00', 5)])
+        service, is_flagged = self.run_service(cart, location='Karachi')
+        confirmation = service.create_fraud_confirmation()
+        # The hold was released and most of the stock sold meanwhile
+        StockHold.objects.filter(order_id=confirmation.order_id).delete()
+        Product.objects.filter(orderitem__order_id=confirmation.order_id).update(stock=2)
+
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('confirm_transaction', args=[confirmation.confirmation_key]))
+
+        self.assertRedirects(response, reverse('order_history'), fetch_redirect_response=False)
+        self.assertEqual(Order.objects.get(pk=confirmation.order_id).status, 'Cancelled')
+        confirmation.refresh_from_db()
+        self.assertEqual((confirmation.status, confirmation.is_confirmed), ('expired', False))
+        self.assertEqual(FraudDailyCounter.objects.get(day=timezone.localdate()).confirmed, 0)
+
+    def test_daily_counters_follow_events(self):
+        from io import StringIO
+
+        today = timezone.localdate()
+        clean = self.create_cart(self.user, [('20.00', 1)])
+        self.run_service(clean)
+        clean.delete()
+
+        holds = []
+        for location in ('Karachi', 'Quetta'):
+            cart = self.create_cart(self.user, [('60.00', 5)])
+            service, is_flagged = self.run_service(cart, location=location)
+            holds.append(service.create_fraud_confirmation())
+            cart.delete()
+
+        confirmed, lapsed = holds
+        confirmed.is_confirmed = True
+        confirmed.status = 'confirmed'
+        confirmed.save()
+        FraudConfirmation.objects.filter(pk=lapsed.pk).update(expiry_time=timezone.now() - timedelta(minutes=1))
+        call_command('sweep_fraud_confirmations', stdout=StringIO())
+
+        counter = FraudDailyCounter.objects.get(day=today)
+        self.assertEqual((counter.total, counter.flagged, counter.confirmed, counter.expired), (3, 2, 1, 1))
+
+        staff = self.create_user(username='staff', is_staff=True)
+        self.client.force_login(staff)
+        context = self.client.get(reverse('fraud_dashboard')).context
+        self.assertEqual((context['total_transactions'], context['flagged_count']), (3, 2))
+        self.assertEqual((context['confirmed_count'], context['expired_count']), (1, 1))
+
+    def test_reconcile_corrects_drift(self):
+        from io import StringIO
+
+        cart = self.create_cart(self.user, [('60.00', 5)])
+        self.run_service(cart, location='Karachi')
+        today = timezone.localdate()
+        FraudDailyCounter.objects.filter(day=today).update(total=10, flagged=0)
+        FraudDailyCounter.objects.create(day=today - timedelta(days=3), total=4)
+
+        out = StringIO()
+        call_command('reconcile_fraud_counters', stdout=out)
+        self.assertIn('total -9, flagged +1', out.getvalue())
+
+        counter = FraudDailyCounter.objects.get(day=today)
+        self.assertEqual((counter.total, counter.flagged), (1, 1))
+        self.assertEqual(FraudDailyCounter.objects.get(day=today - timedelta(days=3)).total, 0)
+
+    def test_confirmation_uses_loaded_cart(self):
+        cart = self.create_cart(self.user, [('60.00', 5), ('15.00', 2)])
+        service, is_flagged = self.run_service(cart, location='Karachi')
+        self.assertTrue(is_flagged)
+
+        confirmation = service.create_fraud_confirmation()
+        self.assertEqual(len(confirmation.cart_snapshot['items']), 2)
+        order = Order.objects.get(id=confirmation.cart_snapshot['order_id'])
+        self.assertEqual(order.status, 'Verification')
+        self.assertEqual(order.items.count(), 2)
+
+
+class UserFraudProfileTests(FraudTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+
+    def test_profile_tracks_created_orders(self):
+        Order.objects.create(user=self.user, total_price=Decimal('10.00'))
+        Order.objects.create(user=self.user, total_price=Decimal('30.00'))
+
+        profile = UserFraudProfile.objects.get(pk=self.user.pk)
+        self.assertEqual(profile.order_count, 2)
+        self.assertEqual(profile.order_average, Decimal('20.00'))
+        self.assertEqual(sum(profile.hour_histogram), 2)
+
+    def test_cancelled_orders_leave_lifetime_totals(self):
+        order = Order.objects.create(user=self.user, total_price=Decimal('10.00'))
+        Order.objects.create(user=self.user, total_price=Decimal('30.00'))
+
+        order.status = 'Cancelled'
+        order.save()
+        profile = UserFraudProfile.objects.get(pk=self.user.pk)
+        self.assertEqual(profile.order_count, 1)
+        self.assertEqual(profile.order_average, Decimal('30.00'))
+
+        order.status = 'Pending'
+        order.save()
+        profile.refresh_from_db()
+        self.assertEqual(profile.order_count, 2)
+
+    def test_batched_cancellation_leaves_lifetime_totals(self):
+        for total in ('10.00', '20.00', '30.00'):
+            Order.objects.create(user=self.user, total_price=Decimal(total))
+
+        transition(Order.objects.filter(total_price__lt=Decimal('25.00')), 'Cancelled')
+
+        profile = UserFraudProfile.objects.get(pk=self.user.pk)
+        self.assertEqual(profile.order_count, 1)
+        self.assertEqual(profile.order_average, Decimal('30.00'))
+
+    def test_rebuild_matches_incremental_profile(self):
+        for total in ('10.00', '20.00', '45.00'):
+            Order.objects.create(user=self.user, total_price=Decimal(total))
+        incremental = UserFraudProfile.objects.get(pk=self.user.pk)
+
+        call_command('rebuild_fraud_profiles', stdout=mock.MagicMock())
+        rebuilt = UserFraudProfile.objects.get(pk=self.user.pk)
+
+        self.assertEqual(rebuilt.order_count, incremental.order_count)
+        self.assertEqual(rebuilt.order_average, incremental.order_average)
+        self.assertEqual(rebuilt.hour_histogram, incremental.hour_histogram)
+
+    def test_service_reads_profile_instead_of_orders(self):
+        for _ in range(3):
+            Order.objects.create(user=self.user, total_price=Decimal('10.00'))
+        cart = self.create_cart(self.user, [('20.00', 1)])
+
+        with CaptureQueriesContext(connection) as queries:
+            service = FraudDetectionService(self.user, cart, 'Lahore', 'A', 'A')
+
+        # Cart items, profile and linked cluster
+        self.assertEqual(len(queries), 3)
+        self.assertFalse(any('"orders_order"' in query['sql'] for query in queries))
+        self.assertEqual(service.features.order_count, 3)
+        self.assertEqual(service.features.recent_order_count, 3)
+
+
+class RescoreTransactionsTests(FraudTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.user.date_joined = timezone.now() - timedelta(hours=2)
+        self.user.save()
+
+    def score(self, items, location='Lahore', billing='Street 1'):
+        cart = self.create_cart(self.user, items)
+        service = FraudDetectionService(self.user, cart, location, 'Street 1', billing)
+        service.collect_transaction_data()
+        service.run_fraud_detection()
+        cart.delete()
+        return service.fraud_log
+
+    def test_vectorized_scores_match_live_scores(self):
+        from io import StringIO
+        import numpy as np
+        from .management.commands.rescore_transactions import Command
+
+        logs = [
+            self.score([('20.00', 1)]),
+            self.score([('60.00', 5)], location='Karachi'),
+            self.score([('120.00', 2)], billing='Street 2'),
+        ]
+
+        command = Command(stdout=StringIO())
+        columns = command.load_columns(np, {'since': None, 'until': None, 'chunk_size': 2})
+        scores, fired = get_plan().evaluate_arrays(columns)
+
+        self.assertEqual(list(scores), [log.risk_score for log in logs])
+
+    def test_command_reports_each_candidate(self):
+        from io import StringIO
+
+        self.score([('60.00', 5)], location='Karachi')
+        self.score([('20.00', 1)])
+
+        out = StringIO()
+        call_command('rescore_transactions', '--set', 'flag_threshold=100', stdout=out)
+        output = out.getvalue()
+
+        self.assertIn('Candidate: current', output)
+        self.assertIn('Flagged: 1 of 2 (50.0%)', output)
+        self.assertIn('Candidate: flag_threshold=100', output)
+        self.assertIn('Flagged: 0 of 2 (0.0%)', output)
+
+
+class RiskModelTests(FraudTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        import tempfile
+        import numpy as np
+        from .ml import RiskModel, FEATURE_NAMES, model_cache
+
+        self.np = np
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = f"{self.directory.name}/model.npy"
+        self.width = len(FEATURE_NAMES)
+        self.RiskModel = RiskModel
+        model_cache.clear()
+        self.addCleanup(model_cache.clear)
+
+        self.user = self.create_user()
+        self.user.date_joined = timezone.now() - timedelta(days=30)
+        self.user.save()
+
+    def save_model(self, bias):
+        model = self.RiskModel(
+            mean=self.np.zeros(self.width),
+            scale=self.np.ones(self.width),
+            weights=self.np.zeros(self.width),
+            bias=bias,
+        )
+        model.save(self.np, self.path)
+        return model
+
+    def test_round_trip_and_reload_on_mtime_change(self):
+        import os
+        from .ml import model_cache
+
+        self.save_model(bias=0.0)
+        model = model_cache.get(self.path, reload_check_seconds=0)
+        self.assertAlmostEqual(model.score([0.0] * self.width), 0.5)
+
+        self.save_model(bias=10.0)
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        reloaded = model_cache.get(self.path, reload_check_seconds=0)
+        self.assertIsNot(reloaded, model)
+        self.assertGreater(reloaded.score([0.0] * self.width), 0.99)
+
+    def test_service_blends_model_probability(self):
+        self.save_model(bias=10.0)
+        cart = self.create_cart(self.user, [('20.00', 1)])
+
+        with override_settings(FRAUD_DETECTION={'ML_MODEL_PATH': self.path, 'ML_BLEND_WEIGHT': 0.5}):
+            service = FraudDetectionService(self.user, cart, 'Lahore', 'A', 'A')
+            service.collect_transaction_data()
+            is_flagged = service.run_fraud_detection()
+
+        # Rule score 0, model probability ~1: blended score is ~50, above the threshold
+        self.assertTrue(is_flagged)
+        self.assertEqual(service.fraud_log.risk_score, 50)
+        self.assertEqual(service.fraud_log.flag_reasons['rule_score'], 0)
+
+    def test_low_model_probability_keeps_rule_flag(self):
+        self.save_model(bias=-10.0)
+        Order.objects.create(user=self.user, total_price=Decimal('10.00'))
+        cart = self.create_cart(self.user, [('60.00', 5)])
+
+        with override_settings(FRAUD_DETECTION={'ML_MODEL_PATH': self.path, 'ML_BLEND_WEIGHT': 0.8}):
+            service = FraudDetectionService(self.user, cart, 'Karachi', 'Street 1', 'Street 2')
+            service.collect_transaction_data()
+            is_flagged = service.run_fraud_detection()
+
+        # The whole plan ran: amount spike, location, address and bulk high-value
+        rule_score = service.fraud_log.flag_reasons['rule_score']
+        self.assertGreaterEqual(rule_score, 85)
+        self.assertGreaterEqual(len(service.fraud_log.flag_reasons['reasons']), 4)
+        # Model probability ~0 pulls the blended score below the threshold, yet the rules' flag stands
+        self.assertLess(service.fraud_log.risk_score, get_plan().flag_threshold)
+        self.assertTrue(is_flagged)
+
+    def test_scoring_stays_under_a_millisecond(self):
+        import time
+        from .features import TransactionFeatures
+        from .ml import blended_score
+
+        self.save_model(bias=-1.0)
+        cart = self.create_cart(self.user, [('20.00', 1)])
+        features = TransactionFeatures.load(self.user, cart, 'Lahore', 'A', 'A')
+
+        with override_settings(FRAUD_DETECTION={'ML_MODEL_PATH': self.path, 'ML_BLEND_WEIGHT': 0.5}):
+            blended_score(features, 0)
+            started = time.perf_counter()
+            for _ in range(200):
+                blended_score(features, 0)
+            elapsed = (time.perf_counter() - started) / 200
+
+        self.assertLess(elapsed, 0.001)
+
+    def test_train_command_writes_loadable_model(self):
+        from io import StringIO
+
+        for index in range(6):
+            cart = self.create_cart(self.user, [('60.00', 5 if index % 2 else 1)])
+            service = FraudDetectionService(self.user, cart, 'Karachi' if index % 2 else 'Lahore', 'A', 'A')
+            service.collect_transaction_data()
+            service.run_fraud_detection()
+            cart.delete()
+
+        call_command('train_fraud_model', '--output', self.path, '--epochs', '50', stdout=StringIO())
+        model = self.RiskModel.load(self.path)
+        self.assertEqual(len(model.weights), self.width)
+
+
+class VelocityCounterTests(FraudTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.user.date_joined = timezone.now() - timedelta(days=30)
+        self.user.save()
+
+    def assert_sliding_window(self, backend):
+        from .velocity import VelocityCounter
+
+        counter = VelocityCounter(backend)
+        now = timezone.now()
+        counter.record('ip', '10.0.0.1', now)
+        counter.record('ip', '10.0.0.1', now - timedelta(hours=3))
+        counter.record('ip', '10.0.0.1', now - timedelta(hours=30))
+        counter.record('ip', '10.0.0.2', now)
+
+        self.assertEqual(counter.count('ip', '10.0.0.1', hours=24, when=now), 2)
+        self.assertEqual(counter.count('ip', '10.0.0.1', hours=48, when=now), 3)
+        self.assertEqual(counter.count('ip', '10.0.0.1', hours=1, when=now), 1)
+        self.assertIsNone(counter.count('ip', '', when=now))
+
+    def test_local_backend_window(self):
+        from .velocity import LocalVelocityBackend, VelocityCounter
+
+        backend = LocalVelocityBackend(window_hours=48)
+        self.assert_sliding_window(backend)
+
+        # A slot reused after a full turn of the ring forgets its old hour
+        now = timezone.now()
+        counter = VelocityCounter(backend)
+        counter.record('ip', '10.0.0.3', now - timedelta(hours=48))
+        counter.record('ip', '10.0.0.3', now)
+        self.assertEqual(counter.count('ip', '10.0.0.3', hours=48, when=now), 1)
+
+    def test_cache_backend_window(self):
+        from .velocity import CacheVelocityBackend
+
+        self.assert_sliding_window(CacheVelocityBackend(window_hours=48))
+
+    def test_local_memory_cache_unavailable_in_production(self):
+        from .checks import check_velocity_cache
+        from .velocity import LocalVelocityBackend, get_velocity_counter
+
+        with override_settings(DEBUG=False, TESTING=False):
+            self.assertEqual([warning.id for warning in check_velocity_cache(None)], ['fraud_detection.W001'])
+            with self.assertLogs('fraud_detection.velocity', 'ERROR'):
+                counter = get_velocity_counter()
+            self.assertIsNone(counter.count('user', self.user.pk))
+
+            # Saving an order still works, without a user count
+            Order.objects.create(user=self.user, total_price=Decimal('10.00'))
+
+            # In-process counters are an explicit choice
+            with override_settings(FRAUD_DETECTION={'VELOCITY_BACKEND': 'local'}):
+                self.assertEqual(check_velocity_cache(None), [])
+                self.assertIsInstance(get_velocity_counter().backend, LocalVelocityBackend)
+
+    def test_addresses_normalized(self):
+        from .velocity import normalize_address
+
+        self.assertEqual(normalize_address('12  Mall Road, Lahore'), normalize_address('12 mall road lahore'))
+        self.assertNotEqual(normalize_address('12 Mall Road'), normalize_address('14 Mall Road'))
+
+    def test_order_frequency_counted_without_querying_orders(self):
+        for _ in range(3):
+            Order.objects.create(user=self.user, total_price=Decimal('10.00'))
+        cache.clear()
+        cart = self.create_cart(self.user, [('20.00', 1)])
+
+        service = FraudDetectionService(self.user, cart, 'Lahore', 'A', 'A')
+        # The counter, not the order table, is the source of recent activity
+        self.assertEqual(service.features.order_count, 3)
+        self.assertEqual(service.features.recent_order_count, 0)
+
+    def test_forwarded_for_only_trusted_behind_configured_proxies(self):
+        from .services import request_device_info
+
+        request = RequestFactory().post(
+            '/checkout/', REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='198.51.100.7, 203.0.113.9, 10.0.0.1'
+        )
+        self.assertEqual(request_device_info(request)['ip_address'], '10.0.0.2')
+        with override_settings(FRAUD_DETECTION={'TRUSTED_PROXY_COUNT': 2}):
+            self.assertEqual(request_device_info(request)['ip_address'], '203.0.113.9')
+        with override_settings(FRAUD_DETECTION={'TRUSTED_PROXY_COUNT': 4}):
+            self.assertEqual(request_device_info(request)['ip_address'], '10.0.0.2')
+
+    @override_settings(FRAUD_DETECTION={'RULES': {
+        'ip_velocity': {'min_previous_orders': 2},
+        'shipping_velocity': {'min_previous_orders': 2},
+    }})
+    def test_ip_and_shipping_velocity_rules(self):
+        request = RequestFactory().post('/checkout/', REMOTE_ADDR='203.0.113.9', HTTP_USER_AGENT='Browser')
+
+        ip_counts = []
+        for index in range(3):
+            user = self.create_user(username=f'buyer{index}')
+            user.date_joined = timezone.now() - timedelta(days=30)
+            user.save()
+            cart = self.create_cart(user, [('20.00', 1)])
+            service = FraudDetectionService(user, cart, 'Lahore', '1 Same Street', '1 Same Street', request=request)
+            service.collect_transaction_data()
+            service.run_fraud_detection()
+            ip_counts.append(service.features.ip_order_count)
+
+        self.assertEqual(ip_counts, [0, 1, 2])
+        transaction_data = service.transaction_data
+        self.assertEqual(transaction_data.device_info, {'user_agent': 'Browser', 'ip_address': '203.0.113.9'})
+        self.assertEqual(transaction_data.shipping_order_count, 2)
+        self.assertEqual(service.fraud_log.risk_score, 30)
+        self.assertIn('203.0.113.9', service.fraud_log.flag_reasons['reasons'][0])
+
+
+class FraudRingTests(FraudTestMixin, TestCase):
+    def create_shopper(self, username):
+        user = self.create_user(username=username)
+        user.date_joined = timezone.now() - timedelta(days=30)
+        user.save()
+        return user
+
+    def checkout(self, user, shipping, billing=None, ip='198.51.100.7', user_agent='Browser'):
+        """Score a checkout and link it as the on-commit hook would"""
+        request = RequestFactory().post('/checkout/', REMOTE_ADDR=ip, HTTP_USER_AGENT=user_agent)
+        cart = self.create_cart(user, [('20.00', 1)])
+        service = FraudDetectionService(user, cart, 'Lahore', shipping, billing or shipping, request=request)
+        service.collect_transaction_data()
+        with mock.patch('fraud_detection.services.transaction.on_commit', lambda callback: callback()):
+            service.run_fraud_detection()
+        cart.delete()
+        return service
+
+    def test_disjoint_set_unions_by_size(self):
+        from .rings import DisjointSet
+
+        accounts = DisjointSet()
+        accounts.union(1, 2)
+        accounts.union(3, 4)
+        accounts.union(3, 5)
+        root = accounts.union(2, 5)
+
+        self.assertEqual(root, accounts.find(3))
+        self.assertEqual(sorted(accounts.groups()[root]), [1, 2, 3, 4, 5])
+        self.assertEqual(accounts.find(6), 6)
+
+    def test_device_fingerprint_follows_network_prefix(self):
+        from .rings import link_attributes
+
+        home = link_attributes('', '', {'user_agent': 'Browser', 'ip_address': '198.51.100.7'})
+        nearby = link_attributes('', '', {'user_agent': 'Browser', 'ip_address': '198.51.100.99'})
+        elsewhere = link_attributes('', '', {'user_agent': 'Browser', 'ip_address': '203.0.113.7'})
+
+        self.assertEqual(sorted(home.values()), ['device', 'ip'])
+        self.assertTrue(set(home) & set(nearby))
+        self.assertFalse(set(home) & set(elsewhere))
+
+    @override_settings(FRAUD_DETECTION={'SCORING_WORKERS': 0})
+    def test_shared_attributes_merge_clusters(self):
+        from .models import FraudCluster, FraudClusterMember
+
+        first, second, bridge = (self.create_shopper(name) for name in ('first', 'second', 'bridge'))
+        self.checkout(first, '1 Mall Road', ip='198.51.100.1')
+        self.checkout(second, '9 Canal View', ip='203.0.113.1')
+        self.assertEqual(FraudCluster.objects.count(), 2)
+
+        # Ships to the first account's address and bills to the second's
+        service = self.checkout(bridge, '1 mall road', billing='9 Canal View', ip='192.0.2.1')
+        self.assertEqual(service.features.cluster_size, 3)
+
+        cluster = FraudCluster.objects.get()
+        self.assertEqual((cluster.size, cluster.transaction_count), (3, 3))
+        self.assertEqual(FraudClusterMember.objects.filter(cluster=cluster).count(), 3)
+        self.assertEqual(cluster.attributes.filter(kind='address').count(), 2)
+
+    @override_settings(FRAUD_DETECTION={'SCORING_WORKERS': 0})
+    def test_fraud_ring_rule_uses_cluster_flag_rate(self):
+        from .models import FraudCluster
+
+        ring = [self.create_shopper(f'ring{index}') for index in range(3)]
+        # Mismatched locations get the ring's own checkouts flagged
+        for user in ring:
+            request = RequestFactory().post('/checkout/', REMOTE_ADDR='198.51.100.50', HTTP_USER_AGENT='Bot')
+            cart = self.create_cart(user, [('60.00', 5)])
+            service = FraudDetectionService(user, cart, 'Karachi', '7 Drop Lane', '8 Other Lane', request=request)
+            service.collect_transaction_data()
+            with mock.patch('fraud_detection.services.transaction.on_commit', lambda callback: callback()):
+                self.assertTrue(service.run_fraud_detection())
+            cart.delete()
+        self.assertEqual(FraudCluster.objects.get().flag_rate, 1.0)
+
+        # A harmless looking checkout shipping to the ring's drop address
+        newcomer = self.create_shopper('newcomer')
+        service = self.checkout(newcomer, '7 Drop Lane', ip='192.0.2.44')
+
+        self.assertEqual(service.features.cluster_size, 4)
+        self.assertEqual(service.fraud_log.risk_score, 25)
+        self.assertIn('cluster of 4 accounts', service.fraud_log.flag_reasons['reasons'][0])
+        self.assertEqual(service.transaction_data.cluster_flag_rate, 1.0)
+
+    @override_settings(FRAUD_DETECTION={'SCORING_WORKERS': 0})
+    def test_rebuild_matches_incremental_index(self):
+        from io import StringIO
+        from .models import FraudCluster
+
+        users = [self.create_shopper(name) for name in ('a', 'b', 'c', 'd')]
+        self.checkout(users[0], '1 Mall Road', ip='198.51.100.1')
+        self.checkout(users[1], '2 Canal View', ip='198.51.100.1')
+        self.checkout(users[2], '2 canal view', ip='203.0.113.1')
+        self.checkout(users[3], '4 Lone Street', ip='192.0.2.1')
+
+        def snapshot():
+            return sorted((cluster.size, cluster.transaction_count, cluster.flagged_count,
+                           cluster.attributes.count()) for cluster in FraudCluster.objects.all())
+
+        incremental = snapshot()
+        call_command('rebuild_fraud_clusters', stdout=StringIO())
+
+        self.assertEqual(snapshot(), incremental)
+        self.assertEqual([size for size, *_ in incremental], [1, 3])
+
+
+@override_settings(FRAUD_DETECTION={
+    'SCORING_WORKERS': 0,
+    'SHADOW_RULES': {'amount_spike_strict': {'rule': 'amount_spike', 'multiplier': 1.5, 'weight': 40}},
+})
+class ShadowRuleTests(FraudTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.user.date_joined = timezone.now() - timedelta(days=30)
+        self.user.save()
+        Order.objects.create(user=self.user, total_price=Decimal('50.00'))
+
+    def score(self, price='80.00'):
+        cart = self.create_cart(self.user, [(price, 1)])
+        service = FraudDetectionService(self.user, cart, 'Lahore', 'Street 1', 'Street 1')
+        service.collect_transaction_data()
+        with mock.patch('fraud_detection.services.transaction.on_commit', lambda callback: callback()):
+            service.run_fraud_detection()
+        cart.delete()
+        return service
+
+    def test_shadow_rules_kept_out_of_live_plan(self):
+        from .rules import Rule, compile_shadow_rules
+
+        candidate = Rule('candidate', lambda f, t: 'fired', features=['order_total'], weight=10, shadow=True)
+        self.assertNotIn('candidate', [rule.code for rule in compile_plan(rules=[candidate]).rules])
+
+        shadow = compile_shadow_rules()
+        self.assertEqual([(rule.code, rule.replaces) for rule in shadow], [('amount_spike_strict', 'amount_spike')])
+        self.assertEqual(shadow[0].thresholds['multiplier'], 1.5)
+        self.assertNotIn('amount_spike_strict', [rule.code for rule in get_plan().rules])
+
+    def test_shadow_outcome_recorded_without_changing_live_flag(self):
+        from .models import ShadowEvaluation
+
+        service = self.score()
+
+        self.assertFalse(service.fraud_log.is_flagged)
+        evaluation = ShadowEvaluation.objects.get(log=service.fraud_log)
+        self.assertEqual(evaluation.code, 'amount_spike_strict')
+        self.assertTrue(evaluation.fired)
+        self.assertFalse(evaluation.live_flagged)
+        self.assertTrue(evaluation.would_flag)
+
+    @override_settings(FRAUD_DETECTION={
+        'SCORING_WORKERS': 0,
+        'SHADOW_RULES': {'amount_spike_strict': {'rule': 'amount_spike', 'multiplier': 1.5}},
+        'SHADOW_BUDGET_MS': -1,
+        'SHADOW_MAX_OVERRUNS': 1,
+    })
+    def test_rule_suspended_after_overrunning_budget(self):
+        from .models import ShadowEvaluation
+        from .shadow import get_shadow_plan
+
+        first = self.score()
+        second = self.score()
+
+        self.assertTrue(ShadowEvaluation.objects.get(log=first.fraud_log).over_budget)
+        self.assertFalse(ShadowEvaluation.objects.filter(log=second.fraud_log).exists())
+        self.assertEqual(get_shadow_plan().overruns['amount_spike_strict'], 1)
+
+    def test_saturated_pool_drops_shadow_work(self):
+        from .models import ShadowEvaluation
+        from .shadow import get_shadow_plan
+
+        with mock.patch('fraud_detection.shadow.run_in_background', return_value=False):
+            with self.assertLogs('fraud_detection.shadow', 'WARNING') as logs:
+                service = self.score()
+
+        self.assertFalse(ShadowEvaluation.objects.filter(log=service.fraud_log).exists())
+        self.assertEqual(get_shadow_plan().dropped, 1)
+        self.assertIn('1 shadow evaluations dropped', logs.output[0])
+
+    @override_settings(FRAUD_DETECTION={
+        'SCORING_WORKERS': 0,
+        'SHADOW_RULES': {'amount_spike_lenient': {'rule': 'amount_spike', 'multiplier': 10}},
+    })
+    def test_adopted_score_counts_rules_after_short_circuit(self):
+        from .models import ShadowEvaluation
+
+        cart = self.create_cart(self.user, [('60.00', 5)])
+        service = FraudDetectionService(self.user, cart, 'Karachi', 'Street 1', 'Street 1')
+        service.collect_transaction_data()
+        with mock.patch('fraud_detection.services.transaction.on_commit', lambda callback: callback()):
+            service.run_fraud_detection()
+
+        # The live plan stopped at amount_spike and bulk_high_value (50 points) and was
+        # completed with location_mismatch; without amount_spike the score is still over the threshold
+        self.assertEqual(service.fraud_log.risk_score, 70)
+        evaluation = ShadowEvaluation.objects.get(log=service.fraud_log)
+        self.assertFalse(evaluation.fired)
+        self.assertTrue(evaluation.would_flag)
+
+    @override_settings(FRAUD_DETECTION={
+        'SCORING_WORKERS': 0,
+        'SHADOW_RULES': {'amount_spike_lenient': {'rule': 'amount_spike', 'multiplier': 10}},
+    })
+    def test_short_circuited_live_result_reevaluated_without_timings(self):
+        from .models import ShadowEvaluation
+        from .shadow import get_shadow_plan, record_shadow
+
+        cart = self.create_cart(self.user, [('60.00', 5)])
+        service = FraudDetectionService(self.user, cart, 'Karachi', 'Street 1', 'Street 1')
+        service.collect_transaction_data()
+        with mock.patch('fraud_detection.services.transaction.on_commit'):
+            service.run_fraud_detection()
+        live_result = get_plan().evaluate(service.features)
+        self.assertTrue(live_result.short_circuited)
+
+        calls = {row['code']: row['calls'] for row in get_plan().timing_report()}
+        record_shadow(get_shadow_plan(), service.features, service.fraud_log, live_result)
+
+        self.assertEqual({row['code']: row['calls'] for row in get_plan().timing_report()}, calls)
+        self.assertTrue(ShadowEvaluation.objects.get(log=service.fraud_log).would_flag)
+
+    def test_report_compares_live_and_shadow_flag_rates(self):
+        from io import StringIO
+
+        self.score()
+        self.score(price='60.00')
+        output = StringIO()
+        call_command('shadow_rule_report', stdout=output)
+
+        report = output.getvalue()
+        self.assertIn('Shadow rule: amount_spike_strict (replacing amount_spike)', report)
+        self.assertIn('Evaluated: 2', report)
+        self.assertIn('Flag rate: live 0.0%, adopted 50.0% (1 newly flagged, 0 cleared)', report)
+
+
+class SnapshotStub:
+    """Minimal feature snapshot for exercising the rule plan"""
+
+    def __init__(self, **features):
+        defaults = {
+            'order_total': Decimal('100.00'),
+            'user_order_average': Decimal('100.00'),
+            'is_first_purchase': False,
+            'confirmed_location': 'Lahore',
+            'registration_location': 'Lahore',
+            'account_age': timedelta(days=30),
+            'recent_order_count': 0,
+            'ip_order_count': 0,
+            'shipping_order_count': 0,
+            'cluster_size': 1,
+            'cluster_flag_rate': 0.0,
+            'shipping_address': 'Street 1',
+            'billing_address': 'Street 1',
+            'local_hour': 12,
+            'items': [],
+        }
+        defaults.update(features)
+        self.__dict__.update(defaults)
+
+
+class EvaluationPlanTests(SimpleTestCase):
+    def test_rules_ordered_by_weight(self):
+        weights = [rule.weight for rule in compile_plan(config={}).rules]
+        self.assertEqual(weights, sorted(weights, reverse=True))
+
+    def test_rules_with_missing_inputs_are_skipped(self):
+        plan = compile_plan(config={})
+        result = plan.evaluate(SnapshotStub(recent_order_count=None, local_hour=None))
+
+        self.assertIn('order_frequency', result.skipped)
+        self.assertIn('unusual_hour', result.skipped)
+        self.assertNotIn('order_frequency', result.timings)
+
+    def test_short_circuits_once_threshold_reached(self):
+        snapshot = SnapshotStub(
+            account_age=timedelta(hours=1),
+            order_total=Decimal('500.00'),
+            confirmed_location='Karachi',
+        )
+        result = compile_plan(config={}).evaluate(snapshot)
+        self.assertTrue(result.is_flagged)
+        self.assertTrue(result.short_circuited)
+        self.assertEqual(result.score, 55)
+
+        result = compile_plan(config={'SHORT_CIRCUIT': False}).evaluate(snapshot)
+        self.assertFalse(result.short_circuited)
+        # The location mismatch also contributes when every rule is evaluated
+        self.assertEqual(result.score, 75)
+
+    def test_complete_evaluates_rules_after_the_cutoff(self):
+        snapshot = SnapshotStub(
+            account_age=timedelta(hours=1),
+            order_total=Decimal('500.00'),
+            confirmed_location='Karachi',
+        )
+        plan = compile_plan(config={})
+        result = plan.complete(plan.evaluate(snapshot), snapshot)
+
+        self.assertFalse(result.short_circuited)
+        self.assertEqual(result.score, 75)
+        self.assertIn('location_mismatch', [hit.code for hit in result.hits])
+
+    def test_settings_override_weights_and_thresholds(self):
+        config = {
+            'FLAG_THRESHOLD': 10,
+            'RULES': {
+                'location_mismatch': {'enabled': False},
+                'order_frequency': {'weight': 12, 'min_previous_orders': 1},
+            },
+        }
+        plan = compile_plan(config=config)
+        self.assertNotIn('location_mismatch', [rule.code for rule in plan.rules])
+
+        result = plan.evaluate(SnapshotStub(recent_order_count=1, confirmed_location='Karachi'))
+        self.assertEqual(result.score, 12)
+        self.assertTrue(result.is_flagged)
+
+    def test_timings_recorded_per_rule(self):
+        plan = compile_plan(config={'SHORT_CIRCUIT': False})
+        plan.evaluate(SnapshotStub())
+
+        report = plan.timing_report()
+        self.assertEqual(len(report), len(plan.rules))
+        self.assertTrue(all(row['calls'] == 1 for row in report))
+
+    @override_settings(FRAUD_DETECTION={'FLAG_THRESHOLD': 5})
+    def test_plan_recompiled_when_settings_change(self):
+        self.assertEqual(get_plan().flag_threshold, 5)
+
+
+class CheckoutQueryBudgetTests(FraudTestMixin, TestCase):
+    # Upper bound on round trips for a whole checkout POST, including session,
+    # auth, cart, fraud scoring, order creation, one guarded stock update per
+    # product (plus the hold rows for flagged orders), the order's outbox
+    # event, cart clearing and resetting its stored totals, and claiming and
+    # completing the idempotency key (an insert in a savepoint and an update)
+    MAX_CHECKOUT_QUERIES = 28
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.user.date_joined = timezone.now() - timedelta(days=30)
+        self.user.save()
+        # A returning customer, so the fraud profile already exists
+        Order.objects.create(user=self.user, total_price=Decimal('50.00'))
+        # Today's counter row exists, as it does after the day's first checkout
+        FraudDailyCounter.objects.create(day=timezone.localdate())
+        self.client.force_login(self.user)
+
+    def checkout(self, location='Lahore'):
+        # Submitted the way the checkout form does, idempotency key included
+        return self.client.post(reverse('checkout'), {
+            'confirmed_location': location,
+            'shipping_address': 'Street 1',
+            'billing_address': 'Street 1',
+            'idempotency_key': str(uuid.uuid4()),
+        })
+
+    def test_checkout_query_budget(self):
+        self.create_cart(self.user, [('20.00', 1), ('30.00', 2), ('40.00', 1)])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.checkout()
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Order.objects.filter(status='Pending').count(), 2)
+        self.assertLessEqual(len(queries), self.MAX_CHECKOUT_QUERIES)
+
+    def test_flagged_checkout_query_budget(self):
+        self.create_cart(self.user, [('60.00', 5), ('30.00', 2), ('40.00', 1)])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.checkout(location='Karachi')
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(FraudConfirmation.objects.count(), 1)
+        self.assertLessEqual(len(queries), self.MAX_CHECKOUT_QUERIES)
+
+
+@override_settings(FRAUD_DETECTION={'ASYNC_SCORING': True, 'SCORING_WORKERS': 0})
+class AsyncScoringTests(FraudTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.user.date_joined = timezone.now() - timedelta(days=30)
+        self.user.save()
+        self.client.force_login(self.user)
+
+    def checkout(self, location='Lahore'):
+        return self.client.post(reverse('checkout'), {
+            'confirmed_location': location,
+            'shipping_address': 'Street 1',
+            'billing_address': 'Street 1',
+        })
+
+    def test_checkout_returns_before_scoring(self):
+        cart = self.create_cart(self.user, [('20.00', 2)])
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.checkout()
+
+        order = Order.objects.get()
+        self.assertRedirects(response, reverse('order_detail', args=[order.id]))
+        self.assertEqual(order.status, 'Scoring')
+        self.assertEqual(order.items.count(), 1)
+        self.assertFalse(cart.items.exists())
+        self.assertFalse(TransactionData.objects.exists())
+        self.assertEqual(len(callbacks), 1)
+
+        status = self.client.get(reverse('order_status', args=[order.id])).json()
+        self.assertTrue(status['is_scoring'])
+        self.assertIsNone(status['redirect_url'])
+
+    def test_clean_order_released_to_pending(self):
+        cart = self.create_cart(self.user, [('20.00', 2)])
+        product = cart.items.get().product
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.checkout()
+
+        order = Order.objects.get()
+        self.assertEqual(order.status, 'Pending')
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 98)
+        self.assertFalse(FraudDetectionLog.objects.get().is_flagged)
+
+        status = self.client.get(reverse('order_status', args=[order.id])).json()
+        self.assertEqual(status['redirect_url'], reverse('order_detail', args=[order.id]))
+
+    def test_flagged_order_moves_to_verification(self):
+        self.create_cart(self.user, [('60.00', 5)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.checkout(location='Karachi')
+
+        # The confirmation holds the checkout's order rather than a second one
+        order = Order.objects.get()
+        self.assertEqual(order.status, 'Verification')
+        confirmation = FraudConfirmation.objects.get()
+        self.assertEqual(confirmation.order, order)
+
+        status = self.client.get(reverse('order_status', args=[order.id])).json()
+        self.assertEqual(status['redirect_url'], reverse('verification_required', args=[confirmation.confirmation_key]))
+
+    def test_order_cancelled_during_scoring_stays_cancelled(self):
+        self.create_cart(self.user, [('20.00', 2)])
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.checkout()
+        order = Order.objects.get()
+        transition(Order.objects.filter(pk=order.pk), 'Cancelled')
+        callbacks[0]()
+
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'Cancelled')
+        self.assertEqual(order.items.get().product.stock, 100)
+
+    def test_status_endpoint_limited_to_owner(self):
+        order = Order.objects.create(user=self.create_user(username='other'), total_price=Decimal('5.00'))
+        response = self.client.get(reverse('order_status', args=[order.id]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_saturated_pool_refuses_work(self):
+        import threading
+        from .pipeline import ScoringPool
+
+        release = threading.Event()
+        pool = ScoringPool(workers=1, queue_size=1)
+        try:
+            self.assertTrue(pool.submit(release.wait))
+            self.assertTrue(pool.submit(release.wait))
+            self.assertFalse(pool.submit(release.wait))
+        finally:
+            release.set()
+            pool.executor.shutdown(wait=True)
+
+
+class ExportTransactionDataTests(FraudTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.user.date_joined = timezone.now() - timedelta(days=30)
+        self.user.save()
+        staff = self.create_user(username='staff', is_staff=True)
+        self.client.force_login(staff)
+
+    def score(self, items, location='Lahore'):
+        cart = self.create_cart(self.user, items)
+        service = FraudDetectionService(self.user, cart, location, 'Street 1', 'Street 1')
+        service.collect_transaction_data()
+        if service.run_fraud_detection():
+            service.create_fraud_confirmation()
+        cart.delete()
+        return service.transaction_data
+
+    def export(self, **params):
+        response = self.client.get(reverse('export_transaction_data'), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode().splitlines()
+
+    def test_rows_joined_in_one_query(self):
+        for index in range(5):
+            self.score([('60.00', 5)] if index % 2 else [('20.00', 1)], location='Karachi' if index % 2 else 'Lahore')
+
+        with CaptureQueriesContext(connection) as queries:
+            lines = self.export()
+
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[1].split(',')[-2], '')
+        self.assertEqual(lines[2].split(',')[-2], 'False')
+        # Session, user and the single transaction query, regardless of row count
+        self.assertLessEqual(len(queries), 3)
+
+    def test_date_filters(self):
+        self.score([('20.00', 1)])
+        tomorrow = (timezone.now() + timedelta(days=1)).date().isoformat()
+
+        self.assertEqual(len(self.export(until=tomorrow)), 2)
+        self.assertEqual(len(self.export(since=tomorrow)), 1)
+        response = self.client.get(reverse('export_transaction_data'), {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_incremental_export_advances_watermark(self):
+        first = self.score([('20.00', 1)])
+        self.assertEqual(len(self.export(incremental='training')), 2)
+        self.assertEqual(ExportWatermark.objects.get(name='training').last_transaction_id, first.id)
+
+        self.assertEqual(len(self.export(incremental='training')), 1)
+
+        second = self.score([('25.00', 1)])
+        lines = self.export(incremental='training')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith(f'{second.id},'))
+
+
+@skipUnless(importlib.util.find_spec('pyarrow'), "PyArrow is not installed")
+class ExportTrainingDataTests(FraudTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        import shutil
+        import tempfile
+        self.user = self.create_user()
+        self.user.date_joined = timezone.now() - timedelta(days=30)
+        self.user.save()
+        self.output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output, True)
+
+    def score(self, items, days_ago=0, location='Lahore'):
+        cart = self.create_cart(self.user, items)
+        service = FraudDetectionService(self.user, cart, location, 'Street 1', 'Street 1')
+        service.collect_transaction_data()
+        service.run_fraud_detection()
+        cart.delete()
+        TransactionData.objects.filter(pk=service.transaction_data.pk).update(
+            transaction_time=timezone.now() - timedelta(days=days_ago)
+        )
+        return service.transaction_data
+
+    def export(self):
+        from io import StringIO
+        out = StringIO()
+        call_command('export_training_data', '--output', self.output, stdout=out)
+        return out.getvalue()
+
+    def test_writes_typed_partitions_for_complete_days(self):
+        import pyarrow.parquet as pq
+
+        self.score([('20.00', 1)], days_ago=2)
+        self.score([('60.00', 5)], days_ago=1, location='Karachi')
+        self.score([('25.00', 1)], days_ago=0)
+
+        self.assertIn('Wrote 2 partition(s), 2 rows', self.export())
+        table = pq.read_table(self.output)
+        self.assertEqual(table.num_rows, 2)
+        self.assertEqual(str(table.schema.field('order_total').type), 'double')
+        self.assertEqual(str(table.schema.field('is_flagged').type), 'bool')
+        self.assertEqual(sorted(table.column('is_flagged').to_pylist()), [False, True])
+        # Numeric columns load straight into NumPy
+        self.assertEqual(table.column('order_total').to_numpy().dtype.name, 'float64')
+
+    def test_only_new_partitions_are_appended(self):
+        import os
+
+        self.score([('20.00', 1)], days_ago=2)
+        self.export()
+        first = sorted(os.listdir(self.output))
+
+        self.score([('30.00', 1)], days_ago=1)
+        self.assertIn('Wrote 1 partition(s), 1 rows', self.export())
+        self.assertEqual(len(os.listdir(self.output)), len(first) + 1)
+        self.assertIn('Wrote 0 partition(s)', self.export())
@@ -0,0 +1,212 @@
+"""
+Sliding-window velocity counters for fraud detection
+
+Counts events (checkouts) per user, IP address and shipping address in
+hourly buckets so rules can ask "how many in the last N hours" without
+querying the order table. Two backends are provided:
+
+- CacheVelocityBackend stores one key per (dimension, value, hour) in a
+  Django cache; keys expire once they fall out of the window, so the keys
+  for one counter form a ring of hourly buckets. The cache must be shared
+  by all workers (Redis or Memcached), as with a local-memory cache each
+  worker would count only its own checkouts. Outside DEBUG and test runs
+  (the TESTING setting) such a cache fails the fraud_detection.W001 system
+  check, and the counts are reported as unavailable instead.
+- LocalVelocityBackend keeps real in-process ring buffers and is meant for
+  tests and single-process development.
+
+Configure with the FRAUD_DETECTION setting::
+
+    FRAUD_DETECTION = {
+        'VELOCITY_BACKEND': 'cache',   # or 'local'
+        'VELOCITY_CACHE': 'default',
+        'VELOCITY_WINDOW_HOURS': 48,
+    }
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+import hashlib
+import re
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+BUCKET_SECONDS = 3600
+DEFAULT_WINDOW_HOURS = 48
+
+DIMENSION_USER = 'user'
+DIMENSION_IP = 'ip'
+DIMENSION_SHIPPING = 'shipping'
+
+
+def hour_bucket(when=None):
+    """Absolute hour number for a timestamp"""
+    when = when or timezone.now()
+    return int(when.timestamp()) // BUCKET_SECONDS
+
+
+def normalize_address(address):
+    """Hash an address so formatting differences map to the same counter"""
+    normalized = re.sub(r'[^a-z0-9]+', ' ', (address or '').lower()).strip()
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+class LocalVelocityBackend:
+    """In-process ring buffers of hourly buckets"""
+
+    def __init__(self, window_hours=DEFAULT_WINDOW_HOURS):
+        self.window_hours = window_hours
+        self._rings = {}
+        self._lock = threading.Lock()
+
+    def increment(self, key, hour, amount=1):
+        with self._lock:
+            hours, counts = self._rings.setdefault(key, ([None] * self.window_hours, [0] * self.window_hours))
+            slot = hour % self.window_hours
+            if hours[slot] != hour:
+                # Slot still holds an expired hour; recycle it
+                hours[slot] = hour
+                counts[slot] = 0
+            counts[slot] += amount
+
+    def count(self, key, hour, hours_back):
+        ring = self._rings.get(key)
+        if ring is None:
+            return 0
+        hours, counts = ring
+        oldest = hour - min(hours_back, self.window_hours) + 1
+        with self._lock:
+            return sum(count for bucket, count in zip(hours, counts) if bucket is not None and oldest <= bucket <= hour)
+
+    def clear(self):
+        with self._lock:
+            self._rings.clear()
+
+
+class CacheVelocityBackend:
+    """Hourly buckets stored as expiring integer keys in a Django cache"""
+
+    def __init__(self, cache_alias='default', window_hours=DEFAULT_WINDOW_HOURS, prefix='fraud:velocity'):
+        self.cache = caches[cache_alias]
+        self.window_hours = window_hours
+        self.prefix = prefix
+
+    def _key(self, key, hour):
+        return f"{self.prefix}:{key}:{hour}"
+
+    def increment(self, key, hour, amount=1):
+        bucket_key = self._key(key, hour)
+        # Bucket lives until it leaves the window (plus the partial current hour)
+        timeout = (self.window_hours + 1) * BUCKET_SECONDS
+        if not self.cache.add(bucket_key, amount, timeout):
+            try:
+                self.cache.incr(bucket_key, amount)
+            except ValueError:
+                # Expired between add and incr
+                self.cache.set(bucket_key, amount, timeout)
+
+    def count(self, key, hour, hours_back):
+        hours_back = min(hours_back, self.window_hours)
+        keys = [self._key(key, hour - offset) for offset in range(hours_back)]
+        return sum(self.cache.get_many(keys).values())
+
+    def clear(self):
+        """Cache keys expire on their own; nothing to do"""
+
+
+class VelocityCounter:
+    """Record and count events per (dimension, value) over sliding windows"""
+
+    def __init__(self, backend):
+        # None when no usable backend is configured; every count is then unavailable
+        self.backend = backend
+
+    @staticmethod
+    def _key(dimension, value):
+        return f"{dimension}:{value}"
+
+    def record(self, dimension, value, when=None, amount=1):
+        if value in (None, '') or self.backend is None:
+            return
+        try:
+            self.backend.increment(self._key(dimension, value), hour_bucket(when), amount)
+        except Exception as e:
+            # An unavailable cache must never block checkout
+            logger.warning(f"Could not record {dimension} velocity: {str(e)}")
+
+    def count(self, dimension, value, hours=24, when=None):
+        """
+        Events recorded for the value in the last N hours, including the
+        current one. Returns None if the value is empty or the backend fails,
+        so rules reading the count are skipped rather than fed a zero.
+        """
+        if value in (None, '') or self.backend is None:
+            return None
+        try:
+            return self.backend.count(self._key(dimension, value), hour_bucket(when), hours)
+        except Exception as e:
+            logger.warning(f"Could not read {dimension} velocity: {str(e)}")
+            return None
+
+    def checkout_counts(self, user_id, ip_address, shipping_address, hours=24, when=None):
+        """Previous checkouts per dimension within the window"""
+        return {
+            DIMENSION_USER: self.count(DIMENSION_USER, user_id, hours, when),
+            DIMENSION_IP: self.count(DIMENSION_IP, ip_address, hours, when),
+            DIMENSION_SHIPPING: self.count(
+                DIMENSION_SHIPPING, normalize_address(shipping_address), hours, when
+            ) if shipping_address else None,
+        }
+
+
+def velocity_cache_problem():
+    """Why the configured velocity cache cannot be used, or None if it can"""
+    config = getattr(settings, 'FRAUD_DETECTION', {})
+    if config.get('VELOCITY_BACKEND', 'cache') == 'local':
+        return None
+    cache_alias = config.get('VELOCITY_CACHE', 'default')
+    if isinstance(caches[cache_alias], LocMemCache) and not (settings.DEBUG or getattr(settings, 'TESTING', False)):
+        return (
+            f"VELOCITY_CACHE '{cache_alias}' is a per-process local-memory cache, "
+            "so each worker would only count its own checkouts"
+        )
+    return None
+
+
+_counter = None
+_counter_lock = threading.Lock()
+
+
+def get_velocity_counter():
+    """Return the process-wide counter configured in settings"""
+    global _counter
+    if _counter is None:
+        with _counter_lock:
+            if _counter is None:
+                config = getattr(settings, 'FRAUD_DETECTION', {})
+                window_hours = config.get('VELOCITY_WINDOW_HOURS', DEFAULT_WINDOW_HOURS)
+                if config.get('VELOCITY_BACKEND', 'cache') == 'local':
+                    backend = LocalVelocityBackend(window_hours)
+                else:
+                    problem = velocity_cache_problem()
+                    if problem:
+                        # Like any other counter failure this must never block checkout
+                        logger.error(f"{problem}; velocity counts are unavailable")
+                        backend = None
+                    else:
+                        backend = CacheVelocityBackend(config.get('VELOCITY_CACHE', 'default'), window_hours)
+                _counter = VelocityCounter(backend)
+    return _counter
+
+
+@receiver(setting_changed)
+def reset_velocity_counter(sender=None, setting='FRAUD_DETECTION', **kwargs):
+    """Rebuild the counter when settings change (e.g. in tests)"""
+    global _counter
+    if setting in ('FRAUD_DETECTION', 'CACHES', 'DEBUG', 'TESTING'):
+        _counter = None
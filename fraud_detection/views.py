@@ -2,15 +2,20 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.utils import timezone
-from django.http import HttpResponse
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
+from django.db import transaction
 from django.db.models import Count
 from django.views.decorators.http import require_GET, require_POST
 from django.urls import reverse
-import csv
+from datetime import datetime
 import uuid
 
-from .models import TransactionData, FraudDetectionLog, FraudConfirmation
+from .models import FraudDetectionLog, FraudConfirmation
+from .exports import export_queryset, get_watermark, stream_csv
+from .services import daily_counter_totals, flag_reason_breakdown
+from orders.inventory import InsufficientStock, convert_holds, reserve_stock
 from orders.models import Order, OrderItem
+from orders.state_machine import transition
 from cart.models import Cart, CartItem
 
 def is_staff(user):
@@ -42,51 +47,77 @@ def confirm_transaction(request, confirmation_key):
         FraudConfirmation, 
         confirmation_key=confirmation_key, 
         transaction__user=request.user,
-        is_confirmed=False
+        is_confirmed=False,
+        status='pending'
     )
     
     if confirmation.is_expired:
         messages.error(request, "This confirmation link has expired. Please try your purchase again.")
         return redirect('home')
     
-    # Mark as confirmed
-    confirmation.is_confirmed = True
-    confirmation.save()
+    order_id = confirmation.cart_snapshot.get('order_id')
+    with transaction.atomic():
+        # Lock the confirmation, then its order, in the order the expiry sweeper does
+        if not FraudConfirmation.objects.select_for_update().filter(pk=confirmation.pk, status='pending').exists():
+            messages.error(request, "This confirmation link has expired. Please try your purchase again.")
+            return redirect('home')
+        order = Order.objects.select_for_update().filter(id=order_id).first() if order_id else None
+        if order is not None and order.status != 'Verification':
+            # Cancelled by the sweeper or by staff while the link was open
+            messages.error(request, "This order is no longer awaiting confirmation.")
+            return redirect('order_history')
+        
+        if order is not None:
+            try:
+                with transaction.atomic():
+                    # Keep the stock held since checkout, reserving anything released meanwhile
+                    convert_holds(order, order.items.all())
+                    transition(Order.objects.filter(pk=order.pk), 'Processing')
+            except InsufficientStock as e:
+                # Cancelling releases whatever is still held for the order; the hold
+                # ends unconfirmed, so it is not counted as a confirmation
+                transition(Order.objects.filter(pk=order.pk), 'Cancelled')
+                confirmation.status = 'expired'
+                confirmation.save()
+                messages.error(request, f"{e}. Your order has been cancelled.")
+                return redirect('order_history')
+        
+        # Mark as confirmed
+        confirmation.is_confirmed = True
+        confirmation.status = 'confirmed'
+        confirmation.save()
     
-    # Update the order status if it exists in the cart snapshot
-    try:
-        order_id = confirmation.cart_snapshot.get('order_id')
-        if order_id:
-            order = Order.objects.get(id=order_id)
-            order.status = 'Processing'  # Update from Verification to Processing
-            order.save()
-            
-            # Now we can redirect to the order detail page
-            messages.success(request, "Thank you for confirming your transaction! Your order has been processed.")
-            return redirect('order_detail', order_id=order.id)
-    except (KeyError, Order.DoesNotExist):
+    if order is not None:
+        messages.success(request, "Thank you for confirming your transaction! Your order has been processed.")
+        return redirect('order_detail', order_id=order.id)
+    
+    if order_id:
         # If order doesn't exist for some reason, we'll create it
         try:
-            # Process the order
-            order = Order.objects.create(
-                user=request.user,
-                total_price=float(confirmation.cart_snapshot['total']),
-                status='Processing'  # Set to Processing since it's confirmed
-            )
-            
-            # Create order items from cart snapshot
-            for item_data in confirmation.cart_snapshot['items']:
-                OrderItem.objects.create(
-                    order=order,
-                    product_name=item_data['product_name'],
-                    product_price=float(item_data['price']),
-                    quantity=item_data['quantity'],
-                    product_id=item_data['product_id']
+            with transaction.atomic():
+                # Process the order
+                order = Order.objects.create(
+                    user=request.user,
+                    total_price=float(confirmation.cart_snapshot['total']),
+                    status='Processing'  # Set to Processing since it's confirmed
                 )
+                
+                # Create order items from cart snapshot
+                items = OrderItem.objects.bulk_create([
+                    OrderItem(
+                        order=order,
+                        product_name=item_data['product_name'],
+                        product_price=float(item_data['price']),
+                        quantity=item_data['quantity'],
+                        product_id=item_data['product_id']
+                    )
+                    for item_data in confirmation.cart_snapshot['items']
+                ])
+                reserve_stock(items)
             
             # Clear the cart
             cart = Cart.objects.get(user=request.user)
-            cart.items.all().delete()
+            cart.clear()
             
             messages.success(request, "Thank you for confirming your transaction! Your order has been placed.")
             return redirect('order_detail', order_id=order.id)
@@ -103,32 +134,29 @@ def fraud_dashboard(request):
     # Recent flagged transactions
     recent_flagged = FraudDetectionLog.objects.filter(is_flagged=True).order_by('-detection_time')[:10]
     
-    # Pending confirmations
+    # Pending confirmations, read through the (status, expiry_time) index
+    now = timezone.now()
     pending_confirmations = FraudConfirmation.objects.filter(
-        is_confirmed=False,
-        expiry_time__gt=timezone.now()
-    ).order_by('expiry_time')[:10]
-    
-    # Summary statistics
-    total_transactions = TransactionData.objects.count()
-    flagged_count = FraudDetectionLog.objects.filter(is_flagged=True).count()
-    confirmed_count = FraudConfirmation.objects.filter(is_confirmed=True).count()
-    expired_count = FraudConfirmation.objects.filter(
-        is_confirmed=False, 
-        expiry_time__lt=timezone.now()
+        status='pending',
+        expiry_time__gt=now
+    ).select_related('transaction__user').order_by('expiry_time')[:10]
+    
+    # Summary statistics from the per-day counters
+    counters = daily_counter_totals()
+    total_transactions = counters['total']
+    flagged_count = counters['flagged']
+    confirmed_count = counters['confirmed']
+    # Swept holds plus any that lapsed since the sweeper last ran
+    expired_count = counters['expired'] + FraudConfirmation.objects.filter(
+        status='pending', expiry_time__lt=now
     ).count()
     
     flagged_percent = (flagged_count / total_transactions * 100) if total_transactions > 0 else 0
     
-    # Flag reason breakdown
-    all_flagged = FraudDetectionLog.objects.filter(is_flagged=True)
-    reason_counts = {}
-    
-    for log in all_flagged:
-        if 'reasons' in log.flag_reasons:
-            for reason in log.flag_reasons['reasons']:
-                key = reason.split(':')[0] if ':' in reason else reason
-                reason_counts[key] = reason_counts.get(key, 0) + 1
+    # Flag reason breakdown, optionally limited to the last N days
+    days = request.GET.get('days')
+    since = timezone.now() - timezone.timedelta(days=int(days)) if days and days.isdigit() else None
+    reason_counts = {row['reason']: row['count'] for row in flag_reason_breakdown(since=since)}
     
     context = {
         'recent_flagged': recent_flagged,
@@ -145,60 +173,28 @@ def fraud_dashboard(request):
 
 @user_passes_test(is_staff)
 def export_transaction_data(request):
-    """Export transaction data as CSV for future model training."""
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="transaction_data.csv"'
-    
-    writer = csv.writer(response)
-    writer.writerow([
-        'Transaction ID',
-        'User ID',
-        'Order Total',
-        'Location Match',
-        'Is First Purchase',
-        'Account Age (days)',
-        'Transaction Hour',
-        'Address Match',
-        'Risk Score',
-        'Is Flagged',
-        'Was Confirmed',
-        'Timestamp'
-    ])
-    
-    # Get all transactions with related data
-    transactions = TransactionData.objects.select_related('fraud_log').all()
-    
-    for transaction in transactions:
-        # Try to get related confirmation
-        try:
-            confirmation = transaction.confirmation
-            was_confirmed = confirmation.is_confirmed
-        except FraudConfirmation.DoesNotExist:
-            was_confirmed = None
-        
-        # Calculate location and address match
-        location_match = transaction.confirmed_location == transaction.registration_location
-        address_match = transaction.shipping_address == transaction.billing_address
-        
-        # Calculate account age
-        account_age = (transaction.transaction_time - transaction.user.date_joined).days
-        
-        # Transaction hour
-        transaction_hour = transaction.transaction_time.hour
-        
-        writer.writerow([
-            transaction.id,
-            transaction.user_id,
-            transaction.order_total,
-            location_match,
-            transaction.is_first_purchase,
-            account_age,
-            transaction_hour,
-            address_match,
-            transaction.fraud_log.risk_score if hasattr(transaction, 'fraud_log') else None,
-            transaction.fraud_log.is_flagged if hasattr(transaction, 'fraud_log') else None,
-            was_confirmed,
-            transaction.transaction_time.strftime('%Y-%m-%d %H:%M:%S')
-        ])
+    """
+    Stream transaction data as CSV for future model training.
+    
+    Optional query parameters: ``since`` and ``until`` (YYYY-MM-DD) limit the
+    date range; ``incremental=<name>`` exports only transactions added since
+    the last complete export under that name and then advances its watermark.
+    """
+    since = request.GET.get('since')
+    until = request.GET.get('until')
+    watermark = request.GET.get('incremental')
+    try:
+        since = datetime.strptime(since, '%Y-%m-%d').date() if since else None
+        until = datetime.strptime(until, '%Y-%m-%d').date() if until else None
+    except ValueError:
+        return HttpResponseBadRequest("Dates must be in YYYY-MM-DD format")
+    
+    queryset = export_queryset(
+        since=since,
+        until=until,
+        after_id=get_watermark(watermark) if watermark else None
+    )
     
+    response = StreamingHttpResponse(stream_csv(queryset, watermark=watermark), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="transaction_data.csv"'
     return response
@@ -1,20 +1,27 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.utils.html import format_html
-from .models import Order, OrderItem
+from .models import ArchivedOrder, ArchivedOrderItem, CheckoutAttempt, Order, OrderEvent, OrderItem, StockHold
+from .state_machine import transition
 
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
     readonly_fields = ['product_name', 'product_price', 'quantity', 'subtotal']
     extra = 0
+
+class StockHoldInline(admin.TabularInline):
+    model = StockHold
+    readonly_fields = ['product', 'quantity', 'expires_at', 'created_at']
+    extra = 0
     
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     list_display = ['id', 'user', 'order_date', 'status', 'status_badge', 'total_price', 'updated_at']
     list_filter = ['status', 'order_date']
     search_fields = ['user__username', 'id']
-    readonly_fields = ['order_date', 'total_price']
-    inlines = [OrderItemInline]
-    list_editable = ['status']  # Now status is included in list_display
+    # Status only changes through the actions below, which follow the state machine
+    readonly_fields = ['order_date', 'total_price', 'status']
+    inlines = [OrderItemInline, StockHoldInline]
+    ordering = ['-order_date']
     actions = ['mark_as_processing', 'mark_as_accepted', 'mark_as_shipped', 'mark_as_delivered', 'mark_as_completed', 'mark_as_cancelled']
     
     def status_badge(self, obj):
@@ -33,32 +40,80 @@ class OrderAdmin(admin.ModelAdmin):
     
     status_badge.short_description = 'Status'
     
+    def _set_status(self, request, queryset, status):
+        """Move the selected orders through the state machine in one batch and report the outcome"""
+        selected = queryset.count()
+        moved = len(transition(queryset, status))
+        if moved:
+            self.message_user(request, f"{moved} order(s) marked as {status}.", messages.SUCCESS)
+        if moved < selected:
+            self.message_user(
+                request,
+                f"{selected - moved} order(s) skipped: they cannot move to {status} from their current status.",
+                messages.WARNING,
+            )
+    
     def mark_as_processing(self, request, queryset):
-        queryset.update(status='Processing')
+        self._set_status(request, queryset, 'Processing')
     mark_as_processing.short_description = "Mark selected orders as Processing"
     
     def mark_as_accepted(self, request, queryset):
-        queryset.update(status='Accepted')
+        self._set_status(request, queryset, 'Accepted')
     mark_as_accepted.short_description = "Mark selected orders as Accepted"
     
     def mark_as_shipped(self, request, queryset):
-        queryset.update(status='Shipped')
+        self._set_status(request, queryset, 'Shipped')
     mark_as_shipped.short_description = "Mark selected orders as Shipped"
     
     def mark_as_delivered(self, request, queryset):
-        queryset.update(status='Delivered')
+        self._set_status(request, queryset, 'Delivered')
     mark_as_delivered.short_description = "Mark selected orders as Delivered"
     
     def mark_as_completed(self, request, queryset):
-        queryset.update(status='Completed')
+        self._set_status(request, queryset, 'Completed')
     mark_as_completed.short_description = "Mark selected orders as Completed"
     
     def mark_as_cancelled(self, request, queryset):
-        queryset.update(status='Cancelled')
+        self._set_status(request, queryset, 'Cancelled')
     mark_as_cancelled.short_description = "Mark selected orders as Cancelled"
 
+class ArchivedOrderItemInline(admin.TabularInline):
+    model = ArchivedOrderItem
+    readonly_fields = ['product_name', 'product_price', 'quantity', 'subtotal']
+    extra = 0
+
+@admin.register(ArchivedOrder)
+class ArchivedOrderAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'order_date', 'status', 'total_price', 'archived_at']
+    list_filter = ['status']
+    search_fields = ['user__username', 'id']
+    ordering = ['-order_date']
+    inlines = [ArchivedOrderItemInline]
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
 @admin.register(OrderItem)
 class OrderItemAdmin(admin.ModelAdmin):
     list_display = ['order', 'product_name', 'product_price', 'quantity', 'subtotal']
     list_filter = ['order__status']
     search_fields = ['product_name']
+
+@admin.register(StockHold)
+class StockHoldAdmin(admin.ModelAdmin):
+    list_display = ['order', 'product', 'quantity', 'expires_at', 'created_at']
+    list_filter = ['expires_at']
+    raw_id_fields = ['order', 'product']
+
+@admin.register(CheckoutAttempt)
+class CheckoutAttemptAdmin(admin.ModelAdmin):
+    list_display = ['key', 'user', 'order', 'created_at', 'expires_at']
+    list_filter = ['expires_at']
+    search_fields = ['key', 'user__username']
+    raw_id_fields = ['user', 'order']
+
+@admin.register(OrderEvent)
+class OrderEventAdmin(admin.ModelAdmin):
+    list_display = ['id', 'order', 'previous_status', 'status', 'total_price', 'created_at']
+    list_filter = ['status']
+    raw_id_fields = ['order']
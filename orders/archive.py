@@ -0,0 +1,81 @@
+"""
+Archival of finished orders
+
+Completed and cancelled orders placed before the archive horizon are moved,
+with their items, from Order / OrderItem into ArchivedOrder /
+ArchivedOrderItem, keeping their ids. The hot tables then only hold recent
+and unfinished orders, and Order.objects.in_range() reads the archive only
+for date ranges that reach it.
+
+    ORDER_ARCHIVE = {
+        'AFTER_DAYS': 365,   # archive finished orders placed longer ago than this
+    }
+
+Orders whose outbox events have not been applied to analytics yet are left
+for a later run.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from datetime import timedelta
+
+from .models import ArchivedOrder, ArchivedOrderItem, Order, OrderEvent, OrderItem
+
+DEFAULT_ARCHIVE_AFTER_DAYS = 365
+
+# Orders in these statuses no longer change and can be archived
+ARCHIVED_STATUSES = ('Completed', 'Cancelled')
+
+
+def archive_horizon(now=None, days=None):
+    """Finished orders placed before this are archived"""
+    if days is None:
+        days = getattr(settings, 'ORDER_ARCHIVE', {}).get('AFTER_DAYS', DEFAULT_ARCHIVE_AFTER_DAYS)
+    return (now or timezone.now()) - timedelta(days=days)
+
+
+def archive_orders(batch_size=500, before=None):
+    """
+    Move one batch of finished orders placed before `before` (default: the
+    archive horizon) to the archive tables. Orders locked by a concurrent run
+    are skipped. Returns the number of orders archived.
+    """
+    before = before or archive_horizon()
+    with transaction.atomic():
+        orders = list(
+            Order.objects.select_for_update(skip_locked=True)
+            .filter(status__in=ARCHIVED_STATUSES, order_date__lt=before)
+            .exclude(Exists(OrderEvent.objects.filter(order=OuterRef('pk'))))
+            .order_by('order_date', 'id')[:batch_size]
+        )
+        if not orders:
+            return 0
+
+        order_ids = [order.id for order in orders]
+        ArchivedOrder.objects.bulk_create([
+            ArchivedOrder(
+                id=order.id,
+                user_id=order.user_id,
+                order_date=order.order_date,
+                status=order.status,
+                total_price=order.total_price,
+                updated_at=order.updated_at,
+            )
+            for order in orders
+        ])
+        ArchivedOrderItem.objects.bulk_create([
+            ArchivedOrderItem(
+                id=item.id,
+                order_id=item.order_id,
+                product_name=item.product_name,
+                product_price=item.product_price,
+                quantity=item.quantity,
+                product_id=item.product_id,
+            )
+            for item in OrderItem.objects.filter(order_id__in=order_ids)
+        ])
+
+        # Removes the items too; holds, confirmations and checkout attempts let go of the order
+        Order.objects.filter(id__in=order_ids).delete()
+    return len(orders)
@@ -0,0 +1,80 @@
+"""
+Idempotency keys for checkout submissions
+
+The checkout form carries a random key. The first POST with a key claims it
+by inserting a CheckoutAttempt, which has a unique constraint on the key, so
+of two concurrent submissions exactly one wins the insert. Retries of the
+same submission (a double click, a refresh, a replayed request after a
+timeout) find the existing attempt and are answered with its outcome instead
+of scoring the cart and placing the order again.
+
+A key is only honoured for KEY_TTL. After that the attempt may be replaced
+by a new claim, and purge_expired_attempts deletes it.
+"""
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from datetime import timedelta
+import uuid
+
+from .models import CheckoutAttempt
+
+KEY_TTL = timedelta(minutes=15)
+
+
+def parse_key(value):
+    """The submitted key as a UUID, or None if missing or malformed"""
+    try:
+        return uuid.UUID(str(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def claim_checkout(user, key, now=None):
+    """
+    Claim an idempotency key for a new checkout.
+
+    Returns (attempt, claimed). When claimed is False the attempt is the
+    earlier submission with the same key and should be replayed. The
+    attempt is None when the key is held by another user; the checkout
+    then runs without idempotency.
+    """
+    now = now or timezone.now()
+    try:
+        with transaction.atomic():
+            return CheckoutAttempt.objects.create(key=key, user=user, expires_at=now + KEY_TTL), True
+    except IntegrityError:
+        pass
+
+    attempt = CheckoutAttempt.objects.filter(key=key, user=user).first()
+    if attempt is None:
+        return None, False
+    if attempt.expires_at <= now:
+        # An expired key starts over; the conditional delete lets only one retry claim it
+        if CheckoutAttempt.objects.filter(pk=attempt.pk, expires_at__lte=now).delete()[0]:
+            return claim_checkout(user, key, now)
+        attempt = CheckoutAttempt.objects.filter(key=key, user=user).first()
+        if attempt is None:
+            return None, False
+    return attempt, False
+
+
+def complete_checkout(attempt, order, redirect_url):
+    """Record the outcome to replay for retries of the submission"""
+    attempt.order = order
+    attempt.redirect_url = redirect_url
+    CheckoutAttempt.objects.filter(pk=attempt.pk).update(order=order, redirect_url=redirect_url)
+
+
+def release_checkout(attempt):
+    """Forget a submission that placed no order so the form can be submitted again"""
+    CheckoutAttempt.objects.filter(pk=attempt.pk).delete()
+
+
+def purge_expired_attempts(batch_size=1000, now=None):
+    """Delete one batch of expired attempts; returns the number deleted"""
+    now = now or timezone.now()
+    ids = list(
+        CheckoutAttempt.objects.filter(expires_at__lte=now).order_by('expires_at')
+        .values_list('id', flat=True)[:batch_size]
+    )
+    return CheckoutAttempt.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,148 @@
+"""
+Stock reservation for checkout
+
+Stock is decremented with one conditional UPDATE per product::
+
+    UPDATE products_product SET stock = stock - <qty> WHERE id = <id> AND stock >= <qty>
+
+The row lock taken by the UPDATE serializes concurrent checkouts of the
+same product, and the guard makes the decrement fail instead of going
+negative, so stock is never read, modified and written back. Products are
+updated in id order so two carts sharing products lock them in the same
+order and cannot deadlock.
+
+Orders held for fraud verification take their stock the same way and
+record it as StockHold rows that expire with the confirmation. Because held
+stock has already left Product.stock, available stock is still a primary
+key read of the product. Confirming an order converts its holds; expired
+holds are handed back in bulk by release_expired_holds.
+"""
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from products.models import Product
+from .models import StockHold
+
+
+class InsufficientStock(Exception):
+    """Raised when products in a cart have less stock than requested"""
+
+    def __init__(self, shortages):
+        # (product name, quantity requested, stock available) per short product
+        self.shortages = shortages
+        details = ', '.join(f"{name} ({available} left, {requested} requested)" for name, requested, available in shortages)
+        super().__init__(f"Not enough stock for {details}")
+
+
+def _combine(items):
+    """Total quantity per product id of cart or order items"""
+    quantities = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    return quantities
+
+
+def _reserve(quantities):
+    # No savepoint of its own; a shortage rolls back the caller's transaction
+    with transaction.atomic(savepoint=False):
+        short = []
+        for product_id in sorted(quantities):
+            quantity = quantities[product_id]
+            reserved = Product.objects.filter(pk=product_id, stock__gte=quantity).update(
+                stock=F('stock') - quantity
+            )
+            if not reserved:
+                short.append(product_id)
+
+        if short:
+            available = {
+                product_id: (name, stock)
+                for product_id, name, stock in Product.objects.filter(pk__in=short).values_list('id', 'name', 'stock')
+            }
+            shortages = []
+            for product_id in short:
+                name, stock = available.get(product_id, (f"product {product_id}", 0))
+                shortages.append((name, quantities[product_id], stock))
+            raise InsufficientStock(shortages)
+
+
+def _restock(holds):
+    """Return (product id, quantity) pairs to stock, in product id order"""
+    quantities = {}
+    for product_id, quantity in holds:
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    for product_id in sorted(quantities):
+        Product.objects.filter(pk=product_id).update(stock=F('stock') + quantities[product_id])
+
+
+def reserve_stock(items):
+    """
+    Decrement stock for the given cart or order items, all or nothing.
+
+    Items need ``product_id`` and ``quantity``; quantities of the same
+    product are combined. Call it inside the transaction that creates the
+    order: when any product is short InsufficientStock is raised, listing
+    the products that could not be reserved, and the enclosing transaction
+    is rolled back along with every decrement.
+    """
+    _reserve(_combine(items))
+
+
+def hold_stock(order, items, expires_at):
+    """Reserve stock for an order awaiting verification until expires_at"""
+    quantities = _combine(items)
+    with transaction.atomic(savepoint=False):
+        _reserve(quantities)
+        StockHold.objects.bulk_create([
+            StockHold(order=order, product_id=product_id, quantity=quantity, expires_at=expires_at)
+            for product_id, quantity in sorted(quantities.items())
+        ])
+
+
+def convert_holds(order, items):
+    """
+    Keep the stock held for a confirmed order.
+
+    Anything no longer held, because its hold expired and was released or
+    the order predates holds, is reserved now and may raise InsufficientStock.
+    """
+    needed = _combine(items)
+    with transaction.atomic(savepoint=False):
+        holds = StockHold.objects.select_for_update().filter(order=order)
+        for product_id, quantity in holds.values_list('product_id', 'quantity'):
+            needed[product_id] = needed.get(product_id, 0) - quantity
+        _reserve({product_id: quantity for product_id, quantity in needed.items() if quantity > 0})
+        holds.delete()
+
+
+def release_holds(order_ids):
+    """Return the held stock of the given (cancelled) orders; returns the number of holds released"""
+    with transaction.atomic():
+        holds = list(
+            StockHold.objects.select_for_update().filter(order_id__in=order_ids)
+            .values_list('id', 'product_id', 'quantity')
+        )
+        _restock((product_id, quantity) for _, product_id, quantity in holds)
+        StockHold.objects.filter(id__in=[hold[0] for hold in holds]).delete()
+    return len(holds)
+
+
+def release_expired_holds(batch_size=500, now=None):
+    """
+    Return the stock of one batch of expired holds.
+
+    Holds locked by a concurrent sweep are skipped, so several sweepers can
+    run at once. Returns the number of holds released.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        holds = list(
+            StockHold.objects.select_for_update(skip_locked=True)
+            .filter(expires_at__lt=now)
+            .order_by('expires_at')
+            .values_list('id', 'product_id', 'quantity')[:batch_size]
+        )
+        _restock((product_id, quantity) for _, product_id, quantity in holds)
+        StockHold.objects.filter(id__in=[hold[0] for hold in holds]).delete()
+    return len(holds)
@@ -0,0 +1,33 @@
+"""
+Move finished orders past the archive horizon to the archive tables
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from orders.archive import archive_horizon, archive_orders
+
+
+class Command(BaseCommand):
+    help = (
+        "Move completed and cancelled orders older than ORDER_ARCHIVE['AFTER_DAYS'] (or --days), "
+        "with their items, to the archive tables in bounded batches. Safe to run from several processes at once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help="Archive finished orders placed more than this many days ago")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Orders moved per transaction")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        before = archive_horizon(days=options['days'])
+
+        total = 0
+        while True:
+            archived = archive_orders(batch_size, before=before)
+            total += archived
+            if archived < batch_size:
+                break
+        self.stdout.write(
+            f"Archived {total} orders placed before {timezone.localtime(before):%Y-%m-%d %H:%M}"
+        )
@@ -0,0 +1,24 @@
+"""
+Delete checkout idempotency keys past their TTL
+"""
+from django.core.management.base import BaseCommand
+
+from orders.idempotency import purge_expired_attempts
+
+
+class Command(BaseCommand):
+    help = "Delete expired checkout attempts in bounded batches so their idempotency keys are forgotten"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Attempts deleted per batch")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total = 0
+        while True:
+            deleted = purge_expired_attempts(batch_size)
+            total += deleted
+            if deleted < batch_size:
+                break
+        self.stdout.write(f"Purged {total} expired checkout attempts")
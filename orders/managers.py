@@ -0,0 +1,245 @@
+"""
+Managers reading live orders together with their archive
+
+Completed and cancelled orders past the archive horizon are moved to the
+ArchivedOrder / ArchivedOrderItem tables (see orders.archive), so queries on
+Order and OrderItem only touch recent data. in_range() restricts a query to
+a date range and reads the archive too, but only when the range reaches
+archived orders:
+
+    Order.objects.in_range(since).filter(status='Completed').aggregate(total=Sum('total_price'))
+
+When it does not, in_range() returns an ordinary queryset. Otherwise it
+returns an ArchiveUnion, which runs the query on both tables and combines
+the results in Python.
+"""
+from django.apps import apps
+from django.db import models
+from django.db.models import Avg, Count, Sum
+from django.db.models.query import FlatValuesListIterable
+
+
+class ArchiveUnion:
+    """
+    The same query over the live and archive tables, combined as one result.
+
+    Supports the queryset methods used for reporting: filter, exclude,
+    values, values_list, annotate, order_by, select_related and
+    prefetch_related chain on both querysets. Grouped rows
+    (values().annotate()) are merged by their group key, with Sum and Count
+    added, Min and Max combined and Avg rebuilt from each table's sum and
+    count. Ordering and slicing apply to the combined rows.
+    """
+    COMBINE = {
+        'Sum': lambda a, b: b if a is None else a if b is None else a + b,
+        'Count': lambda a, b: (a or 0) + (b or 0),
+        'Min': lambda a, b: b if a is None else a if b is None else min(a, b),
+        'Max': lambda a, b: b if a is None else a if b is None else max(a, b),
+    }
+
+    def __init__(self, querysets):
+        self.querysets = querysets
+        self._result_cache = None
+
+    def _chain(self, method, *args, **kwargs):
+        return ArchiveUnion([getattr(queryset, method)(*args, **kwargs) for queryset in self.querysets])
+
+    def filter(self, *args, **kwargs):
+        return self._chain('filter', *args, **kwargs)
+
+    def exclude(self, *args, **kwargs):
+        return self._chain('exclude', *args, **kwargs)
+
+    def values(self, *fields, **expressions):
+        return self._chain('values', *fields, **expressions)
+
+    def values_list(self, *fields, **kwargs):
+        return self._chain('values_list', *fields, **kwargs)
+
+    def annotate(self, *args, **kwargs):
+        return self._chain('annotate', *args, **kwargs)
+
+    def order_by(self, *fields):
+        return self._chain('order_by', *fields)
+
+    def select_related(self, *fields):
+        return self._chain('select_related', *fields)
+
+    def prefetch_related(self, *lookups):
+        return self._chain('prefetch_related', *lookups)
+
+    def _combiner(self, aggregate):
+        name = type(aggregate).__name__
+        if name not in self.COMBINE:
+            raise TypeError(f"{name} cannot be combined across the live and archive tables")
+        return self.COMBINE[name]
+
+    def _average_parts(self, name, average):
+        """Sum and Count of an Avg's rows, from which the average over both tables is rebuilt"""
+        if average.distinct:
+            raise TypeError(f"Avg(distinct=True) for '{name}' cannot be combined across the live and archive tables")
+        expression = average.get_source_expressions()[0]
+        return {
+            f'_{name}_sum': Sum(expression, filter=average.filter),
+            f'_{name}_count': Count(expression, filter=average.filter),
+        }
+
+    def _rebuild_averages(self, row, averages):
+        for name in averages:
+            total, count = row.pop(f'_{name}_sum'), row.pop(f'_{name}_count')
+            row[name] = total / count if count else None
+        return row
+
+    def count(self):
+        # A group present in both tables is one combined row
+        if self._result_cache is not None or self._is_grouped():
+            return len(self._results())
+        return sum(queryset.count() for queryset in self.querysets)
+
+    def exists(self):
+        return any(queryset.exists() for queryset in self.querysets)
+
+    def aggregate(self, **aggregates):
+        averages = [key for key, aggregate in aggregates.items() if isinstance(aggregate, Avg)]
+        queried = {key: aggregate for key, aggregate in aggregates.items() if key not in averages}
+        for key in averages:
+            queried.update(self._average_parts(key, aggregates[key]))
+
+        combined = {}
+        for queryset in self.querysets:
+            for key, value in queryset.aggregate(**queried).items():
+                combined[key] = self._combiner(queried[key])(combined.get(key), value) if key in combined else value
+        return self._rebuild_averages(combined, averages)
+
+    def _grouped(self):
+        """Combine rows of values().annotate() querysets that share a group key"""
+        query = self.querysets[0].query
+        annotations = {name: annotation for name, annotation in query.annotations.items()
+                       if getattr(annotation, 'contains_aggregate', False)}
+        averages = [name for name, annotation in annotations.items() if isinstance(annotation, Avg)]
+        aggregates = {name: self._combiner(annotation) for name, annotation in annotations.items()
+                      if name not in averages}
+        for name in averages:
+            aggregates[f'_{name}_sum'] = self.COMBINE['Sum']
+            aggregates[f'_{name}_count'] = self.COMBINE['Count']
+
+        groups = {}
+        for queryset in self.querysets:
+            # Each table's annotations are resolved against its own columns
+            parts = {}
+            for name in averages:
+                parts.update(self._average_parts(name, queryset.query.annotations[name]))
+            for row in queryset.order_by().annotate(**parts):
+                key = tuple(value for name, value in row.items() if name not in aggregates and name not in averages)
+                if key not in groups:
+                    groups[key] = dict(row)
+                    continue
+                for name, combine in aggregates.items():
+                    groups[key][name] = combine(groups[key][name], row[name])
+        return [self._rebuild_averages(row, averages) for row in groups.values()]
+
+    def _sort(self, rows):
+        """Apply the querysets' ordering to rows from both tables"""
+        fields = self.querysets[0].query.order_by
+        if not fields:
+            return rows
+
+        def value(row, field):
+            if isinstance(row, dict):
+                return row[field]
+            if isinstance(row, tuple):
+                return row[self.querysets[0]._fields.index(field)]
+            return getattr(row, field)
+
+        # Stable sorts from the last ordering field to the first
+        for field in reversed(fields):
+            name = field.lstrip('-')
+            rows.sort(key=lambda row: (value(row, name) is None, value(row, name)), reverse=field.startswith('-'))
+        return rows
+
+    def _is_grouped(self):
+        return self.querysets[0].query.group_by is not None and isinstance(self.querysets[0]._fields, tuple)
+
+    def _fetch(self, stop=None):
+        query = self.querysets[0].query
+        if query.order_by and self.querysets[0]._iterable_class is FlatValuesListIterable:
+            # Flat rows carry no ordering fields, so fetch them alongside and drop them once sorted
+            ordering = [field.lstrip('-') for field in query.order_by]
+            union = ArchiveUnion([
+                queryset.values_list(*queryset._fields, *ordering) for queryset in self.querysets
+            ])
+            return [row[0] for row in union._fetch(stop)]
+        if self._is_grouped():
+            rows = self._grouped()
+        elif stop is not None and query.order_by:
+            # Each table's first rows in the same order hold the combined first rows
+            rows = [row for queryset in self.querysets for row in queryset[:stop]]
+        else:
+            rows = [row for queryset in self.querysets for row in queryset]
+        return self._sort(rows)
+
+    def _results(self):
+        if self._result_cache is None:
+            self._result_cache = self._fetch()
+        return self._result_cache
+
+    def __iter__(self):
+        return iter(self._results())
+
+    def __len__(self):
+        return len(self._results())
+
+    def __bool__(self):
+        return bool(self._results())
+
+    def __getitem__(self, index):
+        if self._result_cache is None and isinstance(index, slice) and index.stop is not None and index.step is None:
+            return self._fetch(stop=index.stop)[index]
+        return self._results()[index]
+
+
+class ArchiveRangeManager(models.Manager):
+    """
+    Manager for a model with an archive twin.
+
+    Subclasses set date_field, the lookup path of the order date on the
+    model, and archive_model, the 'app_label.Model' of the archive table,
+    which has the same field names.
+    """
+    date_field = 'order_date'
+    archive_model = None
+
+    def _in_range(self, queryset, start, end):
+        if start is not None:
+            queryset = queryset.filter(**{f'{self.date_field}__gte': start})
+        if end is not None:
+            queryset = queryset.filter(**{f'{self.date_field}__lt': end})
+        return queryset
+
+    def in_range(self, start=None, end=None):
+        """
+        Rows whose order was placed in [start, end), live and archived.
+
+        The archive is only read when it holds an order in the range, which
+        one probe of its order date index tells.
+        """
+        archived_orders = apps.get_model('orders.ArchivedOrder')._default_manager.all()
+        if start is not None:
+            archived_orders = archived_orders.filter(order_date__gte=start)
+        if end is not None:
+            archived_orders = archived_orders.filter(order_date__lt=end)
+
+        live = self._in_range(self.get_queryset(), start, end)
+        if not archived_orders.exists():
+            return live
+        archive = self._in_range(apps.get_model(self.archive_model)._default_manager.all(), start, end)
+        return ArchiveUnion([live, archive])
+
+
+class OrderManager(ArchiveRangeManager):
+    archive_model = 'orders.ArchivedOrder'
+
+
+class OrderItemManager(ArchiveRangeManager):
+    date_field = 'order__order_date'
+    archive_model = 'orders.ArchivedOrderItem'
@@ -1,6 +1,7 @@
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from products.models import Product
+from .managers import OrderItemManager, OrderManager
 
 class Order(models.Model):
     """Order model for storing order information."""
@@ -13,6 +14,7 @@ class Order(models.Model):
         ('Completed', 'Completed'),
         ('Cancelled', 'Cancelled'),
         ('Verification', 'Requires Verification'),
+        ('Scoring', 'Checking Order'),
     )
     
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='orders')
@@ -21,11 +23,31 @@ class Order(models.Model):
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
     updated_at = models.DateTimeField(auto_now=True)
     
+    # Queries reaching past the archive horizon use Order.objects.in_range()
+    objects = OrderManager()
+    
     def __str__(self):
         return f"Order #{self.id} by {self.user.username}"
     
+    def save(self, *args, **kwargs):
+        # The outbox event written by post_save (see orders.signals) commits with the change itself
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+        self._loaded_status = self.status
+    
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        # The status read back is what the next save changes from
+        self._loaded_status = self.__dict__.get('status')
+    
     class Meta:
-        ordering = ['-order_date']
+        # No default ordering: listings sort explicitly, other queries skip the sort
+        indexes = [
+            # Keyset pagination (see orders.pagination), overall, per customer and per status
+            models.Index(fields=['order_date', 'id']),
+            models.Index(fields=['user', 'order_date', 'id']),
+            models.Index(fields=['status', 'order_date', 'id']),
+        ]
 
 class OrderItem(models.Model):
     """OrderItem model for storing order items."""
@@ -35,6 +57,8 @@ class OrderItem(models.Model):
     quantity = models.PositiveIntegerField()
     product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True)  # Reference to actual product
     
+    objects = OrderItemManager()
+    
     def __str__(self):
         return f"{self.quantity} x {self.product_name} in Order #{self.order.id}"
     
@@ -42,3 +66,82 @@ class OrderItem(models.Model):
     def subtotal(self):
         """Calculate the subtotal price for this item."""
         return self.product_price * self.quantity
+
+class StockHold(models.Model):
+    """Stock set aside for an order awaiting fraud verification."""
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='stock_holds')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_holds')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)  # Held stock returns to the product after this
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} held for Order #{self.order_id}"
+
+class CheckoutAttempt(models.Model):
+    """A checkout submission, identified by the idempotency key rendered into the checkout form."""
+    key = models.UUIDField(unique=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='checkout_attempts')
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='checkout_attempts')
+    redirect_url = models.CharField(max_length=200, blank=True)  # Where the submission ended up; empty while in progress
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)  # The key can be reused (and the row purged) after this
+    
+    def __str__(self):
+        return f"Checkout {self.key} by user {self.user_id}"
+
+class OrderEvent(models.Model):
+    """
+    Outbox row for an order being created or changing status, written in the
+    same transaction as the change and consumed by analytics.
+    """
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='events')
+    previous_status = models.CharField(max_length=20, blank=True)  # Empty for a newly created order
+    status = models.CharField(max_length=20)
+    order_date = models.DateTimeField()  # Copied so consumers can bucket the event without reading the order
+    total_price = models.DecimalField(max_digits=10, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"Order #{self.order_id} {self.previous_status or 'created'} -> {self.status}"
+
+class ArchivedOrder(models.Model):
+    """
+    Completed or cancelled order moved out of the Order table by
+    archive_orders. Same fields and ids as Order, so Order.objects.in_range()
+    can query both.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='archived_orders')
+    order_date = models.DateTimeField()
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    total_price = models.DecimalField(max_digits=10, decimal_places=2)
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"Archived order #{self.id} by {self.user.username}"
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['order_date', 'id']),
+            models.Index(fields=['user', 'order_date', 'id']),
+            models.Index(fields=['status', 'order_date', 'id']),
+        ]
+
+class ArchivedOrderItem(models.Model):
+    """OrderItem of an archived order, with the same fields and ids."""
+    id = models.BigIntegerField(primary_key=True)
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE, related_name='items')
+    product_name = models.CharField(max_length=200)
+    product_price = models.DecimalField(max_digits=10, decimal_places=2)
+    quantity = models.PositiveIntegerField()
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, related_name='+')
+    
+    def __str__(self):
+        return f"{self.quantity} x {self.product_name} in archived Order #{self.order_id}"
+    
+    @property
+    def subtotal(self):
+        """Calculate the subtotal price for this item."""
+        return self.product_price * self.quantity
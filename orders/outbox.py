@@ -0,0 +1,54 @@
+"""
+Transactional outbox of order state changes
+
+Every order creation and status change writes an OrderEvent inside the
+transaction that makes the change, so an event exists exactly when the change
+committed. Saves go through the post_save receiver in orders.signals; code
+changing statuses with a bulk UPDATE, which skips post_save, records its
+events with record_bulk_status_change in the same transaction.
+
+Consumers (analytics' drain_order_events) read the table in id order and
+delete what they have applied.
+"""
+from .models import OrderEvent
+
+
+def record_created(order):
+    """Record a newly created order"""
+    OrderEvent.objects.create(
+        order=order,
+        status=order.status,
+        order_date=order.order_date,
+        total_price=order.total_price,
+    )
+
+
+def record_status_change(order, previous_status):
+    """Record a saved order moving from previous_status to its current status"""
+    OrderEvent.objects.create(
+        order=order,
+        previous_status=previous_status,
+        status=order.status,
+        order_date=order.order_date,
+        total_price=order.total_price,
+    )
+
+
+def record_bulk_status_change(orders, status):
+    """
+    Record orders moved to status by a bulk UPDATE.
+
+    Takes (order id, previous status, order date, total price) rows read,
+    under lock, before the update; orders already in status are skipped.
+    """
+    OrderEvent.objects.bulk_create([
+        OrderEvent(
+            order_id=order_id,
+            previous_status=previous_status,
+            status=status,
+            order_date=order_date,
+            total_price=total_price,
+        )
+        for order_id, previous_status, order_date, total_price in orders
+        if previous_status != status
+    ])
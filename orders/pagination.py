@@ -0,0 +1,100 @@
+"""
+Keyset pagination of orders on (order_date, id)
+
+Pages are read newest first by seeking past the last row shown instead of
+counting an OFFSET, so every page costs one index range scan on
+(order_date, id) however deep it is and rows inserted meanwhile do not shift
+the page boundaries. The cursor is the (order_date, id) key of the first or
+last order on the page, encoded for use in a query string.
+"""
+from datetime import datetime
+import base64
+import binascii
+
+PAGE_SIZE = 25
+
+
+def encode_cursor(order):
+    """Opaque cursor for the key of an order"""
+    key = f"{order.order_date.isoformat()}|{order.id}"
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def decode_cursor(value):
+    """(order_date, id) from a cursor, or None if it is missing or malformed"""
+    if not value:
+        return None
+    try:
+        key = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode()
+        order_date, order_id = key.split('|')
+        order_date = datetime.fromisoformat(order_date)
+        order_id = int(order_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if order_date.tzinfo is None:
+        return None
+    return order_date, order_id
+
+
+class OrderPage:
+    """One page of orders with the cursors of the pages around it"""
+
+    def __init__(self, orders, newer_cursor=None, older_cursor=None):
+        self.orders = orders
+        self.newer_cursor = newer_cursor
+        self.older_cursor = older_cursor
+
+    @property
+    def has_newer(self):
+        return self.newer_cursor is not None
+
+    @property
+    def has_older(self):
+        return self.older_cursor is not None
+
+    @property
+    def is_paginated(self):
+        return self.has_newer or self.has_older
+
+
+def paginate_orders(queryset, after=None, before=None, page_size=PAGE_SIZE):
+    """
+    Return the OrderPage of queryset, newest first.
+
+    after and before are cursors: after pages to older orders, before back
+    to newer ones. Without either the newest page is returned. One query
+    fetches page_size + 1 rows, the extra row telling whether another page
+    follows.
+    """
+    after, before = decode_cursor(after), decode_cursor(before)
+
+    if before is not None:
+        # Walk towards newer orders, then flip the rows back to newest first
+        order_date, order_id = before
+        rows = list(
+            queryset.filter(order_date__gte=order_date)
+            .exclude(order_date=order_date, id__lte=order_id)
+            .order_by('order_date', 'id')[:page_size + 1]
+        )
+        has_newer = len(rows) > page_size
+        orders = rows[:page_size][::-1]
+        return OrderPage(
+            orders,
+            newer_cursor=encode_cursor(orders[0]) if has_newer else None,
+            # Coming back from an older page, so older orders exist
+            older_cursor=encode_cursor(orders[-1]) if orders else None,
+        )
+
+    rows = queryset.order_by('-order_date', '-id')
+    if after is not None:
+        # order_date <= d AND NOT (order_date = d AND id >= pk) keeps the range on the index
+        order_date, order_id = after
+        rows = rows.filter(order_date__lte=order_date).exclude(order_date=order_date, id__gte=order_id)
+    rows = list(rows[:page_size + 1])
+    has_older = len(rows) > page_size
+    orders = rows[:page_size]
+    return OrderPage(
+        orders,
+        newer_cursor=encode_cursor(orders[0]) if after is not None and orders else None,
+        older_cursor=encode_cursor(orders[-1]) if has_older else None,
+    )
@@ -0,0 +1,28 @@
+"""
+Signals writing order state changes to the outbox
+"""
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+
+from .models import Order
+from .outbox import record_created, record_status_change
+
+@receiver(post_init, sender=Order)
+def remember_order_status(sender, instance, **kwargs):
+    """
+    Remember the status an order was loaded with so changes can be detected;
+    Order.save moves it forward once every post_save receiver has run
+    """
+    # Read from __dict__ so deferred status fields are not fetched
+    instance._loaded_status = instance.__dict__.get('status')
+
+@receiver(post_save, sender=Order)
+def record_order_event(sender, instance, created, **kwargs):
+    """
+    Write the outbox event for an order being created or changing status,
+    inside the transaction Order.save opened
+    """
+    if created:
+        record_created(instance)
+    elif instance._loaded_status is not None and instance._loaded_status != instance.status:
+        record_status_change(instance, instance._loaded_status)
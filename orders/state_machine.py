@@ -0,0 +1,87 @@
+"""
+Order state machine
+
+TRANSITIONS lists the statuses each status may move to. Bulk moves go
+through transition(), which locks the orders it may move, changes them with
+one UPDATE constrained to the allowed source statuses and then, for the
+whole batch at once, writes the outbox events, settles stock holds and sends
+a single orders_transitioned signal, so moving thousands of orders costs a
+handful of queries instead of a save per order.
+"""
+from django.db import transaction
+from django.dispatch import Signal
+from django.utils import timezone
+
+from .inventory import release_holds
+from .models import Order, StockHold
+from .outbox import record_bulk_status_change
+
+TRANSITIONS = {
+    'Scoring': ('Pending', 'Verification', 'Cancelled'),
+    'Verification': ('Processing', 'Cancelled'),
+    'Pending': ('Processing', 'Accepted', 'Cancelled'),
+    'Processing': ('Accepted', 'Shipped', 'Cancelled'),
+    'Accepted': ('Shipped', 'Cancelled'),
+    'Shipped': ('Delivered',),
+    'Delivered': ('Completed',),
+    'Completed': (),
+    'Cancelled': (),
+}
+
+# Sent once per transition() with the orders moved, as
+# (order id, previous status, user id, order date, total price) rows, and
+# their new status. Receivers run inside the transition's transaction.
+orders_transitioned = Signal()
+
+
+def can_transition(current, status):
+    """Whether an order in status current may move to status"""
+    return status in TRANSITIONS.get(current, ())
+
+
+def next_statuses(current):
+    """Statuses an order in status current may move to"""
+    return TRANSITIONS.get(current, ())
+
+
+def sources_for(status):
+    """Statuses from which an order may move to status"""
+    return [source for source, targets in TRANSITIONS.items() if status in targets]
+
+
+def transition(queryset, status, now=None):
+    """
+    Move the orders in queryset to status where the state machine allows it.
+
+    Orders in any other status are left alone. Returns the ids of the orders
+    moved; the caller can compare their number with the selection to report
+    how many were skipped.
+    """
+    now = now or timezone.now()
+    sources = sources_for(status)
+    with transaction.atomic():
+        orders = list(
+            queryset.filter(status__in=sources).select_for_update().order_by('id')
+            .values_list('id', 'status', 'user_id', 'order_date', 'total_price')
+        )
+        if not orders:
+            return []
+
+        order_ids = [order[0] for order in orders]
+        Order.objects.filter(id__in=order_ids, status__in=sources).update(status=status, updated_at=now)
+
+        record_bulk_status_change(
+            ((order_id, previous, order_date, total_price) for order_id, previous, _, order_date, total_price in orders),
+            status,
+        )
+
+        if status == 'Cancelled':
+            release_holds(order_ids)
+        else:
+            # Orders let through verification keep the stock held for them
+            held = [order[0] for order in orders if order[1] == 'Verification']
+            if held:
+                StockHold.objects.filter(order_id__in=held).delete()
+
+        orders_transitioned.send(sender=Order, orders=orders, status=status)
+    return order_ids
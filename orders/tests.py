@@ -1,3 +1,544 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Avg, Count, QuerySet, Sum
+from django.urls import reverse
+from django.utils import timezone
+from datetime import timedelta
+from decimal import Decimal
+from unittest import skipIf
+import threading
+import uuid
 
-# Create your tests here.
+from cart.models import Cart, CartItem
+from products.models import Category, Product
+from .archive import archive_horizon, archive_orders
+from .idempotency import KEY_TTL, claim_checkout, parse_key
+from .inventory import InsufficientStock, convert_holds, hold_stock, release_expired_holds, release_holds, reserve_stock
+from .models import ArchivedOrder, ArchivedOrderItem, CheckoutAttempt, Order, OrderEvent, OrderItem, StockHold
+from .pagination import decode_cursor, encode_cursor, paginate_orders
+from .state_machine import orders_transitioned, transition
+
+
+class InventoryTestMixin:
+    """Shared fixtures for stock reservation tests"""
+
+    def create_product(self, name='Widget', stock=10, price='20.00'):
+        category, _ = Category.objects.get_or_create(name='General')
+        return Product.objects.create(
+            name=name, description='Test product', price=Decimal(price), stock=stock, category=category
+        )
+
+
+class ReserveStockTests(InventoryTestMixin, TestCase):
+    def test_reserves_every_product(self):
+        first = self.create_product('First', stock=5)
+        second = self.create_product('Second', stock=3)
+        items = [CartItem(product=first, quantity=2), CartItem(product=second, quantity=3),
+                 CartItem(product=first, quantity=1)]
+
+        with transaction.atomic():
+            reserve_stock(items)
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.stock, second.stock), (2, 0))
+
+    def test_shortage_reserves_nothing(self):
+        plenty = self.create_product('Plenty', stock=50)
+        scarce = self.create_product('Scarce', stock=1)
+
+        with self.assertRaises(InsufficientStock) as raised:
+            with transaction.atomic():
+                reserve_stock([CartItem(product=plenty, quantity=5), CartItem(product=scarce, quantity=2)])
+
+        self.assertEqual(raised.exception.shortages, [('Scarce', 2, 1)])
+        plenty.refresh_from_db()
+        self.assertEqual(plenty.stock, 50)
+
+    def test_checkout_rejects_cart_beyond_stock(self):
+        user = get_user_model().objects.create_user(username='shopper', password='pass12345', location='Lahore')
+        product = self.create_product(stock=1)
+        cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=cart, product=product, quantity=3)
+        self.client.force_login(user)
+
+        response = self.client.post(reverse('checkout'), {
+            'confirmed_location': 'Lahore',
+            'shipping_address': 'Street 1',
+            'billing_address': 'Street 1',
+        })
+
+        self.assertRedirects(response, reverse('cart'), fetch_redirect_response=False)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(cart.items.count(), 1)
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 1)
+
+
+class StockHoldTests(InventoryTestMixin, TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='shopper', password='pass12345', location='Lahore')
+        self.product = self.create_product(stock=10)
+
+    def held_order(self, quantity, expires_at):
+        order = Order.objects.create(user=self.user, total_price=Decimal('20.00'), status='Verification')
+        item = OrderItem.objects.create(order=order, product=self.product, product_name='Widget',
+                                        product_price=Decimal('20.00'), quantity=quantity)
+        with transaction.atomic():
+            hold_stock(order, [item], expires_at)
+        return order
+
+    def assert_stock(self, expected):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, expected)
+
+    def test_expired_holds_released_in_bulk(self):
+        now = timezone.now()
+        self.held_order(3, now - timedelta(minutes=1))
+        self.held_order(2, now - timedelta(minutes=2))
+        live = self.held_order(4, now + timedelta(minutes=30))
+        self.assert_stock(1)
+
+        self.assertEqual(release_expired_holds(), 2)
+
+        self.assert_stock(6)
+        self.assertEqual(list(StockHold.objects.values_list('order_id', flat=True)), [live.id])
+        self.assertEqual(release_expired_holds(), 0)
+
+    def test_convert_reserves_stock_released_meanwhile(self):
+        order = self.held_order(4, timezone.now() + timedelta(minutes=30))
+        release_holds([order.id])
+        self.assert_stock(10)
+
+        with transaction.atomic():
+            convert_holds(order, order.items.all())
+
+        self.assert_stock(6)
+        self.assertFalse(StockHold.objects.exists())
+
+    def test_convert_fails_when_released_stock_sold_out(self):
+        order = self.held_order(4, timezone.now() - timedelta(minutes=1))
+        release_expired_holds()
+        Product.objects.filter(pk=self.product.pk).update(stock=2)
+
+        with self.assertRaises(InsufficientStock):
+            with transaction.atomic():
+                convert_holds(order, order.items.all())
+        self.assert_stock(2)
+
+
+class CheckoutIdempotencyTests(InventoryTestMixin, TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='shopper', password='pass12345', location='Lahore')
+        self.user.date_joined = timezone.now() - timedelta(days=30)
+        self.user.save()
+        self.product = self.create_product(stock=10)
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        self.client.force_login(self.user)
+
+    def checkout(self, key):
+        return self.client.post(reverse('checkout'), {
+            'confirmed_location': 'Lahore',
+            'shipping_address': 'Street 1',
+            'billing_address': 'Street 1',
+            'idempotency_key': str(key),
+        })
+
+    def test_form_carries_key(self):
+        response = self.client.get(reverse('checkout'))
+        self.assertIsNotNone(parse_key(response.context['idempotency_key']))
+        self.assertContains(response, 'name="idempotency_key"')
+
+    def test_retry_returns_original_order(self):
+        key = uuid.uuid4()
+        first = self.checkout(key)
+        order = Order.objects.get()
+        self.assertRedirects(first, reverse('order_detail', args=[order.id]))
+
+        retry = self.checkout(key)
+
+        self.assertRedirects(retry, reverse('order_detail', args=[order.id]))
+        self.assertEqual(Order.objects.count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 8)
+        self.assertEqual(CheckoutAttempt.objects.get(key=key).order, order)
+
+    def test_retry_while_in_progress(self):
+        key = uuid.uuid4()
+        claim_checkout(self.user, key)
+
+        response = self.checkout(key)
+
+        self.assertRedirects(response, reverse('order_history'))
+        self.assertFalse(Order.objects.exists())
+
+    def test_failed_submission_releases_key(self):
+        key = uuid.uuid4()
+        Product.objects.filter(pk=self.product.pk).update(stock=1)
+        self.assertRedirects(self.checkout(key), reverse('cart'), fetch_redirect_response=False)
+        self.assertFalse(CheckoutAttempt.objects.exists())
+
+        Product.objects.filter(pk=self.product.pk).update(stock=10)
+        response = self.checkout(key)
+
+        order = Order.objects.get()
+        self.assertRedirects(response, reverse('order_detail', args=[order.id]))
+
+    def test_expired_key_claimed_again(self):
+        key = uuid.uuid4()
+        attempt, claimed = claim_checkout(self.user, key, now=timezone.now() - KEY_TTL * 2)
+        self.assertTrue(claimed)
+
+        again, claimed = claim_checkout(self.user, key)
+
+        self.assertTrue(claimed)
+        self.assertNotEqual(again.pk, attempt.pk)
+        self.assertEqual(claim_checkout(self.user, key), (again, False))
+
+    def test_key_of_another_user_not_replayed(self):
+        key = uuid.uuid4()
+        other = get_user_model().objects.create_user(username='other', password='pass12345', location='Lahore')
+        claim_checkout(other, key)
+
+        self.assertEqual(claim_checkout(self.user, key), (None, False))
+
+    def test_purge_expired_attempts(self):
+        from io import StringIO
+        claim_checkout(self.user, uuid.uuid4(), now=timezone.now() - KEY_TTL * 2)
+        live, _ = claim_checkout(self.user, uuid.uuid4())
+
+        out = StringIO()
+        call_command('purge_checkout_attempts', stdout=out)
+
+        self.assertIn("Purged 1 expired checkout attempts", out.getvalue())
+        self.assertEqual(list(CheckoutAttempt.objects.all()), [live])
+
+
+class OrderPaginationTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='shopper', password='pass12345', location='Lahore')
+        now = timezone.now()
+        self.orders = []
+        for index in range(7):
+            order = Order.objects.create(user=self.user, total_price=Decimal('10.00'),
+                                         status='Pending' if index % 2 else 'Shipped')
+            # Pairs of orders share a timestamp so the id breaks ties
+            Order.objects.filter(pk=order.pk).update(order_date=now - timedelta(hours=index // 2))
+            self.orders.append(order.id)
+        self.newest_first = list(Order.objects.order_by('-order_date', '-id').values_list('id', flat=True))
+
+    def ids(self, page):
+        return [order.id for order in page.orders]
+
+    def test_pages_forward_and_back(self):
+        first = paginate_orders(Order.objects.all(), page_size=3)
+        second = paginate_orders(Order.objects.all(), after=first.older_cursor, page_size=3)
+        third = paginate_orders(Order.objects.all(), after=second.older_cursor, page_size=3)
+
+        self.assertEqual(self.ids(first) + self.ids(second) + self.ids(third), self.newest_first)
+        self.assertFalse(first.has_newer)
+        self.assertFalse(third.has_older)
+
+        back = paginate_orders(Order.objects.all(), before=third.newer_cursor, page_size=3)
+        self.assertEqual(self.ids(back), self.ids(second))
+        self.assertTrue(back.has_newer and back.has_older)
+        self.assertEqual(self.ids(paginate_orders(Order.objects.all(), before=back.newer_cursor, page_size=3)),
+                         self.ids(first))
+
+    def test_malformed_cursor_returns_first_page(self):
+        self.assertIsNone(decode_cursor('not-a-cursor'))
+        page = paginate_orders(Order.objects.all(), after='not-a-cursor', page_size=3)
+        self.assertEqual(self.ids(page), self.newest_first[:3])
+
+    def test_each_page_is_one_query(self):
+        cursor = encode_cursor(Order.objects.get(pk=self.newest_first[2]))
+        with self.assertNumQueries(1):
+            paginate_orders(Order.objects.all(), after=cursor, page_size=3)
+
+    def test_staff_page_filters_by_status(self):
+        staff = get_user_model().objects.create_user(username='staff', password='pass12345', location='Lahore',
+                                                     is_staff=True)
+        self.client.force_login(staff)
+
+        # Session, user, orders with their customers, and the prefetched items
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('order_management'), {'status': 'Shipped'})
+
+        self.assertEqual([order.id for order in response.context['orders']],
+                         [pk for pk in self.newest_first if Order.objects.get(pk=pk).status == 'Shipped'])
+        self.assertEqual(response.context['page_query'], 'status=Shipped')
+
+
+class OrderStateMachineTests(InventoryTestMixin, TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='shopper', password='pass12345', location='Lahore')
+        self.staff = get_user_model().objects.create_user(username='staff', password='pass12345', location='Lahore',
+                                                          is_staff=True, is_superuser=True)
+
+    def create_orders(self, count, status='Pending'):
+        orders = [Order.objects.create(user=self.user, total_price=Decimal('10.00')) for _ in range(count)]
+        Order.objects.filter(pk__in=[order.pk for order in orders]).update(status=status)
+        return [order.pk for order in orders]
+
+    def test_moves_only_orders_allowed_to_transition(self):
+        pending = self.create_orders(2)
+        shipped = self.create_orders(1, status='Shipped')
+
+        moved = transition(Order.objects.all(), 'Processing')
+
+        self.assertEqual(moved, pending)
+        self.assertEqual(Order.objects.get(pk=shipped[0]).status, 'Shipped')
+        self.assertEqual(OrderEvent.objects.filter(previous_status='Pending', status='Processing').count(), 2)
+
+    def test_query_count_does_not_grow_with_batch(self):
+        self.create_orders(3)
+        with CaptureQueriesContext(connection) as small:
+            transition(Order.objects.filter(status='Pending'), 'Accepted')
+
+        self.create_orders(40)
+        with CaptureQueriesContext(connection) as large:
+            transition(Order.objects.filter(status='Pending'), 'Accepted')
+
+        self.assertEqual(len(large), len(small))
+
+    def test_one_signal_per_transition(self):
+        order_ids = self.create_orders(3)
+        received = []
+
+        def receiver(sender, orders, status, **kwargs):
+            received.append(([order[0] for order in orders], status))
+
+        orders_transitioned.connect(receiver)
+        try:
+            transition(Order.objects.all(), 'Cancelled')
+        finally:
+            orders_transitioned.disconnect(receiver)
+
+        self.assertEqual(received, [(order_ids, 'Cancelled')])
+
+    def test_cancelling_held_order_releases_stock(self):
+        product = self.create_product(stock=10)
+        order_id = self.create_orders(1, status='Verification')[0]
+        order = Order.objects.get(pk=order_id)
+        item = OrderItem.objects.create(order=order, product=product, product_name='Widget',
+                                        product_price=Decimal('20.00'), quantity=4)
+        with transaction.atomic():
+            hold_stock(order, [item], timezone.now() + timedelta(minutes=30))
+
+        transition(Order.objects.filter(pk=order_id), 'Cancelled')
+
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 10)
+        self.assertFalse(StockHold.objects.exists())
+
+    def test_staff_status_update_rejects_illegal_transition(self):
+        order_id = self.create_orders(1, status='Shipped')[0]
+        self.client.force_login(self.staff)
+
+        self.client.post(reverse('update_order_status', args=[order_id]), {'status': 'Pending'})
+        self.assertEqual(Order.objects.get(pk=order_id).status, 'Shipped')
+
+        self.client.post(reverse('update_order_status', args=[order_id]), {'status': 'Delivered'})
+        self.assertEqual(Order.objects.get(pk=order_id).status, 'Delivered')
+
+    def test_admin_action_reports_skipped_orders(self):
+        order_ids = self.create_orders(2) + self.create_orders(1, status='Completed')
+        self.client.force_login(self.staff)
+
+        response = self.client.post(reverse('admin:orders_order_changelist'), {
+            'action': 'mark_as_cancelled',
+            '_selected_action': order_ids,
+        }, follow=True)
+
+        self.assertEqual(Order.objects.filter(status='Cancelled').count(), 2)
+        self.assertContains(response, "2 order(s) marked as Cancelled.")
+        self.assertContains(response, "1 order(s) skipped")
+
+
+class OrderArchiveTests(InventoryTestMixin, TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='shopper', password='pass12345', location='Lahore')
+        self.product = self.create_product()
+        self.now = timezone.now()
+
+    def create_order(self, status, days_ago, quantity=1):
+        order = Order.objects.create(user=self.user, total_price=Decimal('20.00') * quantity)
+        OrderItem.objects.create(order=order, product=self.product, product_name='Widget',
+                                 product_price=Decimal('20.00'), quantity=quantity)
+        Order.objects.filter(pk=order.pk).update(status=status, order_date=self.now - timedelta(days=days_ago))
+        OrderEvent.objects.filter(order=order).delete()
+        return order.pk
+
+    def test_archives_only_finished_orders_past_horizon(self):
+        old_completed = self.create_order('Completed', 400, quantity=2)
+        old_cancelled = self.create_order('Cancelled', 500)
+        old_pending = self.create_order('Pending', 400)
+        recent = self.create_order('Completed', 10)
+        unapplied = self.create_order('Completed', 400)
+        # Its completion has not reached analytics yet
+        OrderEvent.objects.create(order_id=unapplied, status='Completed', order_date=self.now, total_price=1)
+
+        self.assertEqual(archive_orders(before=archive_horizon(self.now, days=365)), 2)
+
+        self.assertEqual(set(ArchivedOrder.objects.values_list('id', flat=True)), {old_completed, old_cancelled})
+        self.assertEqual(set(Order.objects.values_list('id', flat=True)), {old_pending, recent, unapplied})
+        item = ArchivedOrderItem.objects.get(order_id=old_completed)
+        self.assertEqual((item.quantity, item.product_id), (2, self.product.id))
+        self.assertFalse(OrderItem.objects.filter(order_id=old_completed).exists())
+
+    def test_recent_range_does_not_read_archive(self):
+        self.create_order('Completed', 400)
+        archive_orders(before=archive_horizon(self.now, days=365))
+
+        # One probe of the archive's date index, then a plain queryset
+        with self.assertNumQueries(1):
+            recent = Order.objects.in_range(self.now - timedelta(days=30))
+        self.assertIsInstance(recent, QuerySet)
+
+    def test_range_reaching_archive_combines_tables(self):
+        self.create_order('Completed', 400, quantity=2)
+        self.create_order('Completed', 399)
+        archive_orders(before=archive_horizon(self.now, days=365))
+        self.create_order('Completed', 5)
+        self.create_order('Pending', 5)
+
+        orders = Order.objects.in_range(self.now - timedelta(days=450))
+
+        self.assertEqual(orders.count(), 4)
+        self.assertEqual(orders.filter(status='Completed').aggregate(total=Sum('total_price'))['total'], Decimal('80.00'))
+        by_status = {row['status']: row['count'] for row in orders.values('status').annotate(count=Count('id'))}
+        self.assertEqual(by_status, {'Completed': 3, 'Pending': 1})
+        newest = [order.order_date for order in orders.order_by('-order_date')[:3]]
+        self.assertEqual(newest, sorted(newest, reverse=True))
+        units = OrderItem.objects.in_range(self.now - timedelta(days=450)).aggregate(units=Sum('quantity'))
+        self.assertEqual(units['units'], 5)
+
+    def test_range_reaching_archive_combines_averages(self):
+        self.create_order('Completed', 400, quantity=4)
+        archive_orders(before=archive_horizon(self.now, days=365))
+        self.create_order('Completed', 5)
+        self.create_order('Pending', 5, quantity=2)
+
+        orders = Order.objects.in_range(self.now - timedelta(days=450))
+
+        # Weighted by row, not the mean of each table's average
+        self.assertEqual(orders.aggregate(average=Avg('total_price'))['average'], Decimal('140.00') / 3)
+        by_status = {row['status']: row['average'] for row in orders.values('status').annotate(average=Avg('total_price'))}
+        self.assertEqual(by_status, {'Completed': Decimal('50.00'), 'Pending': Decimal('40.00')})
+        with self.assertRaises(TypeError):
+            orders.aggregate(average=Avg('total_price', distinct=True))
+
+    def test_grouped_count_merges_groups_from_both_tables(self):
+        self.create_order('Completed', 400)
+        archive_orders(before=archive_horizon(self.now, days=365))
+        self.create_order('Completed', 5)
+        self.create_order('Pending', 5)
+
+        orders = Order.objects.in_range(self.now - timedelta(days=450))
+
+        # Completed has rows in both tables but is one group
+        self.assertEqual(orders.values('status').annotate(count=Count('id')).count(), 2)
+
+    def test_flat_values_list_sorted_across_tables(self):
+        archived = self.create_order('Completed', 400)
+        archive_orders(before=archive_horizon(self.now, days=365))
+        newest = self.create_order('Completed', 5)
+        middle = self.create_order('Pending', 10)
+
+        orders = Order.objects.in_range(self.now - timedelta(days=450)).order_by('-order_date')
+
+        self.assertEqual(list(orders.values_list('id', flat=True)), [newest, middle, archived])
+        self.assertEqual(list(orders.values_list('id', flat=True)[:2]), [newest, middle])
+        self.assertEqual(list(orders.order_by('id').values_list('id', flat=True)), sorted([newest, middle, archived]))
+
+    def test_history_and_detail_include_archived_orders(self):
+        archived = self.create_order('Completed', 400)
+        archive_orders(before=archive_horizon(self.now, days=365))
+        live = self.create_order('Pending', 1)
+        self.client.force_login(self.user)
+
+        response = self.client.get(reverse('order_history'))
+        self.assertEqual([order.id for order in response.context['orders']], [live, archived])
+
+        response = self.client.get(reverse('order_detail', args=[archived]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['order'].id, archived)
+
+    def test_archive_command(self):
+        from io import StringIO
+        for days_ago in (400, 401, 402):
+            self.create_order('Completed', days_ago)
+
+        out = StringIO()
+        call_command('archive_orders', days=365, batch_size=2, stdout=out)
+
+        self.assertIn("Archived 3 orders", out.getvalue())
+        self.assertFalse(Order.objects.exists())
+
+
+class ConcurrentReservationTests(InventoryTestMixin, TransactionTestCase):
+    THREADS = 12
+    QUANTITY = 3
+
+    def test_guarded_decrement_never_oversells(self):
+        # Both checkouts read the same stock before either reserves
+        first = self.create_product(stock=5)
+        second = Product.objects.get(pk=first.pk)
+
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                reserve_stock([CartItem(product=first, quantity=4)])
+
+        # The stock check is part of the decrement, so no read can go stale in between
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"stock" >= 4', updates[0])
+        self.assertFalse([query for query in queries if query['sql'].startswith('SELECT')])
+
+        with self.assertRaises(InsufficientStock) as raised:
+            with transaction.atomic():
+                reserve_stock([CartItem(product=second, quantity=4)])
+
+        self.assertEqual(raised.exception.shortages, [('Widget', 4, 1)])
+        self.assertEqual(Product.objects.get(pk=first.pk).stock, 1)
+
+    @skipIf(connection.vendor == 'sqlite', "SQLite serializes writers at the database level")
+    def test_concurrent_checkouts_never_oversell(self):
+        product = self.create_product(stock=20)
+        other = self.create_product('Other', stock=100)
+        start = threading.Barrier(self.THREADS)
+        outcomes = []
+
+        def checkout(index):
+            try:
+                # Alternate item order so rows are requested in both orders
+                items = [CartItem(product=product, quantity=self.QUANTITY), CartItem(product=other, quantity=1)]
+                if index % 2:
+                    items.reverse()
+                start.wait()
+                try:
+                    with transaction.atomic():
+                        reserve_stock(items)
+                    outcomes.append(True)
+                except InsufficientStock:
+                    outcomes.append(False)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout, args=(index,)) for index in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product.refresh_from_db()
+        other.refresh_from_db()
+        reserved = outcomes.count(True)
+        self.assertEqual(len(outcomes), self.THREADS)
+        self.assertEqual(reserved, 20 // self.QUANTITY)
+        self.assertEqual(product.stock, 20 - reserved * self.QUANTITY)
+        self.assertEqual(other.stock, 100 - reserved)
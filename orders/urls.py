@@ -5,6 +5,7 @@ urlpatterns = [
     path('checkout/', views.checkout_view, name='checkout'),
     path('history/', views.order_history_view, name='order_history'),
     path('detail/<int:order_id>/', views.order_detail_view, name='order_detail'),
+    path('status/<int:order_id>/', views.order_status_view, name='order_status'),
     
     # Staff-only URLs for order management
     path('management/', views.order_management_view, name='order_management'),
@@ -2,61 +2,152 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.db import transaction
+from django.http import JsonResponse
+from django.urls import reverse
 from django.utils import timezone
-import time
+from django.utils.dateparse import parse_date
+from datetime import datetime, time, timedelta
+import uuid
 
 from cart.models import Cart
-from .models import Order, OrderItem
+from .idempotency import claim_checkout, complete_checkout, parse_key, release_checkout
+from .inventory import InsufficientStock, reserve_stock
+from .models import ArchivedOrder, Order, OrderItem
+from .pagination import paginate_orders
+from .state_machine import next_statuses, transition
+from fraud_detection.models import FraudConfirmation
+from fraud_detection.pipeline import scoring_settings, submit_scoring
 from fraud_detection.services import FraudDetectionService
 
+def _order_items(order, cart_items):
+    """Build unsaved order items snapshotting the given cart items"""
+    return [
+        OrderItem(
+            order=order,
+            product_name=cart_item.product.name,
+            product_price=cart_item.product.price,
+            quantity=cart_item.quantity,
+            product=cart_item.product
+        )
+        for cart_item in cart_items
+    ]
+
 @login_required
 def checkout_view(request):
     """Handle checkout process with fraud detection."""
+    if request.method == 'POST':
+        key = parse_key(request.POST.get('idempotency_key'))
+        if key is None:
+            return _place_order(request)[0]
+        
+        # A retry of a submission already seen replays its outcome instead of checking out again
+        attempt, claimed = claim_checkout(request.user, key)
+        if attempt is None:
+            return _place_order(request)[0]
+        if not claimed:
+            return _replay_checkout(request, attempt)
+        
+        try:
+            response, order = _place_order(request)
+        except Exception:
+            release_checkout(attempt)
+            raise
+        if order is None:
+            # Nothing was placed (empty cart, short stock), let the form be submitted again
+            release_checkout(attempt)
+        else:
+            complete_checkout(attempt, order, response.url)
+        return response
+    
     try:
-        cart = Cart.objects.get(user=request.user)
-        if cart.items.count() == 0:
+        cart = Cart.objects.with_items().get(user=request.user)
+        if not cart.total_items:
             messages.error(request, "Your cart is empty.")
             return redirect('cart')
     except Cart.DoesNotExist:
         messages.error(request, "Your cart is empty.")
         return redirect('cart')
+    
+    return render(request, 'orders/checkout.html', {'cart': cart, 'idempotency_key': uuid.uuid4()})
 
-    if request.method == 'POST':
-        # Get user confirmed location and addresses from form
-        confirmed_location = request.POST.get('confirmed_location', '')
-        shipping_address = request.POST.get('shipping_address', '')
-        billing_address = request.POST.get('billing_address', '')
-        
-        # Simulate processing delay for UX (3-5 seconds)
-        time.sleep(3)
-        
-        # Initialize fraud detection service
-        fraud_service = FraudDetectionService(
-            user=request.user,
-            cart=cart,
-            confirmed_location=confirmed_location,
-            shipping_address=shipping_address, 
-            billing_address=billing_address
-        )
-        
-        # Collect transaction data
-        transaction_data = fraud_service.collect_transaction_data()
-        
-        # Run fraud detection rules
-        is_flagged = fraud_service.run_fraud_detection()
+def _replay_checkout(request, attempt):
+    """Answer a repeated checkout submission with the outcome of the first one"""
+    if attempt.redirect_url:
+        messages.info(request, "This checkout was already submitted.")
+        return redirect(attempt.redirect_url)
+    messages.info(request, "Your checkout is still being processed.")
+    return redirect('order_history')
+
+def _place_order(request):
+    """Run a checkout submission; returns the response and the order placed or held, if any"""
+    try:
+        cart = Cart.objects.with_items().get(user=request.user)
+    except Cart.DoesNotExist:
+        messages.error(request, "Your cart is empty.")
+        return redirect('cart'), None
+    
+    # Get user confirmed location and addresses from form
+    confirmed_location = request.POST.get('confirmed_location', '')
+    shipping_address = request.POST.get('shipping_address', '')
+    billing_address = request.POST.get('billing_address', '')
+    
+    # Initialize fraud detection service
+    fraud_service = FraudDetectionService(
+        user=request.user,
+        cart=cart,
+        confirmed_location=confirmed_location,
+        shipping_address=shipping_address, 
+        billing_address=billing_address,
+        request=request
+    )
+    
+    # Check the items fraud detection loaded instead of counting them first
+    if not fraud_service.features.items:
+        messages.error(request, "Your cart is empty.")
+        return redirect('cart'), None
+    
+    if scoring_settings()['async']:
+        # Place the order now and score it in the background once committed
+        with transaction.atomic():
+            order = Order.objects.create(
+                user=request.user,
+                total_price=fraud_service.order_total,
+                status='Scoring'
+            )
+            OrderItem.objects.bulk_create(_order_items(order, fraud_service.features.items))
+            cart.clear()
+            transaction.on_commit(lambda: submit_scoring(fraud_service, order.id))
         
-        if is_flagged:
-            # Create fraud confirmation entry
+        messages.info(request, f"Your order #{order.id} has been received and is being checked.")
+        return redirect('order_detail', order_id=order.id), order
+    
+    # Collect transaction data
+    transaction_data = fraud_service.collect_transaction_data()
+    
+    # Run fraud detection rules
+    is_flagged = fraud_service.run_fraud_detection()
+    
+    if is_flagged:
+        # Create fraud confirmation entry, holding the stock until it expires
+        try:
             confirmation = fraud_service.create_fraud_confirmation()
-            
-            # Redirect to verification page
-            messages.warning(request, "Your transaction requires additional verification.")
-            return redirect('verification_required', confirmation_key=confirmation.confirmation_key)
-        else:
-            # Create order from cart items if no flags
+        except InsufficientStock as e:
+            messages.error(request, f"{e}. Please update your cart.")
+            return redirect('cart'), None
+        
+        # Redirect to verification page
+        messages.warning(request, "Your transaction requires additional verification.")
+        return redirect('verification_required', confirmation_key=confirmation.confirmation_key), confirmation.order
+    else:
+        # Create order from cart items if no flags
+        try:
             with transaction.atomic():
-                # Calculate total price
-                total_price = cart.total_price
+                # Reuse the cart items and total already loaded for fraud detection
+                cart_items = fraud_service.features.items
+                total_price = fraud_service.order_total
+                
+                # Reserve stock first so a shortfall fails before anything is written
+                reserve_stock(cart_items)
                 
                 # Create order
                 order = Order.objects.create(
@@ -66,66 +157,127 @@ def checkout_view(request):
                 )
                 
                 # Create order items from cart items
-                for cart_item in cart.items.all():
-                    OrderItem.objects.create(
-                        order=order,
-                        product_name=cart_item.product.name,
-                        product_price=cart_item.product.price,
-                        quantity=cart_item.quantity,
-                        product=cart_item.product
-                    )
-                    
-                    # Update product stock
-                    product = cart_item.product
-                    product.stock -= cart_item.quantity
-                    product.save()
+                OrderItem.objects.bulk_create(_order_items(order, cart_items))
                 
                 # Clear the cart
-                cart.items.all().delete()
-                
-                messages.success(request, f"Your order #{order.id} has been placed successfully!")
-                return redirect('order_detail', order_id=order.id)
-    
-    return render(request, 'orders/checkout.html', {'cart': cart})
+                cart.clear()
+        except InsufficientStock as e:
+            messages.error(request, f"{e}. Please update your cart.")
+            return redirect('cart'), None
+        
+        messages.success(request, f"Your order #{order.id} has been placed successfully!")
+        return redirect('order_detail', order_id=order.id), order
+
+def _page_query(request):
+    """The current query string without the page cursors, for building page links"""
+    query = request.GET.copy()
+    query.pop('after', None)
+    query.pop('before', None)
+    return query.urlencode()
 
 @login_required
 def order_history_view(request):
-    """Display order history for the current user."""
-    orders = Order.objects.filter(user=request.user)
-    return render(request, 'orders/order_history.html', {'orders': orders})
+    """Display order history for the current user, archived orders included, one keyset page at a time."""
+    orders = Order.objects.in_range().filter(user=request.user).prefetch_related('items')
+    page = paginate_orders(orders, after=request.GET.get('after'), before=request.GET.get('before'))
+    return render(request, 'orders/order_history.html', {
+        'orders': page.orders,
+        'page': page,
+        'page_query': _page_query(request),
+    })
 
 @login_required
 def order_detail_view(request, order_id):
     """Display details of a specific order."""
     try:
         order = Order.objects.get(id=order_id, user=request.user)
-        return render(request, 'orders/order_detail.html', {'order': order})
     except Order.DoesNotExist:
-        messages.error(request, "Order not found.")
-        return redirect('order_history')
+        # Finished orders past the archive horizon keep their id in the archive
+        order = ArchivedOrder.objects.filter(id=order_id, user=request.user).first()
+        if order is None:
+            messages.error(request, "Order not found.")
+            return redirect('order_history')
+    return render(request, 'orders/order_detail.html', {'order': order})
+
+@login_required
+def order_status_view(request, order_id):
+    """Report an order's status as JSON so clients can poll for the fraud check outcome."""
+    order = get_object_or_404(Order.objects.only('id', 'status'), id=order_id, user=request.user)
+    
+    redirect_url = None
+    if order.status == 'Verification':
+        confirmation_key = FraudConfirmation.objects.filter(order=order).values_list('confirmation_key', flat=True).first()
+        if confirmation_key:
+            redirect_url = reverse('verification_required', kwargs={'confirmation_key': confirmation_key})
+    elif order.status != 'Scoring':
+        redirect_url = reverse('order_detail', kwargs={'order_id': order.id})
+    
+    return JsonResponse({
+        'order_id': order.id,
+        'status': order.status,
+        'status_display': order.get_status_display(),
+        'is_scoring': order.status == 'Scoring',
+        'redirect_url': redirect_url,
+    })
 
 # Check if user is staff
 def is_staff(user):
     return user.is_authenticated and user.is_staff
 
+def _day_start(value):
+    """Start of the given YYYY-MM-DD day in the current time zone, or None"""
+    try:
+        day = parse_date(value or '')
+    except ValueError:
+        return None
+    if day is None:
+        return None
+    return timezone.make_aware(datetime.combine(day, time.min))
+
 @user_passes_test(is_staff)
 def order_management_view(request):
-    """Display all orders for staff to manage."""
-    orders = Order.objects.all().order_by('-order_date')
-    return render(request, 'orders/order_management.html', {'orders': orders})
+    """Display all orders for staff to manage, filtered by status and date, one keyset page at a time."""
+    orders = Order.objects.select_related('user').prefetch_related('items')
+    
+    # Both filters are ranges on the (status, order_date, id) or (order_date, id) index
+    status = request.GET.get('status', '')
+    if status in dict(Order.STATUS_CHOICES):
+        orders = orders.filter(status=status)
+    else:
+        status = ''
+    date_from = _day_start(request.GET.get('date_from'))
+    if date_from:
+        orders = orders.filter(order_date__gte=date_from)
+    date_to = _day_start(request.GET.get('date_to'))
+    if date_to:
+        orders = orders.filter(order_date__lt=date_to + timedelta(days=1))
+    
+    page = paginate_orders(orders, after=request.GET.get('after'), before=request.GET.get('before'))
+    labels = dict(Order.STATUS_CHOICES)
+    for order in page.orders:
+        order.next_statuses = [(value, labels[value]) for value in next_statuses(order.status)]
+    return render(request, 'orders/order_management.html', {
+        'orders': page.orders,
+        'page': page,
+        'page_query': _page_query(request),
+        'status_choices': Order.STATUS_CHOICES,
+        'status': status,
+        'date_from': request.GET.get('date_from', '') if date_from else '',
+        'date_to': request.GET.get('date_to', '') if date_to else '',
+    })
 
 @user_passes_test(is_staff)
 def update_order_status(request, order_id):
-    """Update the status of an order (staff only)."""
+    """Move an order to a new status if the state machine allows it (staff only)."""
     if request.method == 'POST':
-        order = get_object_or_404(Order, id=order_id)
+        order = get_object_or_404(Order.objects.only('id', 'status'), id=order_id)
         new_status = request.POST.get('status')
         
-        if new_status in dict(Order.STATUS_CHOICES).keys():
-            order.status = new_status
-            order.save()
+        if new_status not in dict(Order.STATUS_CHOICES).keys():
+            messages.error(request, "Invalid status selected")
+        elif transition(Order.objects.filter(pk=order.pk), new_status):
             messages.success(request, f"Order #{order.id} status updated to {new_status}")
         else:
-            messages.error(request, "Invalid status selected")
+            messages.error(request, f"Order #{order.id} cannot move from {order.status} to {new_status}")
             
     return redirect('order_management')
@@ -0,0 +1,35 @@
+"""
+Recompute the stored product search vectors
+"""
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from products.models import Product, update_search_vectors
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute Product.search_vector for every product, in batches of product ids. Run it once after "
+        "upgrading and after bulk imports or update() calls that change names or descriptions. PostgreSQL only; "
+        "other databases search an in-process index that rebuilds itself."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Products updated per statement")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            self.stdout.write("No stored search vectors on this database, nothing to rebuild")
+            return
+
+        batch_size = options['batch_size']
+        total = 0
+        last_id = 0
+        while True:
+            batch = list(Product.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+            if not batch:
+                break
+            total += update_search_vectors(Product.objects.filter(id__in=batch))
+            last_id = batch[-1]
+        self.stdout.write(f"Rebuilt search vectors for {total} products")
@@ -1,6 +1,25 @@
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import connection, models
 from django.urls import reverse
 
+# Text search configuration of Product.search_vector
+SEARCH_CONFIG = 'english'
+
+
+def search_vector():
+    """Expression computing a product's search vector from its own columns."""
+    return (SearchVector('name', weight='A', config=SEARCH_CONFIG)
+            + SearchVector('description', weight='B', config=SEARCH_CONFIG))
+
+
+def update_search_vectors(queryset):
+    """Recompute the stored search vector of the products in queryset, in one UPDATE."""
+    if connection.vendor != 'postgresql':
+        # Only PostgreSQL has tsvectors; see products.search for the fallback
+        return 0
+    return queryset.update(search_vector=search_vector())
+
 class Category(models.Model):
     """Category model for product categorization."""
     name = models.CharField(max_length=100)
@@ -22,9 +41,22 @@ class Product(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Weighted tsvector of name and description, maintained by save()
+    search_vector = SearchVectorField(null=True, editable=False)
+    
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='product_search_vector_gin'),
+        ]
     
     def __str__(self):
         return self.name
     
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'name', 'description'} & set(update_fields):
+            update_search_vectors(Product.objects.filter(pk=self.pk))
+    
     def get_absolute_url(self):
         return reverse('product_detail', args=[self.pk])
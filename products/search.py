@@ -0,0 +1,100 @@
+"""
+Storefront product search
+
+On PostgreSQL, Product.search_vector holds a weighted tsvector of the
+product name (weight A) and description (weight B). Product.save keeps it
+current and a GIN index serves the match. Results are ranked with ts_rank
+against a websearch_to_tsquery of the visitor's terms:
+
+    SELECT ... WHERE search_vector @@ websearch_to_tsquery('english', <terms>)
+    ORDER BY ts_rank(search_vector, ...) DESC
+
+Other databases (SQLite in tests and local development) have no tsvector,
+so search falls back to an in-process inverted index over the same fields.
+It is rebuilt whenever the product table has changed and approximates the
+PostgreSQL behaviour: every term must match, and name matches outrank
+description matches.
+
+Products created with bulk_create or renamed with update() bypass save();
+run the rebuild_search_index command afterwards.
+"""
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import Count, F, Max
+import re
+import threading
+
+from .models import SEARCH_CONFIG, Product
+
+# Rank weights of the fallback index, after PostgreSQL's defaults for A and B
+NAME_WEIGHT = 1.0
+DESCRIPTION_WEIGHT = 0.4
+
+
+def tokenize(text):
+    """Lower-cased words, with a plural 's' dropped so 'widgets' finds 'widget'"""
+    return [word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word
+            for word in re.findall(r'\w+', (text or '').lower())]
+
+
+class LocalSearchIndex:
+    """In-process inverted index of product names and descriptions"""
+
+    def __init__(self):
+        self._postings = {}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _table_version(self):
+        # Changes whenever a product is added, removed or saved
+        return tuple(Product.objects.aggregate(count=Count('id'), updated=Max('updated_at')).values())
+
+    def _build(self):
+        postings = {}
+        for product_id, name, description in Product.objects.values_list('id', 'name', 'description').iterator():
+            for weight, text in ((NAME_WEIGHT, name), (DESCRIPTION_WEIGHT, description)):
+                for term in tokenize(text):
+                    scores = postings.setdefault(term, {})
+                    scores[product_id] = scores.get(product_id, 0) + weight
+        return postings
+
+    def search(self, query):
+        """Product ids matching every term of query, best match first"""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        version = self._table_version()
+        with self._lock:
+            if version != self._version:
+                self._postings = self._build()
+                self._version = version
+            postings = [self._postings.get(term, {}) for term in terms]
+
+        matches = set.intersection(*(set(scores) for scores in postings))
+        ranked = {product_id: sum(scores[product_id] for scores in postings) for product_id in matches}
+        return sorted(ranked, key=lambda product_id: (-ranked[product_id], product_id))
+
+
+_local_index = LocalSearchIndex()
+
+
+def search_products(query):
+    """
+    Products matching query, best match first. A queryset annotated with
+    rank on PostgreSQL, a list of products elsewhere.
+    """
+    query = (query or '').strip()
+    if not query:
+        return Product.objects.none()
+
+    if connection.vendor == 'postgresql':
+        terms = SearchQuery(query, search_type='websearch', config=SEARCH_CONFIG)
+        return (
+            Product.objects.defer('search_vector').filter(search_vector=terms)
+            .annotate(rank=SearchRank(F('search_vector'), terms))
+            .order_by('-rank', 'id')
+        )
+
+    product_ids = _local_index.search(query)
+    products = Product.objects.in_bulk(product_ids)
+    return [products[product_id] for product_id in product_ids if product_id in products]
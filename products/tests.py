@@ -1,3 +1,73 @@
-from django.test import TestCase
+from decimal import Decimal
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+
+from analytics.models import SearchQuery
+from .models import Category, Product
+from .search import search_products, tokenize
+from .views import ProductSearchView
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='General')
+
+    def create_product(self, name, description):
+        return Product.objects.create(
+            name=name, description=description, price=Decimal('10.00'), stock=5, category=self.category
+        )
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize('Blue Widgets, glass!'), ['blue', 'widget', 'glass'])
+
+    def test_name_matches_rank_first_and_every_term_must_match(self):
+        described = self.create_product('Desk lamp', 'Comes with a blue widget clip')
+        named = self.create_product('Blue widget', 'A small gadget')
+        red = self.create_product('Red widget', 'A small gadget')
+
+        self.assertEqual(search_products('blue widgets'), [named, described])
+        # Equal ranks fall back to product order
+        self.assertEqual(search_products('gadget'), [named, red])
+        self.assertEqual(list(search_products('   ')), [])
+
+    def test_index_follows_product_changes(self):
+        product = self.create_product('Teapot', 'Ceramic')
+        self.assertEqual(search_products('kettle'), [])
+
+        product.name = 'Kettle'
+        product.save()
+        self.assertEqual(search_products('kettle'), [product])
+
+        product.delete()
+        self.assertEqual(search_products('kettle'), [])
+
+    def test_search_page(self):
+        for index in range(14):
+            self.create_product(f'Widget {index}', 'Test product')
+
+        response = self.client.get(reverse('product_search'), {'q': 'widget'})
+
+        self.assertEqual(response.context['paginator'].count, 14)
+        self.assertEqual(len(response.context['products']), 12)
+        self.assertContains(response, '14 products found')
+
+    def test_query_logged_after_response_is_sent(self):
+        self.create_product('Widget', 'Test product')
+        request = RequestFactory().get(reverse('product_search'), {'q': 'widget'})
+        request.user = AnonymousUser()
+
+        response = ProductSearchView.as_view()(request)
+        response.render()
+        self.assertFalse(SearchQuery.objects.exists())
+
+        # The server closes the response once it has been written out
+        response.close()
+        search = SearchQuery.objects.get()
+        self.assertEqual((search.query_text, search.results_count, search.user), ('widget', 1, None))
+
+    def test_empty_query_is_not_logged(self):
+        self.client.get(reverse('product_search'), {'q': ''})
+
+        self.assertFalse(SearchQuery.objects.exists())
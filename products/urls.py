@@ -3,5 +3,6 @@ from . import views
 
 urlpatterns = [
     path('', views.ProductListView.as_view(), name='product_list'),
+    path('search/', views.ProductSearchView.as_view(), name='product_search'),
     path('<int:pk>/', views.ProductDetailView.as_view(), name='product_detail'),
 ]
\ No newline at end of file
@@ -1,6 +1,8 @@
 from django.shortcuts import render, get_object_or_404
 from django.views.generic import ListView, DetailView
+from analytics.services import record_search_query_after_response
 from .models import Product, Category
+from .search import search_products
 
 class ProductListView(ListView):
     """View for displaying all products or products by category."""
@@ -10,7 +12,8 @@ class ProductListView(ListView):
     paginate_by = 12
     
     def get_queryset(self):
-        queryset = super().get_queryset()
+        # Listings never need the stored search vector
+        queryset = super().get_queryset().defer('search_vector')
         category_id = self.request.GET.get('category')
         if category_id:
             queryset = queryset.filter(category__id=category_id)
@@ -21,6 +24,30 @@ class ProductListView(ListView):
         context['categories'] = Category.objects.all()
         return context
 
+class ProductSearchView(ListView):
+    """View for searching products by name and description, best match first."""
+    template_name = 'products/search_results.html'
+    context_object_name = 'products'
+    paginate_by = 12
+    
+    def get_queryset(self):
+        self.query = self.request.GET.get('q', '').strip()
+        return search_products(self.query)
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['query'] = self.query
+        return context
+    
+    def get(self, request, *args, **kwargs):
+        response = super().get(request, *args, **kwargs)
+        if self.query:
+            # Logged after the response is sent, so searching is not slowed down
+            record_search_query_after_response(
+                response, request, self.query[:255], response.context_data['paginator'].count
+            )
+        return response
+
 class ProductDetailView(DetailView):
     """View for displaying a single product's details."""
     model = Product